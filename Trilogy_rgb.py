@@ -49,7 +49,7 @@ outdir   .
 samplesize 1000
 sampledx  0
 sampledy  0
-stampsize  1000
+stampsize  None
 showstamps  0
 satpercent  0.001
 noiselum    0.10
@@ -63,7 +63,14 @@ deletetests  0
 scaling  None
 legend  1
 thumbnail  None
-maxstampsize  6000
+pyramid  0
+maxstampsize  None
+memory  None
+workers  None
+register  0
+psfmatch  0
+gridref  None
+background  0
 """
 
 # Can also set noiselum individually for each filter with:
@@ -77,17 +84,28 @@ maxstampsize  6000
     'samplesize':1000,  # to determine levels
     'sampledx':0,  # offset
     'sampledy':0,  # offset
-    'stampsize': 1000,  # for making final color image one section at a time (just a memory issue)
-    'maxstampsize':6000,   # My memory can't handle an array larger than 6000x6000
+    'stampsize': None,  # for making final color image one section at a time; None: chosen from the memory budget
+    'maxstampsize':None,   # largest sample used to determine levels; None: chosen from the memory budget
+    'memory':None,  # memory budget, e.g. 8G or 512M; None: the RAM available when Trilogy starts
+    'workers':None,  # number of sections made at once; None: chosen from the memory budget and CPUs
+    'processes':0,  # 1: scale the sections in worker processes, which get them through shared memory (shared_arena.py), instead of threads
+    'register':0,  # 1: measure the sub-pixel offset of every image from registerref in the central sample and shift them onto it
+    'registerref':None,  # reference image for register; None: the first image of R (the reddest channel)
+    'psfmatch':0,  # 1: convolve every image to the PSF of psftarget (psfmatch.py), so red halos don't surround compact sources
+    'psftarget':None,  # filter to match to; None: the broadest PSF of the images
+    'gridref':None,  # image whose pixel grid (WCS) the others are reprojected onto; None: the largest image if they differ in size
+    'background':0,  # 1: subtract a background that varies across the image, measured in backbox x backbox boxes
+    'backbox':256,  # pixels; several times larger than the galaxies
     'showwith':'open',  # Command to display images; set to 0 to display with PIL (as lossy jpeg)
     'scaling':None,  # Use an input scaling levels file
     'legend':1,  # Adds legend to top-left corner indicating which filters were used
+    'thumbnail':None,  # width of a downsampled copy, e.g. 800 or 800.png (default jpg); made from the pyramid if there is one
+    'pyramid':0,  # dzi or xyz: also write the image as 256x256 tiles at every zoom level (pyramid.py), while it is made
 """
 
 #################################
 
 # TO DO:
-# Images larger than 6000
 # More robust input? if just input 3 fits files, have them be RGB?
 # Change temperature to make image redder/bluer, if desired
 # I should allow for input of a weight image and make use of it, but I don't currently
@@ -153,7 +171,6 @@ maxstampsize  6000
 
 #import pyfits
 import astropy.io.fits as pyfits
-import string
 from numpy import *
 #import Image
 from PIL import Image, ImageDraw
@@ -161,6 +178,15 @@ import os, sys
 from scipy.optimize import golden
 from os.path import exists, join
 from glob import glob
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import registration
+import psfmatch
+import regrid
+import background
+import accel
+import pyramid
 
 defaultvalues = {
     'indir':'',
@@ -172,21 +198,40 @@ defaultvalues = {
     'satpercent':0.001,  # *Percentage* of pixels which will be saturated
     # (satpercent = 0.001 means 1 / 100,000 pixels will be saturated)
     'colorsatfac':1,  # > 1 to boost color saturation
-    'thumbnail':None,
+    'thumbnail':None,  # width (and format), e.g. 800 or 800.png; see makethumbnail
+    'pyramid':0,  # dzi or xyz: write a tile pyramid of the image as it is made; see makecolorimage
+    'tilesize':256,  # side of the pyramid tiles, in pixels
+    'tileformat':'png',  # png or jpg
     'samplesize':1000,  # to determine levels
     'sampledx':0,  # offset
     'sampledy':0,  # offset
-    'stampsize': 1000,  # for making final color image (just a memory issue)
+    'stampsize': None,  # for making final color image (just a memory issue); None: see planstamps
     'testfirst':1,
     'show':1,
     'showstamps':0,
     'showwith':'open',  # Command to display images; set to 0 to display with PIL (as lossy jpeg)
     'deletetests':0,
     'scaling':None,
-    'maxstampsize':6000,   # My memory can't handle an array larger than 6000x6000
+    'maxstampsize':None,   # None: largest sample that fits in memory; see planstamps
+    'memory':None,  # memory budget (bytes, or e.g. '8G'); None: available RAM
+    'workers':None,  # sections made at once; None: see planstamps
+    'processes':0,  # 1: RGBscale2im in worker processes through shared memory, instead of threads; see makecolorimage
+    'register':0,  # 1: register the images to registerref by phase correlation; see planregistration
+    'registerref':None,  # None: first image of R
+    'registersize':512,  # side of the central region used to measure the offsets
+    'maxshift':3,  # largest offset (pixels) searched for
+    'offsets':{},  # image: (dx, dy) offset from the reference, in pixels (measured if register)
+    'psfmatch':0,  # 1: convolve every image to the PSF of psftarget; see planpsfmatch
+    'psftarget':None,  # None: broadest PSF of the images
+    'pixelscale':0.03,  # arcsec per pixel, for psfmatch
+    'gridref':None,  # reproject the images onto this image's grid; None: onto the largest image if sizes differ; see plangrid
+    'gridorder':1,  # interpolation order of the reprojection (1: bilinear, 3: cubic)
+    'background':0,  # 1: subtract a BackgroundMesh from every image; see planbackground
+    'backbox':256,  # side of the background mesh boxes, in pixels
+    'backfilter':3,  # median filter of the mesh, in boxes
     'legend':1,  # Adds legend to top-left corner indicating which filters were used
     'invert':0,  # Invert luminosity (black on white)
-    'combine':'average',  # average or sum.  sum was the previous default (not explicitly defined)
+    'combine':'average',  # average, sum or weighted (by the values of the weight images).  sum was the previous default (not explicitly defined); see channelcombiner
     'noise':None,     # determined automatically if None: image data value of the "noise"
     'saturate':None,  # determined automatically if None: image data value allowed to saturate
     'bscale':1,  # Multiply all images by this value
@@ -194,6 +239,7 @@ defaultvalues = {
     'correctbias':0,   # Measure data noise mean (otherwise assume = 0)
     'noisesig':1,    # Data noise level output to noiselum: measured sigma above the measured mean
     'noisesig0':2,   # Data noise level: measured sigma above the measured mean
+    'precision':'float64',  # float32 halves memory (output is 8-bit anyway); see precision_report.py
     }
 
 imfilt = ''  # Initialize
@@ -281,7 +327,7 @@ class meanstd_robust:
             #print(xs[-1])
             #print(xs[-2])
             #print(len(xs))
-            imed = (ilo+ihi) / 2
+            imed = (ilo+ihi) // 2
             #print(imed)
             aver = xs[imed]
             #print('std')
@@ -318,7 +364,7 @@ def decapfile(name, ext=''):
     else:
         if strend(name, '.gz'):
             name = name[:-3]
-        i = string.rfind(name, '.')
+        i = name.rfind('.')
         if i > -1:
             name = name[:i]
     return name
@@ -326,30 +372,30 @@ def decapfile(name, ext=''):
 def stringsplitatof(str, separator=''):
     """Splits a string into floats"""
     if separator:
-        words = string.split(str, separator)
+        words = str.split(separator)
     else:
-        words = string.split(str)
+        words = str.split()
     vals = []
     for word in words:
-        vals.append(string.atof(word))
+        vals.append(float(word))
     return vals
 
 def str2num(str, rf=0):
     """CONVERTS A STRING TO A NUMBER (INT OR FLOAT) IF POSSIBLE
     ALSO RETURNS FORMAT IF rf=1"""
     try:
-        num = string.atoi(str)
+        num = int(str)
         format = 'd'
     except:
         try:
-            num = string.atof(str)
+            num = float(str)
             format = 'f'
         except:
-            if not string.strip(str):
+            if not str.strip():
                 num = None
                 format = ''
             else:
-                words = string.split(str)
+                words = str.split()
                 if len(words) > 1:
                     num = map(str2num, tuple(words))
                     format = 'l'
@@ -379,12 +425,15 @@ def striskey(str):
                 iskey = str[1] not in ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '.']
     return iskey
 
-def params_cl(converttonumbers=True):
+def params_cl(converttonumbers=True, argv=None):
     """RETURNS PARAMETERS FROM COMMAND LINE ('cl') AS DICTIONARY:
     KEYS ARE OPTIONS BEGINNING WITH '-'
     VALUES ARE WHATEVER FOLLOWS KEYS: EITHER NOTHING (''), A VALUE, OR A LIST OF VALUES
-    ALL VALUES ARE CONVERTED TO INT / FLOAT WHEN APPROPRIATE"""
-    list = sys.argv[:]
+    ALL VALUES ARE CONVERTED TO INT / FLOAT WHEN APPROPRIATE
+    argv: ARGUMENTS TO USE INSTEAD OF sys.argv (e.g. FROM cli.py)"""
+    if argv is None:
+        argv = sys.argv
+    list = argv[:]
     i = 0
     dict = {}
     oldkey = ""
@@ -429,11 +478,18 @@ def determinescaling(data, unsatpercent, noisesig=1, correctbias=True, noisesig0
     #print('get stats')
     #s = stat_robust(array(datar))
     #s = stat_robust(data.flat)
-    datasorted = sort(data.flat)
-    datasorted[isnan(datasorted)]=0  # set all nan values to zero
-    if datasorted[0] == datasorted[-1]:
+    # Constant data (e.g. off the edge of the mosaic, NaN counting as 0) is found before sorting
+    nans = isnan(data)
+    if nans.all():
+        constant = True
+    else:
+        lo, hi = nanmin(data), nanmax(data)
+        constant = (lo == hi) and ((lo == 0) or not nans.any())
+    if constant:
         levels = 0, 1, 100  # whatever
     else:
+        datasorted = sort(data.flat)
+        datasorted[isnan(datasorted)]=0  # set all nan values to zero
         s = meanstd_robust(datasorted,sortedalready=True)
         s.run()
         m = s.mean
@@ -536,22 +592,29 @@ def imscale2(data, levels, y1):
     # Normalize?  No.  Unless the data is all ~1e-40 or something...
     #data = data / levels[-1]
     #levels = array(levels) / levels[-1]
-    x0, x1, x2 = levels  
-    if y1 == 0.5:
-        k = (x2 - 2 * x1 + x0) / float(x1 - x0) ** 2
-    else:
-        n = 1 / y1
-        #print('n x0 x1 x2', n, x0, x1, x2)
-        #k = golden(da)
-        k = abs(golden(da))
-        #print('k', k)
-        #pause()
-    r1 = log10( k * (x2 - x0) + 1)
+    with goldenlock:  # stamps may be scaled in several threads (makecolorimage)
+        x0, x1, x2 = [float(x) for x in levels]  # golden needs double precision, even for float32 data
+        if y1 == 0.5:
+            k = (x2 - 2 * x1 + x0) / float(x1 - x0) ** 2
+        else:
+            n = 1 / y1
+            #print('n x0 x1 x2', n, x0, x1, x2)
+            #k = golden(da)
+            k = abs(golden(da))
+            #print('k', k)
+            #pause()
+        lo, hi = x0, x2
+    # log1p(y) / log1p(y2) == log10(y + 1) / log10(y2 + 1), but keeps its precision when k is tiny,
+    # which float32 data needs (float32 data stays float32)
+    dtype = data.dtype.type if data.dtype.kind == 'f' else float64
+    r1 = log1p( k * (hi - lo) )
+    if accel.eligible(data):  # the same steps in one compiled pass
+        return accel.logscale_uint8(data, k, lo, r1)
     v = ravel(data)
     v = clip2(v, 0, None)
-    d = k * (v - x0) + 1
-    d = clip2(d, 1e-30, None)
-    z = log10(d) / r1
+    d = dtype(k) * (v - dtype(lo))
+    d = clip2(d, -0.5, None)  # anything below x0 is clipped to 0 below
+    z = log1p(d) / dtype(r1)
     z = clip(z, 0, 1)
     z.shape = data.shape
     z = z * 255
@@ -559,6 +622,8 @@ def imscale2(data, levels, y1):
     z = z.astype(uint8)
     return z
 
+goldenlock = threading.Lock()
+
 #im255 = imscale  # (old name)
 
 #########
@@ -595,7 +660,7 @@ def adjsat(RGB, K):
     #print(three, nx, ny)
     RGB.shape = three, nx*ny
     #print(m.shape, RGB.shape)
-    RGB = dot(m, RGB)
+    RGB = dot(m.astype(RGB.dtype), RGB)
     RGB.shape = three, nx, ny
     return RGB
 
@@ -625,7 +690,7 @@ def RGBscale2im(RGB, levdict, noiselums, colorsatfac, mode='RGB', invlum=0):
         print('Warning: You should probably feed smaller stamps into RGBscale2im.')
         print("This may take a while...")
 
-    scaled = zeros(RGB.shape, float)
+    scaled = zeros(RGB.shape, RGB.dtype if RGB.dtype.kind == 'f' else float)
     for i in range(three):
         channel = mode[i]  # 'RGB' or 'L'
         levels = levdict[channel]
@@ -687,16 +752,16 @@ def loaddict(filename, dir="", silent=0):
     dict = {}
     for line in lines:
         if line[0] != '#':
-            words = string.split(line)
+            words = line.split()
             key = str2num(words[0])
             val = ''  # if nothing there
-            valstr = string.join(words[1:], ' ')
+            valstr = ' '.join(words[1:])
             valtuple = False
             valarray = True
             if valstr[0] in '[(' and valstr[-1] in '])':  # LIST / TUPLE!
                 valtuple = valstr[0] == '('
                 valstr = valstr[1:-1].replace(',', '')
-                words[1:] = string.split(valstr)
+                words[1:] = valstr.split()
             if len(words) == 2:
                 val = str2num(words[1])
             elif len(words) > 2:
@@ -712,30 +777,6 @@ def loaddict(filename, dir="", silent=0):
     return dict
 
 
-#################################
-# Apply offsets
-# Implement below??
-
-offsets = {}
-
-def offsetarray(data, offset):
-    new = zeros(data.shape)
-    dx, dy = offset
-    if dy >= 0:
-        if dx >= 0:
-            new[dy:,dx:] = data[:-dy,:-dx]
-        else:
-            new[dy:,:-dx] = data[:-dy,dx:]
-    else:
-        if dx >= 0:
-            new[:-dy,dx:] = data[dy:,:-dx]
-        else:
-            new[:-dy,:-dx] = data[dy:,dx:]
-    return new
-
-for channel in offsets.keys():
-    dataRGB[channel] = offsetarray(dataRGB[channel], offsets[channel])
-
 #################################
 
 
@@ -790,6 +831,14 @@ def loadfitsimagedata(image, indir='', silent=1, bscale=1, bzero=0):
     
     return data
 
+def loadfitsimageheader(image, indir=''):
+    if image[-1] == ']':
+        iext = int(image[-2])
+        image = image[:-3]  # Remove [0]
+    else:
+        iext = 0
+    return pyfits.getheader(join(indir, image), iext)
+
 imfilts = {}
 
 def processimagename(image):
@@ -816,6 +865,267 @@ def datascale(data, bscale, bzero):
     else:
         return data
 
+#################################
+# Memory budget: choose the stamp (section) size instead of a fixed maxstampsize
+
+def availablememory():
+    """RAM available now, in bytes (MemAvailable on Linux, else all physical memory)"""
+    try:
+        for line in open('/proc/meminfo'):
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024**3  # can't tell: assume a small machine
+
+def parsememory(memory):
+    """Memory budget in bytes from 8000000000, '8G', '512M', '64K'; None or 'auto' -> availablememory()"""
+    if memory in [None, 'None', 'auto']:
+        return availablememory()
+    if type(memory) == str:
+        units = {'K':1024, 'M':1024**2, 'G':1024**3, 'T':1024**4}
+        memory = memory.strip().upper().rstrip('B')
+        if memory[-1] in units:
+            return int(float(memory[:-1]) * units[memory[-1]])
+    return int(float(memory))
+
+def bytesperpixel(nchannels, itemsize, weighting, weighted=0):
+    """Peak memory per stamp pixel while one stamp goes through loadstamps and RGBscale2im"""
+    # loadstamps: stampRGB + the stamp being added (channelcombiner's buffer)
+    b = (nchannels + 1) * itemsize
+    if weighting:  # weightRGB + the unpacked weight mask
+        b += nchannels * itemsize + 1
+    if weighted:  # the weight values instead of the mask
+        b += itemsize - 1
+    # RGBscale2im: scaled, imscale2 temporaries (v, d, z), then RGB2im transposed + clipped copies and uint8
+    b += nchannels * itemsize + 3 * itemsize + 2 * nchannels * itemsize + nchannels
+    return b
+
+def planstamps(nx, ny, nchannels, itemsize, weighting, budget, workers=None, minside=256, weighted=0):
+    """Choose the stamp shape (dy, dx) and how many stamps to make at once within budget (bytes)
+    Stamps span whole rows when they can: FITS images are stored row by row"""
+    bpp = bytesperpixel(nchannels, itemsize, weighting, weighted)
+    pixels = int(budget / bpp)  # pixels all workers may hold at once
+    if pixels < minside * minside:
+        print('Warning: memory budget of %d bytes is less than one %dx%d stamp needs.' % (budget, minside, minside))
+        pixels = minside * minside
+    if workers in [None, 'None', 0]:
+        workers = os.cpu_count() or 1
+    workers = max([1, min([int(workers), pixels // (minside * minside)])])
+    perworker = pixels // workers
+    if perworker >= nx * minside:  # whole rows
+        dx = nx
+        dy = min([ny, perworker // nx])
+    else:
+        dx = dy = int(sqrt(perworker))
+        dx = min([dx, nx])
+        dy = min([dy, ny])
+    nstamps = int(ceil(ny / float(dy)) * ceil(nx / float(dx)))
+    workers = min([workers, nstamps])
+    return dy, dx, workers
+
+#################################
+# Channel combination: add the images of each channel into one stamp
+
+class channelcombiner:
+    """Combines the images of each channel into a stamp, adding them in place
+    combine: 'average', 'sum', or 'weighted'
+    With weight images (imext -> weightext), 'average' and 'sum' use them as flags (weight > 0)
+    and divide each pixel by the number of images flagged there, as loadstamps always did;
+    'weighted' adds weight * image and divides by the sum of the weights (e.g. inverse variance maps),
+    and needs weight images.  Without them, 'sum' adds the images and 'average' divides by their number.
+    Images are opened once; weight masks are cached bit-packed (1 bit / pixel) per stamp."""
+    def __init__(self, indir='', imext=None, weightext=None, combine='average', precision='float64', bscale=1, bzero=0):
+        self.indir = indir
+        self.imext = imext
+        self.weightext = weightext
+        self.weighting = weightext != None
+        self.combine = combine
+        if (combine == 'weighted') and not self.weighting:
+            raise ValueError("combine 'weighted' needs weight images (weightimages)")
+        self.precision = precision
+        self.bscale = bscale
+        self.bzero = bzero
+        self.data = {}         # image: memory-mapped data
+        self.weightfiles = {}  # image: weight image, or None if it does not exist
+        self.masks = {}        # (image, limits): bit-packed weight mask
+        self.buffers = threading.local()  # each thread's stamp buffer
+        self.offsets = {}      # image: (dx, dy) offset from the reference image; see Trilogy.planregistration
+        self.margin = 4        # extra pixels loaded around a stamp before it is shifted (the Lanczos kernel's reach)
+        self.psffilters = {}   # image: filter, for images convolved to the PSF of psftarget; see Trilogy.planpsfmatch
+        self.psftarget = None
+        self.pixelscale = psfmatch.pixel_scale
+        self.reprojections = {}  # image: regrid.Reprojection onto the output grid; see Trilogy.plangrid
+        self.backgrounds = {}  # image: background.BackgroundMesh subtracted from it; see Trilogy.planbackground
+
+    def imagedata(self, image, silent=1):
+        data = self.data.get(image)
+        if data is None:
+            data = loadfitsimagedata(image, self.indir, silent=silent)
+            self.data[image] = data
+        return data
+
+    def section(self, image, limits, grid=None):
+        """image within limits (ylo, yhi, xlo, xhi) of the output grid, which may extend past the image (zeros there)
+        Images on another grid (or their weight images: grid = image) are reprojected tile by tile,
+        and the background of the tile is subtracted (except where the image is 0: outside the survey)"""
+        data = self.imagedata(image)
+        mesh = self.backgrounds.get(image)
+        reprojection = self.reprojections.get(grid or image)
+        if reprojection is not None:
+            tile = reprojection.resample(data, limits, self.precision)
+            if mesh is not None:
+                sy, sx = reprojection.mapping(limits)
+                tile -= where(tile != 0, mesh.at(sy, sx), 0)
+            return tile
+        ylo, yhi, xlo, xhi = limits
+        ny, nx = data.shape
+        y0, y1 = max([ylo, 0]), min([yhi, ny])
+        x0, x1 = max([xlo, 0]), min([xhi, nx])
+        if (mesh is None) and ((y0, y1, x0, x1) == (ylo, yhi, xlo, xhi)):
+            return data[ylo:yhi,xlo:xhi]
+        tile = zeros((yhi - ylo, xhi - xlo), self.precision)
+        if (y0 < y1) and (x0 < x1):
+            inside = tile[y0-ylo:y1-ylo, x0-xlo:x1-xlo]
+            inside[:] = data[y0:y1,x0:x1]
+            if mesh is not None:
+                inside -= where(inside != 0, mesh.tile((y0, y1, x0, x1)), 0)
+        return tile
+
+    def weightfile(self, image):
+        if image not in self.weightfiles:
+            weightimage = image.replace(self.imext, self.weightext)
+            weightfile = join(self.indir, weightimage)
+            if exists(weightfile):
+                self.weightfiles[image] = weightimage
+            else:
+                print(weightfile, 'DOES NOT EXIST')
+                self.weightfiles[image] = None
+        return self.weightfiles[image]
+
+    def weightmask(self, image, limits):
+        """Flag (weight > 0) of each pixel of image within limits as a bool array, or None if unweighted"""
+        ylo, yhi, xlo, xhi = limits
+        packed = self.masks.get((image, limits))
+        if packed is None:
+            weightimage = self.weightfile(image)
+            if weightimage == None:
+                return None
+            weight = self.section(weightimage, limits, grid=image)
+            packed = packbits(greater(weight, 0), axis=-1)  # FLAG IMAGE!!  EITHER 1 or 0
+            self.masks[(image, limits)] = packed
+        return unpackbits(packed, axis=-1, count=xhi-xlo).view(bool)
+
+    def weightvalues(self, image, limits):
+        """Weight of each pixel of image within limits (0 where it is not positive), or None if image has no weight image
+        In this thread's weight buffer, not cached: unlike the masks, the values take as much memory as the images"""
+        ylo, yhi, xlo, xhi = limits
+        weightimage = self.weightfile(image)
+        if weightimage == None:
+            return None
+        weight = getattr(self.buffers, 'weight', None)
+        if (weight is None) or (weight.shape != (yhi - ylo, xhi - xlo)):
+            weight = empty((yhi - ylo, xhi - xlo), self.precision)
+            self.buffers.weight = weight
+        weight[...] = self.section(weightimage, limits, grid=image)
+        weight[~greater(weight, 0)] = 0  # negative and NaN weights too
+        return weight
+
+    def cachebytes(self, nx, ny, nimages):
+        """Memory the weight masks of nimages images take once every stamp of an (ny, nx) image is cached"""
+        if (not self.weighting) or (self.combine == 'weighted'):
+            return 0
+        return nimages * ny * int(ceil(nx / 8.))
+
+    def processedstamp(self, image, limits):
+        """data within limits, shifted by -offset (dx, dy) onto the reference image and/or PSF matched to psftarget
+        Loaded with a margin beyond the kernels' reach (zeros past the image edges), so the stamps agree with processing the whole image"""
+        ylo, yhi, xlo, xhi = limits
+        offset = self.offsets.get(image)
+        filt = self.psffilters.get(image)
+        m = 0
+        if offset is not None:
+            dx, dy = offset
+            m += int(ceil(max([abs(dx), abs(dy)]))) + self.margin
+        if filt is not None:
+            m += psfmatch.margin([filt], self.psftarget, self.pixelscale)
+        padded = array(self.section(image, (ylo - m, yhi + m, xlo - m, xhi + m)), self.precision)
+        padded[isnan(padded)] = 0
+        if offset is not None:
+            padded = registration.shift_stack(padded, (-dy, -dx), 'lanczos')
+        if filt is not None:
+            padded = psfmatch.match_stack(padded[newaxis], [filt], self.psftarget, self.pixelscale)[0]
+        return padded[m:-m,m:-m]
+
+    def stampbuffer(self, shape):
+        """This thread's stamp buffer, reused while the stamp shape stays the same"""
+        stamp = getattr(self.buffers, 'stamp', None)
+        if (stamp is None) or (stamp.shape != shape):
+            stamp = empty(shape, self.precision)
+            self.buffers.stamp = stamp
+        return stamp
+
+    def combinestamps(self, imagesRGB, mode, limits, silent=1, out=None):
+        """Combine the images of each channel in mode within limits (ylo, yhi, xlo, xhi) into a (channels, ny, nx) stamp
+        Images beginning with '-' are subtracted.  out: (channels, ny, nx) array to combine into, e.g. a shared memory block"""
+        ylo, yhi, xlo, xhi = limits
+        ny = yhi - ylo
+        nx = xhi - xlo
+
+        three = len(mode)
+        if out is None:
+            stampRGB = zeros((three, ny, nx), self.precision)
+        else:
+            stampRGB = out
+            stampRGB[...] = 0
+        if self.weighting:
+            weightRGB = zeros((three, ny, nx), self.precision)
+        stamp = self.stampbuffer((ny, nx))
+
+        for ichannel, channel in enumerate(mode):
+            total = stampRGB[ichannel]
+            for image in imagesRGB[channel]:
+                if not silent:
+                    print(channel,)
+                accumulate = add
+                if image[0] == '-':
+                    accumulate = subtract
+                    image = image[1:]
+                self.imagedata(image, silent)
+                if (image in self.offsets) or (image in self.psffilters):
+                    stamp[...] = self.processedstamp(image, limits)
+                else:
+                    stamp[...] = self.section(image, limits)
+                if self.bscale != 1:
+                    multiply(stamp, self.bscale, out=stamp)
+                if self.bzero != 0:
+                    add(stamp, self.bzero, out=stamp)
+
+                if self.weighting:
+                    if self.combine == 'weighted':
+                        weight = self.weightvalues(image, limits)
+                    else:
+                        weight = self.weightmask(image, limits)
+                    if weight is not None:
+                        multiply(stamp, weight, out=stamp)
+                        accumulate(weightRGB[ichannel], weight, out=weightRGB[ichannel])
+
+                accumulate(total, stamp, out=total)
+
+            if self.weighting:
+                weight = weightRGB[ichannel]
+                divide(total, weight, out=total, where=(weight != 0))
+                total[weight == 0] = 0
+            elif self.combine == 'sum':
+                pass
+            elif len(imagesRGB[channel]):
+                total /= len(imagesRGB[channel])
+
+        return stampRGB
+
 class Trilogy:
     def __init__(self, infile=None, images=None, imagesorder='BGR', **inparams):
         self.nx = None  # image size
@@ -827,7 +1137,9 @@ class Trilogy:
         self.imagesRGB = {'R':[], 'G':[], 'B':[], 'L':[]}  # File names
         self.inkeys = []
         self.mode = 'L'  # reset below if color
+        self.imext = None
         self.weightext = None  # No weighting unless weight images are declared
+        self.tilepyramid = None  # pyramid.TilePyramid, if self.pyramid
         # Can use either:
         # weightext drz wht
         # weightext drz -> wht
@@ -916,9 +1228,9 @@ class Trilogy:
             if line[0] == '#':
                 continue
             
-            word = string.strip(line)
+            word = line.strip()
             if len(word):
-                words = string.split(word)
+                words = word.split()
                 if len(words) == 1:  # Channel or image name
                     if (word in 'RGB') and (prevline == ''):
                         channel = word
@@ -934,7 +1246,7 @@ class Trilogy:
                         #    self.images.append(image)
                 else:  # parameter and value(s)
                     key = words[0]
-                    val = str2num(string.join(words[1:]))
+                    val = str2num(' '.join(words[1:]))
                     if key == 'weightimages':
                         print(words)
                         if len(words[1:]) == 2:  # drz wht
@@ -993,6 +1305,7 @@ class Trilogy:
         print("Loading image data.",)
         print("If multiple filters per channel, adding data.")
         filters = {'B':[], 'G':[], 'R':[], 'L':[]}
+        shapes = {}
         fout = open(self.outfilterfile(), 'w')
         #for ichannel, channel in enumerate(self.mode):
         for channel in self.mode[::-1]:
@@ -1023,6 +1336,7 @@ class Trilogy:
                 filters[channel].append(filt)
                 outline += filt
                 ny, nx = data.shape
+                shapes[image] = ny, nx
                 #print(data.shape)
                 if self.ny == None:
                     self.ny = ny
@@ -1031,13 +1345,7 @@ class Trilogy:
                     self.xc = nx / 2
                 else:
                     if (self.ny != ny) or (self.nx != nx):
-                        print("Input FAIL.  Your images are not all the same size as (%d,%d)." % (self.ny, self.nx))
-                        for channel in self.mode[::-1]:  # 'BGR'
-                            for image in self.imagesRGB[channel]:
-                                #data = loadfitsimagedata(image, self.indir, 0, self.bscale, self.bzero)
-                                data = loadfitsimagedata(image, self.indir, silent=0)
-                                #print(image, '(%d,%d)' % data.shape)
-                        raise  # Raise Exception (error) and quit
+                        print("%s is not the same size as (%d,%d): reprojecting the images onto one grid." % (image, self.ny, self.nx))
 
             fout.write(outline+'\n')
             print(outline)
@@ -1046,10 +1354,12 @@ class Trilogy:
         fout.close()
         print()
 
+        reprojections = self.plangrid(shapes)
+
         if 0:
             fout = open(self.outfilterfile(), 'w')
             for channel in 'BGR':
-                filtstr = string.join(filters[channel], ' + ')
+                filtstr = ' + '.join(filters[channel])
                 #print(channel, filtstr)
                 #print('%s = %s\n' % (channel, filtstr))
                 #print('%s' % channel)
@@ -1075,69 +1385,139 @@ class Trilogy:
         elif self.yhi < 0:
             self.yhi = self.ny + self.yhi
 
-
-    def loadstamps(self, limits, silent=1):
-        ylo, yhi, xlo, xhi = limits
-
-        ylo = clip(ylo, 0, self.ny)
-        yhi = clip(yhi, 0, self.ny)
-        xlo = clip(xlo, 0, self.nx)
-        xhi = clip(xhi, 0, self.nx)
-
-        ny = yhi - ylo
-        nx = xhi - xlo
-        
+        self.combiner = channelcombiner(self.indir, self.imext, self.weightext, self.combine, self.precision, self.bscale, self.bzero)
+        self.combiner.reprojections = reprojections
+
+
+    def plangrid(self, shapes):
+        """Choose the output pixel grid: gridref's, else the largest image's if the images differ in size
+        The images on other grids are reprojected (regrid.py) one stamp at a time as they are loaded"""
+        reprojections = {}
+        gridref = self.gridref
+        if gridref == None:
+            if len(set(shapes.values())) == 1:
+                return reprojections
+            gridref = sorted(shapes.keys(), key=lambda image: shapes[image][0] * shapes[image][1])[-1]
+        targetheader = loadfitsimageheader(gridref, self.indir)
+        targetgrid = regrid.grid_key(targetheader)
+        self.ny, self.nx = targetheader['NAXIS2'], targetheader['NAXIS1']
+        self.yc = self.ny / 2
+        self.xc = self.nx / 2
+        print('Output pixel grid: %s (%d,%d)' % (gridref, self.ny, self.nx))
+        for image in shapes.keys():
+            header = loadfitsimageheader(image, self.indir)
+            if regrid.grid_key(header) != targetgrid:
+                reprojections[image] = regrid.Reprojection(header, targetheader, order=self.gridorder)
+                print('  %s (%d,%d) reprojected' % ((image,) + shapes[image]))
+        return reprojections
+
+    def planmemory(self):
+        """Choose stamp shape, number of workers and largest sample from the memory budget"""
+        budget = parsememory(self.memory)
+        itemsize = dtype(self.precision).itemsize
         three = len(self.mode)
-        stampRGB = zeros((three, ny, nx), float)
         weighting = self.weightext != None
-        if weighting:
-            weightstampRGB = zeros((three, ny, nx), float)
-        
-        for ichannel, channel in enumerate(self.mode):
+        budget = budget - self.nx * self.ny * three  # imfull, the 8-bit output, is held in memory
+        nimages = sum([len(self.imagesRGB[channel]) for channel in self.mode])
+        budget = budget - self.combiner.cachebytes(self.xhi - self.xlo, self.yhi - self.ylo, nimages)  # cached weight masks
+        weighted = self.combine == 'weighted'
+        dy, dx, workers = planstamps(self.xhi - self.xlo, self.yhi - self.ylo, three, itemsize, weighting, budget, self.workers, weighted=weighted)
+        if self.maxstampsize == None:
+            # determinescaling also sorts a copy of each channel of the sample
+            bpp = bytesperpixel(three, itemsize, weighting, weighted) + 2 * itemsize
+            self.maxstampsize = int(sqrt(max([budget, 0]) / bpp))
+        if self.stampsize == None:
+            self.stampshape = dy, dx
+        elif self.stampsize == 0:
+            self.stampshape = self.maxstampsize, self.maxstampsize
+        else:
+            self.stampshape = self.stampsize, self.stampsize
+            stampbytes = bytesperpixel(three, itemsize, weighting, weighted) * self.stampsize**2
+            workers = max([1, min([workers, int(budget / stampbytes)])])
+        self.workers = workers
+        print('Memory budget %.2f GB: %dx%d stamps, %d at a time; samples up to %dx%d' % (budget / 1024.**3, self.stampshape[1], self.stampshape[0], self.workers, self.maxstampsize, self.maxstampsize))
+
+    def planbackground(self):
+        """Measure the background of every image on a mesh of (backbox x backbox) boxes (if background),
+        which channelcombiner interpolates and subtracts from each stamp as it is loaded"""
+        if not self.background:
+            return
+        print('Measuring the background of each image in %dx%d boxes...' % (self.backbox, self.backbox))
+        for channel in self.mode:
             for image in self.imagesRGB[channel]:
-                if not silent:
-                    print(channel,)
-                sgn = 1
                 if image[0] == '-':
-                    sgn = -1
                     image = image[1:]
-                #data = loadfitsimagedata(image, self.indir, silent, self.bscale, self.bzero)
-                data = loadfitsimagedata(image, self.indir, silent=silent)
-                stamp = data[ylo:yhi,xlo:xhi]
-                stamp = datascale(stamp, self.bscale, self.bzero)
-                #if (self.bscale != 1) or (self.bzero != 0):
-                #    stamp = self.bscale * stamp + self.bzero
-                #print(limits)
-                #print(stamp.shape)
-                #print(stampRGB.shape)
-
-                # weight image?
-                if weighting:
-                    weightimage = image.replace(self.imext, self.weightext)
-                    weightfile = join(self.indir, weightimage)
-                    if exists(weightfile):
-                        #print('Loading %s...' % weightimage)
-                        #weight = loadfitsimagedata(weightimage, self.indir, silent, self.bscale, self.bzero)
-                        weight = loadfitsimagedata(weightimage, self.indir, silent=silent)
-                        weightstamp = weight[ylo:yhi,xlo:xhi]
-                        #weightstamp = datascale(weightstamp, self.bscale, self.bzero)
-                        weightstamp = greater(weightstamp, 0)  # FLAG IMAGE!!  EITHER 1 or 0
-                        weightstampRGB[ichannel] = weightstampRGB[ichannel] + sgn * weightstamp
-                        stamp = stamp * weightstamp
-                    else:
-                        print(weightfile, 'DOES NOT EXIST')
-
-                stampRGB[ichannel] = stampRGB[ichannel] + sgn * stamp
-
-        if weighting:
-            for ichannel, channel in enumerate(self.mode):
-                stampRGB[ichannel] = where(weightstampRGB[ichannel],
-                                           stampRGB[ichannel] / weightstampRGB[ichannel], 0)
-        elif self.combine == 'average':
-            for ichannel, channel in enumerate(self.mode):
-                stampRGB[ichannel] = stampRGB[ichannel] / len(self.imagesRGB[channel])
+                if image not in self.combiner.backgrounds:
+                    mesh = background.BackgroundMesh(self.combiner.imagedata(image), box=self.backbox, filter_size=self.backfilter, workers=self.workers)
+                    self.combiner.backgrounds[image] = mesh
+                    print('  %s: background from %g to %g' % (image, mesh.sky.min(), mesh.sky.max()))
+
+    def planregistration(self):
+        """Measure the offset of every image from registerref (if register) by phase correlation
+        in the central (registersize x registersize) region, and have channelcombiner shift the images onto it"""
+        offsets = dict(self.offsets)
+        if self.register:
+            images = []
+            for channel in self.mode:
+                for image in self.imagesRGB[channel]:
+                    if image[0] == '-':
+                        image = image[1:]
+                    if image not in images:
+                        images.append(image)
+            reference = self.registerref
+            if reference == None:
+                reference = (self.imagesRGB.get('R') or images)[0]
+            dy = min([self.registersize, self.ny])
+            dx = min([self.registersize, self.nx])
+            ylo = int(self.yc - dy / 2)
+            xlo = int(self.xc - dx / 2)
+            stack = zeros((len(images), dy, dx), self.precision)
+            for i, image in enumerate(images):
+                stack[i] = self.combiner.section(image, (ylo, ylo+dy, xlo, xlo+dx))
+            stack[isnan(stack)] = 0
+            refdata = nan_to_num(asarray(self.combiner.section(reference, (ylo, ylo+dy, xlo, xlo+dx)), self.precision))
+            shifts = registration.Registration(refdata, max_shift=self.maxshift).estimate(stack)
+            print('Registration to %s (%dx%d core):' % (reference, dx, dy))
+            for image, (sy, sx) in zip(images, shifts):
+                if image != reference:
+                    offsets[image] = sx, sy
+                    print('  %s offset by (%.2f,%.2f)' % (image, sx, sy))
+        self.combiner.offsets = offsets
+
+    def planpsfmatch(self):
+        """Find the filter of every image (FITS header, name(filter), or file name) if psfmatch,
+        and have channelcombiner convolve the images to the broadest PSF (or psftarget)"""
+        if not self.psfmatch:
+            return
+        filters = {}
+        for channel in self.mode:
+            for image in self.imagesRGB[channel]:
+                if image[0] == '-':
+                    image = image[1:]
+                filt = imfilts.get(decapfile(image)) or imfilts.get(image) or psfmatch.filter_of(image)
+                if filt and (filt.lower() in psfmatch.psf_fwhm):
+                    filters[image] = filt.lower()
+                else:
+                    print('No PSF known for %s (filter %s): not PSF matched' % (image, filt))
+        if not filters:
+            return
+        target = self.psftarget or psfmatch.broadest(list(filters.values()))
+        target = target.lower()
+        print('PSF matching to %s:' % target)
+        self.combiner.psftarget = target
+        self.combiner.pixelscale = self.pixelscale
+        for image, filt in filters.items():
+            sigma = psfmatch.matching_sigma(filt, target, self.pixelscale)
+            if sigma > 0:
+                self.combiner.psffilters[image] = filt
+                print('  %s (%s) convolved by a Gaussian of sigma %.2f pixels' % (image, filt, sigma))
+
+    def cliplimits(self, limits):
+        ylo, yhi, xlo, xhi = limits
+        return int(clip(ylo, 0, self.ny)), int(clip(yhi, 0, self.ny)), int(clip(xlo, 0, self.nx)), int(clip(xhi, 0, self.nx))
 
-        return stampRGB
+    def loadstamps(self, limits, silent=1, out=None):
+        return self.combiner.combinestamps(self.imagesRGB, self.mode, self.cliplimits(limits), silent, out)
 
     #def determinescalings(self, samplesize, testfirst=1):
     def determinescalings(self):
@@ -1213,41 +1593,41 @@ class Trilogy:
                 print('Otherwise, enter new values:')
 
                 line = '  noise yields brightness: %g? ' % self.noiselum
-                inp = raw_input(line)
-                if string.strip(inp) != '':
+                inp = input(line)
+                if inp.strip() != '':
                     self.noiselum = float(inp)
                     for channel in self.mode:
                         self.noiselums[channel] = self.noiselum
                     redo = True
 
                 line = '  %% of pixels that saturate: %g? ' % self.satpercent
-                inp = raw_input(line)
-                if string.strip(inp) != '':
+                inp = input(line)
+                if inp.strip() != '':
                     self.satpercent = float(inp)
                     redo = True
 
                 if self.mode == 'RGB':
                     line = '  color saturation factor: %g? ' % self.colorsatfac
-                    inp = raw_input(line)
-                    if string.strip(inp) != '':
+                    inp = input(line)
+                    if inp.strip() != '':
                         self.colorsatfac = float(inp)
                         redo = True
 
                 line = '  Sample size: %d? ' % self.samplesize
-                inp = raw_input(line)
-                if string.strip(inp) != '':
+                inp = input(line)
+                if inp.strip() != '':
                     self.samplesize = int(inp)
                     redo = True
 
                 line = '  Sample offset x: %d? ' % self.sampledx
-                inp = raw_input(line)
-                if string.strip(inp) != '':
+                inp = input(line)
+                if inp.strip() != '':
                     self.sampledx = int(inp)
                     redo = True
 
                 line = '  Sample offset y: %d? ' % self.sampledy
-                inp = raw_input(line)
-                if string.strip(inp) != '':
+                inp = input(line)
+                if inp.strip() != '':
                     self.sampledy = int(inp)
                     redo = True
 
@@ -1322,47 +1702,47 @@ class Trilogy:
                 print('Otherwise, enter new values:')
 
                 line = '  noise yields brightness: %g? ' % self.noiselum
-                inp = raw_input(line)
-                if string.strip(inp) != '':
+                inp = input(line)
+                if inp.strip() != '':
                     self.noiselum = float(inp)
                     for channel in self.mode:
                         self.noiselums[channel] = self.noiselum
                     redo = True
 
                 line = '  noise image input data value: %g? ' % self.noise
-                inp = raw_input(line)
-                if string.strip(inp) != '':
+                inp = input(line)
+                if inp.strip() != '':
                     self.noise = float(inp)
                     redo = True
 
                 line = '  saturation level image input data value: %g? ' % self.saturate
-                inp = raw_input(line)
-                if string.strip(inp) != '':
+                inp = input(line)
+                if inp.strip() != '':
                     self.saturate = float(inp)
                     redo = True
 
                 if self.mode == 'RGB':
                     line = '  color saturation factor: %g? ' % self.colorsatfac
-                    inp = raw_input(line)
-                    if string.strip(inp) != '':
+                    inp = input(line)
+                    if inp.strip() != '':
                         self.colorsatfac = float(inp)
                         redo = True
 
                 line = '  Sample size: %d? ' % self.samplesize
-                inp = raw_input(line)
-                if string.strip(inp) != '':
+                inp = input(line)
+                if inp.strip() != '':
                     self.samplesize = int(inp)
                     redo = True
 
                 line = '  Sample offset x: %d? ' % self.sampledx
-                inp = raw_input(line)
-                if string.strip(inp) != '':
+                inp = input(line)
+                if inp.strip() != '':
                     self.sampledx = int(inp)
                     redo = True
 
                 line = '  Sample offset y: %d? ' % self.sampledy
-                inp = raw_input(line)
-                if string.strip(inp) != '':
+                inp = input(line)
+                if inp.strip() != '':
                     self.sampledy = int(inp)
                     redo = True
 
@@ -1381,6 +1761,10 @@ class Trilogy:
                 print('Copying to', outfile)
                 os.copy(imfile, outfile)
             imfull = Image.open(outfile)
+            if self.pyramid:
+                self.tilepyramid = self.maketilepyramid()
+                self.tilepyramid.add(imfull, 0, 0)
+                self.tilepyramid.close()
             return imfull
         
         # Clean up: Delete test images
@@ -1389,9 +1773,7 @@ class Trilogy:
                 if exists(testimage):
                     os.remove(testimage)
 
-        dx = dy = self.stampsize
-        if dx * dy == 0:
-            dx = dy = self.maxstampsize
+        dy, dx = self.stampshape
         
         imfull = Image.new(self.mode, (self.nx, self.ny))
 
@@ -1400,25 +1782,70 @@ class Trilogy:
             print('Making full color image, one stamp (section) at a time...')
         elif self.mode == 'L':
             print('Making full grayscale image, one stamp (section) at a time...')
+        print('%dx%d stamps, %d at a time' % (dx, dy, self.workers))
+        if self.pyramid:
+            # Tiles are written as each band of stamps is finished, so the full image is never reread
+            self.tilepyramid = self.maketilepyramid()
         #for yo in range(0,self.ny,dy):
             #dy1 = min([dy, self.ny-yo])
             #for xo in range(0,self.nx,dx):
                 #dx1 = min([dx, self.nx-xo])
+        stamplist = []
         for yo in range(self.ylo,self.yhi,dy):
             dy1 = min([dy, self.yhi-yo])
             for xo in range(self.xlo,self.xhi,dx):
                 dx1 = min([dx, self.xhi-xo])
-                print('%5d, %5d  /  (%d x %d)' % (xo, yo, self.nx, self.ny))
-                #print(dx, dy, self.nx, self.ny, dx1, dy1)
-                #stamps = self.dataRGB[:,yo:yo+dy,xo:xo+dx]
-                limits = yo, yo+dy, xo, xo+dx
-                stamps = self.loadstamps(limits)
-                im = RGBscale2im(stamps, self.levdict, self.noiselums, self.colorsatfac, self.mode, self.invert)
-                if self.show and self.showstamps:
-                    im.show()
-
-                #print(array(stamps).shape, im.size, xo,self.ny-yo-dy1,xo+dx1,self.ny-yo)
-                imfull.paste(im, (xo,self.ny-yo-dy1,xo+dx1,self.ny-yo))
+                stamplist.append((yo, dy1, xo, dx1))
+
+        def makestamp(yo, xo):
+            #stamps = self.dataRGB[:,yo:yo+dy,xo:xo+dx]
+            limits = yo, yo+dy, xo, xo+dx
+            stamps = self.loadstamps(limits)
+            return RGBscale2im(stamps, self.levdict, self.noiselums, self.colorsatfac, self.mode, self.invert)
+
+        def pastestamp(yo, dy1, xo, dx1, im):
+            print('%5d, %5d  /  (%d x %d)' % (xo, yo, self.nx, self.ny))
+            #print(dx, dy, self.nx, self.ny, dx1, dy1)
+            if self.show and self.showstamps:
+                im.show()
+
+            #print(array(stamps).shape, im.size, xo,self.ny-yo-dy1,xo+dx1,self.ny-yo)
+            imfull.paste(im, (xo,self.ny-yo-dy1,xo+dx1,self.ny-yo))
+            if self.tilepyramid is not None:
+                self.tilepyramid.add(im, xo, self.ny-yo-dy1)
+
+        if self.processes:
+            # The stamps are combined here, straight into shared memory blocks, and scaled by worker processes
+            # which get only the blocks' descriptors; at most self.workers stamps in flight
+            import shared_arena
+            arena = shared_arena.SharedArena()
+            def stamps():
+                for yo, dy1, xo, dx1 in stamplist:
+                    limits = self.cliplimits((yo, yo+dy, xo, xo+dx))
+                    descriptor = arena.allocate((len(self.mode), limits[1] - limits[0], limits[3] - limits[2]), self.precision)
+                    self.loadstamps(limits, out=arena.view(descriptor))
+                    yield descriptor
+            args = (self.levdict, self.noiselums, self.colorsatfac, self.mode, self.invert)
+            images = shared_arena.imap_shared(shared_arena.trilogy_stamp, stamps(), out_spec=shared_arena.trilogy_spec, args=args, processes=self.workers, max_inflight=self.workers, arena=arena)
+            try:
+                for (yo, dy1, xo, dx1), pixels in zip(stamplist, images):
+                    pastestamp(yo, dy1, xo, dx1, Image.fromarray(array(pixels), self.mode))
+            finally:
+                images.close()
+                arena.close()
+        else:
+            # At most self.workers stamps in memory (being made or waiting to be pasted)
+            pool = ThreadPoolExecutor(self.workers)
+            pending = deque()
+            for i, (yo, dy1, xo, dx1) in enumerate(stamplist):
+                pending.append((yo, dy1, xo, dx1, pool.submit(makestamp, yo, xo)))
+                while pending and ((len(pending) >= self.workers) or (i == len(stamplist) - 1)):
+                    yo, dy1, xo, dx1, future = pending.popleft()
+                    pastestamp(yo, dy1, xo, dx1, future.result())
+            pool.shutdown()
+        if self.tilepyramid is not None:
+            print('Writing tile pyramid', self.tilepyramid.outroot, '...')
+            print('%d tiles' % self.tilepyramid.close())
 
         #outfile = outname+'.png'
         outfile = join(self.outdir, self.outfile)
@@ -1435,20 +1862,29 @@ class Trilogy:
         
         return imfull
 
+    def maketilepyramid(self):
+        outroot = join(self.outdir, self.outname)
+        return pyramid.TilePyramid(outroot, self.nx, self.ny, self.mode, self.pyramid, self.tilesize, self.tileformat, self.workers)
+
     def makethumbnail1(self, outroot, width, fmt='jpg'):
-        nx = width
-        ny = 1000 * (ny / float(nx))
-        im = open(outroot+'.png')
-        im2 = im.resize((nx,ny))
-        im2.save(self.outname+'_%d.%s' % (width, fmt))
+        if self.tilepyramid is not None:
+            # From the smallest pyramid level at least this wide
+            im2 = self.tilepyramid.thumbnail(width)
+        else:
+            im = Image.open(join(self.outdir, self.outfile))
+            nx, ny = im.size
+            im2 = im.resize((width, max([int(round(width * ny / float(nx))), 1])), Image.LANCZOS)
+        outfile = join(self.outdir, outroot+'_%d.%s' % (width, fmt))
+        print('Saving', outfile, '...')
+        im2.save(outfile)
         return im2
 
     def makethumbnail(self):
         if self.thumbnail not in [None, 'None']:
-            outname = self.thumbnail
-            if outname[-4] == '.':
-                outname = outname[:-4]
-                fmt = outname[-3:]
+            outname = str(self.thumbnail)
+            fmt = 'jpg'
+            if '.' in outname:
+                outname, fmt = outname.split('.', 1)
             width = int(outname)
             self.makethumbnail1(self.outname, width, fmt)
 
@@ -1490,7 +1926,7 @@ class Trilogy:
             self.showimage(outfile, Image)
 
         print('Like what you see?')
-        inp = raw_input()
+        inp = input()
         #pause()
 
 
@@ -1571,6 +2007,10 @@ class Trilogy:
         self.setimages()  # not needed from command line
         self.setoutfile()  # adds .png if necessary to outname
         self.loadimagesize()
+        self.planmemory()
+        self.planbackground()
+        self.planregistration()
+        self.planpsfmatch()
         self.addtofilterlog()
         if 'justaddlegend' in self.inkeys:
             self.addlegend()
@@ -1606,21 +2046,25 @@ class Trilogy:
         self.makethumbnail()
 
 def pause(text=''):
-    inp = raw_input(text)
-
-if __name__ == '__main__':    
-    if len(sys.argv) == 1:
+    inp = input(text)
+
+def main(argv=None):
+    """Run Trilogy from command line arguments:
+    python Trilogy_rgb.py [trilogy.in | image.fits | 'images*.fits'] [-option value ...]"""
+    if argv is None:
+        argv = sys.argv
+    if len(argv) == 1:
         infile = 'trilogy.in'
         images = None
-        Trilogy(infile, images=images, **params_cl()).run()
+        Trilogy(infile, images=images, **params_cl(argv=argv)).run()
     else: # > 1
-        input1 = sys.argv[1]
+        input1 = argv[1]
         if ('*' in input1) or ('?' in input1):
-            indir = params_cl().get('indir', '')
+            indir = params_cl(argv=argv).get('indir', '')
             input1 = join(indir, input1)
             images = glob(input1)
             for image in images:
-                Trilogy(images=image, **params_cl()).run()
+                Trilogy(images=image, **params_cl(argv=argv)).run()
         else:
             images = None
             #print(input1[-5:])
@@ -1631,8 +2075,11 @@ if __name__ == '__main__':
             else:
                 infile = input1
             
-            Trilogy(infile, images=images, **params_cl()).run()
+            Trilogy(infile, images=images, **params_cl(argv=argv)).run()
 
     #print('infile', infile)
     #print('images', images)
     #pause()
+
+if __name__ == '__main__':
+    main()
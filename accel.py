@@ -0,0 +1,166 @@
+#
+# Optional compiled kernels for img_scale.py and Trilogy_rgb.py, used when numba is installed
+# Each kernel makes one pass over the pixels (split over the cores) where the numpy code makes several, with temporaries.
+# The numpy code stays the reference and the fallback: set IMG_SCALE_ACCEL=0, or call use(False), to run it instead.
+#
+# You can freely use the code
+#
+
+import os
+import math
+import importlib.util
+import numpy
+from concurrent.futures import ThreadPoolExecutor
+
+# numba is only imported when a kernel first runs: checking that it is installed is much faster than importing it
+available = importlib.util.find_spec('numba') is not None
+enabled = available and os.environ.get('IMG_SCALE_ACCEL', '1') != '0'
+
+# img_scale.py modes handled by stretch()
+modes = {'linear': 0, 'sqrt': 1, 'log': 2, 'power': 3, 'asinh': 4, 'logistic': 5}
+
+# Images with more pixels than this are split into chunks of this many pixels, run in parallel by `workers` threads
+chunk = 1 << 20
+workers = os.cpu_count() or 1
+
+def use(flag=True):
+	"""Turn the compiled kernels on or off at runtime.
+
+	@type flag: boolean
+	@param flag: True to use them (if numba is available), False for the numpy code
+	@rtype: boolean
+	@return: whether the compiled kernels are now used
+
+	"""
+	global enabled
+	enabled = bool(flag) and available
+	return enabled
+
+def eligible(data, *values):
+	"""Whether a compiled kernel can stand in for the numpy code: float pixels and scalar parameters.
+
+	@type data: numpy array
+	@param data: image data array
+	@type values: float
+	@param values: parameters of the scaling, which must be scalars (stretch_batch() broadcasts arrays of them itself)
+	@rtype: boolean
+	@return: True if enabled and eligible
+
+	"""
+	return enabled and (data.dtype.kind == 'f') and all([numpy.ndim(value) == 0 for value in values])
+
+def kernels():
+	"""The compiled kernels, importing numba (and loading or compiling the kernels) on first use.
+
+	@rtype: module
+	@return: accel_kernels
+
+	"""
+	import accel_kernels
+	return accel_kernels
+
+def _chunked(kernel, flat, out, *args):
+	"""Run an elementwise kernel over flat, in parallel chunks if it is large (the kernels release the GIL).
+
+	@type kernel: function
+	@param kernel: compiled kernel(flat, out, *args)
+	@type flat: numpy array
+	@param flat: 1D input
+	@type out: numpy array
+	@param out: 1D output, the size of flat
+	@type args: tuple
+	@param args: the other arguments of the kernel
+	@rtype: None
+
+	"""
+	if (flat.size <= chunk) or (workers == 1):
+		kernel(flat, out, *args)
+		return
+	with ThreadPoolExecutor(workers) as pool:
+		list(pool.map(lambda lo: kernel(flat[lo:lo + chunk], out[lo:lo + chunk], *args), range(0, flat.size, chunk)))
+
+def stretch(imageData, mode, scale_min, scale_max, **params):
+	"""One pass version of the img_scale.py scaling of the same name, with the same quirks.
+
+	@type imageData: numpy array
+	@param imageData: image data array (float)
+	@type mode: string
+	@param mode: 'linear', 'sqrt', 'log', 'power', 'asinh' or 'logistic'
+	@type scale_min: float
+	@param scale_min: minimum data value
+	@type scale_max: float
+	@param scale_max: maximum data value
+	@type params: float
+	@param params: exponent, power_index, non_linear, or center and slope, with the img_scale.py defaults
+	@rtype: numpy array
+	@return: scaled image data array, the dtype the numpy code returns
+
+	"""
+	lo = float(scale_min)
+	hi = float(scale_max)
+	p1 = p2 = p3 = p4 = 0.0
+	if mode == 'linear':
+		p1 = 1.0 / (hi - lo)
+	elif mode == 'sqrt':
+		p1 = 1.0 / math.sqrt(hi - lo)
+	elif mode == 'log':
+		p1 = float(params.get('exponent', 1000))
+		p2 = 1.0 / math.log10(p1)
+	elif mode == 'power':
+		p1 = float(params.get('power_index', 3.0))
+		p2 = 1.0 / math.pow((hi - lo), p1)
+	elif mode == 'asinh':
+		p1 = float(params.get('non_linear', 2.0))
+		p2 = 1.0 / math.asinh((hi - lo) / p1)
+	elif mode == 'logistic':
+		p3 = float(params.get('center', 0.5))
+		p4 = float(params.get('slope', 1.0))
+		p2 = 1.0 / (1.0 / (1.0 + 1.0 / math.exp((hi - p3) / p4)) + 1.0 / (1.0 + 1.0 / math.exp((lo - p3) / p4)))
+		p1 = -1.0 * p2 / (1.0 + 1.0 / math.exp((lo - p3) / p4))
+	# linear and sqrt compute a new array, which numpy.float64 limits make float64; the others scale in place
+	dtype = numpy.result_type(imageData, scale_min, scale_max) if mode in ('linear', 'sqrt') else imageData.dtype
+	flat = numpy.ascontiguousarray(imageData, dtype=dtype).ravel()
+	out = numpy.empty_like(flat)
+	_chunked(kernels().stretch, flat, out, modes[mode], lo, hi, p1, p2, p3, p4)
+	return out.reshape(numpy.shape(imageData))
+
+def sky_mean_sig_clip(input_arr, sig_fract, percent_fract, max_iter=100, low_cut=True, high_cut=True):
+	"""img_scale.sky_mean_sig_clip() without copying the clipped pixels: a mask is updated in place instead.
+
+	@rtype: tuple
+	@return: (sky value, number of iterations)
+
+	"""
+	flat = numpy.ascontiguousarray(input_arr, dtype=float).ravel()
+	return kernels().mean_sig_clip(flat, float(sig_fract), float(percent_fract), int(max_iter), bool(low_cut), bool(high_cut))
+
+def sky_median_sig_clip(input_arr, sig_fract, percent_fract, max_iter=100, low_cut=True, high_cut=True):
+	"""img_scale.sky_median_sig_clip() with each clipping pass fused into one compiled loop.
+
+	@rtype: tuple
+	@return: (sky value, number of iterations)
+
+	"""
+	flat = numpy.ascontiguousarray(input_arr, dtype=float).ravel()
+	return kernels().median_sig_clip(flat, float(sig_fract), float(percent_fract), int(max_iter), bool(low_cut), bool(high_cut))
+
+def logscale_uint8(data, k, lo, r1):
+	"""Trilogy_rgb.imscale2() after its levels are fitted: clip, log scale and quantize to 0 - 255 in one pass.
+
+	@type data: numpy array
+	@param data: image data array (float)
+	@type k: float
+	@param k: log scaling factor
+	@type lo: float
+	@param lo: data value which maps to 0 (x0)
+	@type r1: float
+	@param r1: log1p(k * (x2 - x0)), the value which maps to 1
+	@rtype: numpy array
+	@return: uint8 array, the shape of data
+
+	"""
+	flat = numpy.ascontiguousarray(data).ravel()
+	out = numpy.empty(flat.size, numpy.uint8)
+	dtype = flat.dtype.type
+	_chunked(kernels().logscale_uint8, flat, out, dtype(k), dtype(lo), dtype(r1))
+	return out.reshape(data.shape)
@@ -0,0 +1,124 @@
+#
+# The numba kernels of accel.py, in their own module so importing accel.py (and img_scale.py) doesn't import numba
+# accel.py imports this module the first time a kernel runs.  The kernels are serial and release the GIL; accel.py splits
+# large images over threads itself.  (numba's parallel=True kernels hang the interpreter at exit once they have run in a
+# thread other than the main one, which is how Trilogy_rgb.py scales its stamps.)
+#
+# You can freely use the code
+#
+
+import math
+import numpy
+import numba
+
+@numba.njit(nogil=True, cache=True, error_model='numpy')
+def stretch(flat, out, mode, lo, hi, p1, p2, p3, p4):
+	for i in range(flat.size):
+		x = flat[i]
+		if mode == 0:  # linear
+			y = (x - lo) * p1
+			if y < 0:
+				y = 0.0
+		elif mode == 1:  # sqrt
+			y = x - lo
+			if y < 0:
+				y = 0.0
+			y = math.sqrt(y) * p1
+		elif x < lo:
+			y = 0.0
+		elif x > hi:
+			y = 1.0
+		elif x != x:  # NaN stays NaN
+			y = x
+		elif mode == 2:  # log (of x, not x - scale_min, like img_scale.log)
+			y = math.log10(x * p1 + 1) * p2
+		elif mode == 3:  # power
+			y = math.pow(x - lo, p1) * p2
+		elif mode == 4:  # asinh
+			y = math.asinh((x - lo) / p1) * p2
+		else:  # logistic
+			y = p1 + p2 / (1.0 + 1.0 / math.exp((x - p3) / p4))
+		out[i] = y
+
+@numba.njit(nogil=True, cache=True, error_model='numpy')
+def _clip_pass(flat, keep, center, lower, upper, low_cut, high_cut):
+	# drop the kept pixels outside the limits; sum (relative to center) and count those left
+	total = 0.0
+	count = 0
+	for i in range(flat.size):
+		if keep[i]:
+			x = flat[i]
+			if (low_cut and not (x > lower)) or (high_cut and not (x < upper)):
+				keep[i] = False
+			else:
+				total += x - center
+				count += 1
+	return total, count
+
+@numba.njit(nogil=True, cache=True, error_model='numpy')
+def _kept_sum_sq(flat, keep, mean):
+	total = 0.0
+	for i in range(flat.size):
+		if keep[i]:
+			total += (flat[i] - mean) ** 2
+	return total
+
+@numba.njit(nogil=True, cache=True, error_model='numpy')
+def mean_sig_clip(flat, sig_fract, percent_fract, max_iter, low_cut, high_cut):
+	keep = numpy.ones(flat.size, dtype=numpy.bool_)
+	n = flat.size
+	old_sky = flat.mean()
+	mean = old_sky
+	iteration = -1
+	while True:
+		sig = math.sqrt(_kept_sum_sq(flat, keep, mean) / n) if n else numpy.nan
+		total, n = _clip_pass(flat, keep, old_sky, old_sky - sig_fract * sig, old_sky + sig_fract * sig, low_cut, high_cut)
+		new_sky = old_sky + total / n if n else numpy.nan
+		mean = new_sky
+		iteration += 1
+		if not ((math.fabs(old_sky - new_sky) / new_sky > percent_fract) and (iteration < max_iter)):
+			break
+		old_sky = new_sky
+	return new_sky, iteration
+
+@numba.njit(nogil=True, cache=True, error_model='numpy')
+def _clipped(work, lower, upper, low_cut, high_cut):
+	kept = numpy.empty_like(work)
+	n = 0
+	for x in work:
+		if (low_cut and not (x > lower)) or (high_cut and not (x < upper)):
+			continue
+		kept[n] = x
+		n += 1
+	return kept[:n]
+
+@numba.njit(nogil=True, cache=True, error_model='numpy')
+def median_sig_clip(flat, sig_fract, percent_fract, max_iter, low_cut, high_cut):
+	work = flat
+	old_sky = numpy.median(work)
+	iteration = -1
+	while True:
+		sig = work.std() if work.size else numpy.nan
+		work = _clipped(work, old_sky - sig_fract * sig, old_sky + sig_fract * sig, low_cut, high_cut)
+		new_sky = numpy.median(work) if work.size else numpy.nan
+		iteration += 1
+		if not ((math.fabs(old_sky - new_sky) / new_sky > percent_fract) and (iteration < max_iter)):
+			break
+		old_sky = new_sky
+	return new_sky, iteration
+
+@numba.njit(nogil=True, cache=True, error_model='numpy')
+def logscale_uint8(flat, out, k, lo, r1):
+	for i in range(flat.size):
+		v = flat[i]
+		if v < 0:
+			v = 0.0
+		d = k * (v - lo)
+		if d < -0.5:
+			d = -0.5
+		z = math.log1p(d) / r1
+		if not (z > 0):  # and NaN
+			z = 0.0
+		elif z > 1:
+			z = 1.0
+		out[i] = numpy.uint8(z * 255)
@@ -0,0 +1,278 @@
+#
+# Atlas output: many galaxy panels packed into large PNG sheets, with an index of where each panel is,
+# instead of one small file per galaxy, mode and filter.
+# The sheets are written band by band (one row of panels) as the panels are made. Each band is its own IDAT chunk,
+# ending in a zlib full flush, and the index keeps the byte offset of each band, so read_panel() inflates only the
+# band a panel is in rather than decoding the whole sheet.
+#
+# You can freely use the code
+#
+
+import numpy
+import csv
+import json
+import os
+import struct
+import zlib
+
+signature = b'\x89PNG\r\n\x1a\n'
+columns = ['id', 'mode', 'filter', 'sheet', 'x', 'y', 'w', 'h']
+
+def to_pixels(img, cmap=None):
+	"""Turn scaled data into 8-bit pixels, the same way up as imshow(..., origin='lower') shows it.
+
+	@type img: numpy array
+	@param img: (width, height) scaled data in [0, 1], or (width, height, 3) RGB data
+	@type cmap: string
+	@param cmap: name of the matplotlib colormap for single channel data
+	@rtype: numpy array
+	@return: (height, width, 3) uint8 pixels
+
+	"""
+	img = numpy.nan_to_num(numpy.asarray(img, dtype=float), nan=0.0)
+	if img.ndim == 2:
+		import matplotlib
+		pixels = matplotlib.colormaps[cmap](numpy.clip(img, 0, 1), bytes=True)[:, :, :3]
+	else:
+		pixels = (numpy.clip(img, 0, 1) * 255).astype(numpy.uint8)
+	return numpy.ascontiguousarray(pixels[::-1])
+
+def chunk(kind, data):
+	"""One PNG chunk: length, type, data and CRC."""
+	return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+def sub_filter(pixels):
+	"""PNG scanlines with the Sub filter, which (unlike Up or Paeth) needs no other row to undo.
+
+	@type pixels: numpy array
+	@param pixels: (rows, width, channels) uint8 pixels
+	@rtype: bytes
+	@return: filter type byte and filtered bytes of each row
+
+	"""
+	rows, width, channels = pixels.shape
+	flat = pixels.reshape(rows, width * channels)
+	lines = numpy.empty((rows, 1 + width * channels), numpy.uint8)
+	lines[:, 0] = 1
+	lines[:, 1:1 + channels] = flat[:, :channels]
+	lines[:, 1 + channels:] = flat[:, channels:] - flat[:, :-channels]
+	return lines.tobytes()
+
+def sub_unfilter(lines, width, channels):
+	"""Undo sub_filter().
+
+	@rtype: numpy array
+	@return: (rows, width, channels) uint8 pixels
+	"""
+	lines = numpy.frombuffer(lines, numpy.uint8).reshape(-1, 1 + width * channels)
+	if (lines[:, 0] != 1).any():
+		raise ValueError('Not an atlas sheet: scanlines without the Sub filter')
+	return numpy.cumsum(lines[:, 1:].reshape(-1, width, channels), axis=1, dtype=numpy.uint8)
+
+class SheetWriter:
+	"""One PNG sheet, written a band of rows at a time."""
+
+	def __init__(self, filename, width, height, channels=3, level=6):
+		"""
+		@type filename: string
+		@param filename: output file name
+		@type width: integer
+		@param width: width of the sheet, in pixels
+		@type height: integer
+		@param height: planned height of the sheet; close() corrects it if fewer rows are written
+		@type channels: integer
+		@param channels: 1 (gray) or 3 (RGB)
+		@type level: integer
+		@param level: zlib compression level
+
+		"""
+		self.filename = filename
+		self.width = width
+		self.channels = channels
+		self.rows = 0
+		self.bands = []  # [file offset of the IDAT data, length, first row, rows]
+		self.compressor = zlib.compressobj(level)
+		self.out = open(filename, 'wb')
+		self.out.write(signature)
+		self.out.write(chunk(b'IHDR', self.header(height)))
+
+	def header(self, height):
+		return struct.pack('>IIBBBBB', self.width, height, 8, 2 if self.channels == 3 else 0, 0, 0, 0)
+
+	def write_band(self, pixels):
+		"""Compress a band of rows into its own IDAT chunk, ending in a full flush.
+
+		@type pixels: numpy array
+		@param pixels: (rows, width, channels) uint8 pixels
+		@rtype: None
+
+		"""
+		data = self.compressor.compress(sub_filter(pixels)) + self.compressor.flush(zlib.Z_FULL_FLUSH)
+		self.bands.append([self.out.tell() + 8, len(data), self.rows, pixels.shape[0]])
+		self.out.write(chunk(b'IDAT', data))
+		self.rows += pixels.shape[0]
+
+	def close(self):
+		"""End the zlib stream and the file, and set the height to the rows written."""
+		self.out.write(chunk(b'IDAT', self.compressor.flush(zlib.Z_FINISH)))
+		self.out.write(chunk(b'IEND', b''))
+		self.out.seek(len(signature))
+		self.out.write(chunk(b'IHDR', self.header(self.rows)))
+		self.out.close()
+
+class AtlasWriter:
+	"""Packs panels into sheets of cols x rows cells as they are added, one set of sheets per group (e.g. per mode)."""
+
+	def __init__(self, outroot, cols=32, rows=32, cell=None, channels=3, level=6):
+		"""
+		@type outroot: string
+		@param outroot: output name without extension: outroot_<group>_000.png ..., outroot.json and outroot.csv
+		@type cols: integer
+		@param cols: panels per band
+		@type rows: integer
+		@param rows: bands per sheet
+		@type cell: tuple
+		@param cell: (width, height) of the cells; the size of the first panel if None
+		@type channels: integer
+		@param channels: 1 (gray) or 3 (RGB)
+		@type level: integer
+		@param level: zlib compression level
+
+		"""
+		self.outroot = outroot
+		self.cols = cols
+		self.rows = rows
+		self.cell = cell
+		self.channels = channels
+		self.level = level
+		self.groups = {}  # group: [open SheetWriter, its sheet number, band pixels, panels in the band]
+		self.sheets = []  # index entries of the sheets
+		self.panels = []
+		dirname = os.path.dirname(outroot)
+		if dirname:
+			os.makedirs(dirname, exist_ok=True)
+
+	def add(self, key, pixels, group=''):
+		"""Add a panel.
+
+		@type key: tuple
+		@param key: (id, mode, filter) of the panel
+		@type pixels: numpy array
+		@param pixels: (height, width, channels) uint8 pixels, e.g. from to_pixels(), no larger than the cells
+		@type group: string
+		@param group: sheets the panel goes in
+		@rtype: None
+
+		"""
+		pixels = numpy.asarray(pixels, numpy.uint8)
+		if pixels.ndim == 2:
+			pixels = pixels[:, :, numpy.newaxis]
+		if self.cell is None:
+			self.cell = (pixels.shape[1], pixels.shape[0])
+		cw, ch = self.cell
+		h, w = pixels.shape[:2]
+		if (w > cw) or (h > ch) or (pixels.shape[2] != self.channels):
+			raise ValueError('Panel %s is %dx%dx%d, the atlas cells are %dx%dx%d' % (key, w, h, pixels.shape[2], cw, ch, self.channels))
+		if group not in self.groups:
+			self.groups[group] = [None, None, None, 0]
+		state = self.groups[group]
+		if state[0] is None:
+			# Sheets are numbered in the order they are started
+			state[1] = len(self.sheets)
+			name = self.outroot + ('_' + group if group else '') + '_%03d.png' % len([g for g in self.sheets if g['group'] == group])
+			self.sheets.append({'file': os.path.basename(name), 'group': group})
+			state[0] = SheetWriter(name, cw * self.cols, ch * self.rows, self.channels, self.level)
+		if state[2] is None:
+			state[2] = numpy.zeros((ch, cw * self.cols, self.channels), numpy.uint8)
+			state[3] = 0
+		x = state[3] * cw
+		state[2][:h, x:x + w] = pixels
+		self.panels.append(list(key) + [state[1], x, state[0].rows, w, h])
+		state[3] += 1
+		if state[3] == self.cols:
+			self.end_band(state)
+
+	def end_band(self, state):
+		state[0].write_band(state[2])
+		state[2] = None
+		if state[0].rows >= self.cell[1] * self.rows:
+			self.end_sheet(state)
+
+	def end_sheet(self, state):
+		sheet = state[0]
+		sheet.close()
+		self.sheets[state[1]].update({'width': sheet.width, 'height': sheet.rows, 'channels': sheet.channels, 'bands': sheet.bands})
+		state[0] = None
+
+	def close(self):
+		"""Write the bands and sheets which aren't full, then the index.
+
+		@rtype: integer
+		@return: number of sheets written
+
+		"""
+		for state in self.groups.values():
+			if state[2] is not None:
+				self.end_band(state)
+			if state[0] is not None:
+				self.end_sheet(state)
+		index = {'cell': list(self.cell or (0, 0)), 'cols': self.cols, 'rows': self.rows, 'sheets': self.sheets, 'columns': columns, 'panels': self.panels}
+		with open(self.outroot + '.json', 'w') as fout:
+			json.dump(index, fout)
+		with open(self.outroot + '.csv', 'w', newline='') as fout:
+			writer = csv.writer(fout)
+			writer.writerow(columns)
+			for panel in self.panels:
+				writer.writerow(panel[:3] + [self.sheets[panel[3]]['file']] + panel[4:])
+		return len(self.sheets)
+
+class AtlasReader:
+	"""Crops single panels out of an atlas."""
+
+	def __init__(self, index_file):
+		"""
+		@type index_file: string
+		@param index_file: outroot.json written by AtlasWriter
+		"""
+		with open(index_file) as fin:
+			self.index = json.load(fin)
+		self.folder = os.path.dirname(index_file)
+		self.panels = dict([(tuple(panel[:3]), panel[3:]) for panel in self.index['panels']])
+
+	def keys(self):
+		"""(id, mode, filter) of every panel."""
+		return list(self.panels)
+
+	def panel(self, f_id, mode, filt):
+		"""One panel, inflating only the band of the sheet it is in.
+
+		@type f_id: string
+		@param f_id: ID of the sample
+		@type mode: string
+		@param mode: scaling mode
+		@type filt: string
+		@param filt: filter name
+		@rtype: numpy array
+		@return: (height, width, channels) uint8 pixels
+
+		"""
+		sheet_number, x, y, w, h = self.panels[(f_id, mode, filt)]
+		sheet = self.index['sheets'][sheet_number]
+		for number, (offset, length, first, rows) in enumerate(sheet['bands']):
+			if first <= y < first + rows:
+				break
+		with open(os.path.join(self.folder, sheet['file']), 'rb') as fin:
+			fin.seek(offset)
+			data = fin.read(length)
+		# The first band starts with the zlib header; the others start at a full flush, as raw deflate
+		lines = zlib.decompressobj(zlib.MAX_WBITS if number == 0 else -zlib.MAX_WBITS).decompress(data)
+		band = sub_unfilter(lines, sheet['width'], sheet['channels'])
+		return band[y - first:y - first + h, x:x + w]
+
+def read_panel(index_file, f_id, mode, filt):
+	"""One panel of an atlas; see AtlasReader to read several.
+
+	@rtype: numpy array
+	@return: (height, width, channels) uint8 pixels
+	"""
+	return AtlasReader(index_file).panel(f_id, mode, filt)
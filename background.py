@@ -0,0 +1,154 @@
+#
+# Spatially varying sky background: sigma clipped statistics on a mesh of boxes, median filtered and interpolated
+# This replaces the single sky value of img_scale.sky_mean_sig_clip() for mosaics whose background varies
+#
+# You can freely use the code
+#
+
+import numpy
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import median_filter, map_coordinates
+
+def clipped_stats(boxes, sig_fract, percent_fract, max_iter=10):
+	"""Sigma clipped mean and standard deviation of many boxes at once, clipped like img_scale.sky_mean_sig_clip().
+
+	@type boxes: numpy array
+	@param boxes: (..., pixels) array, NaN for pixels to ignore
+	@type sig_fract: float
+	@param sig_fract: fraction of sigma clipping
+	@type percent_fract: float
+	@param percent_fract: convergence fraction
+	@type max_iter: integer
+	@param max_iter: max. of iterations
+	@rtype: tuple
+	@return: (mean, standard deviation, number of pixels left), each of shape boxes.shape[:-1]
+
+	"""
+	work = numpy.array(boxes, dtype=float)
+	with numpy.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)  # boxes with no valid pixels
+		old_sky = numpy.nanmean(work, axis=-1)
+		for iteration in range(max_iter + 1):
+			sig = numpy.nanstd(work, axis=-1)
+			outside = numpy.abs(work - old_sky[..., None]) >= sig_fract * sig[..., None]
+			work[outside] = numpy.nan
+			new_sky = numpy.nanmean(work, axis=-1)
+			converged = ~(numpy.abs(old_sky - new_sky) / numpy.abs(new_sky) > percent_fract)
+			old_sky = new_sky
+			if numpy.all(converged):
+				break
+		return (new_sky, numpy.nanstd(work, axis=-1), numpy.sum(~numpy.isnan(work), axis=-1))
+
+class BackgroundMesh:
+	"""Background (and noise) of an image on a coarse mesh of boxes, evaluated on any part of the image on demand."""
+
+	def __init__(self, data, box=64, filter_size=3, sig_fract=3.0, percent_fract=0.01, max_iter=10, min_fraction=0.5, order=3, workers=None):
+		"""Measure the mesh.  data is read one row of boxes at a time, so it can be a memory map of a whole mosaic.
+
+		@type data: numpy array
+		@param data: (ny, nx) image; NaN and exactly 0 pixels (outside the survey) are ignored
+		@type box: integer
+		@param box: side of the boxes, in pixels; several times the size of the galaxies, so they don't raise the background
+		@type filter_size: integer
+		@param filter_size: side of the median filter applied to the mesh, in boxes, so single boxes dominated by a bright source don't stand out
+		@type sig_fract: float
+		@param sig_fract: fraction of sigma clipping
+		@type percent_fract: float
+		@param percent_fract: convergence fraction
+		@type max_iter: integer
+		@param max_iter: max. of iterations
+		@type min_fraction: float
+		@param min_fraction: boxes with fewer valid pixels than this fraction take their background from their neighbours
+		@type order: integer
+		@param order: spline order of the interpolation between the box centers
+		@type workers: integer
+		@param workers: threads measuring rows of boxes, all cores if None
+
+		"""
+		self.shape = data.shape
+		self.box = box
+		self.order = order
+		ny, nx = self.shape
+		my = int(numpy.ceil(ny / float(box)))
+		mx = int(numpy.ceil(nx / float(box)))
+
+		def measure_row(j):
+			strip = numpy.full((box, mx * box), numpy.nan)
+			rows = numpy.array(data[j * box:(j + 1) * box], dtype=float)
+			rows[rows == 0] = numpy.nan
+			strip[:rows.shape[0], :nx] = rows
+			boxes = strip.reshape(box, mx, box).transpose(1, 0, 2).reshape(mx, box * box)
+			return clipped_stats(boxes, sig_fract, percent_fract, max_iter)
+
+		with ThreadPoolExecutor(workers or os.cpu_count() or 1) as pool:
+			rows = list(pool.map(measure_row, range(my)))
+
+		sky = numpy.array([row[0] for row in rows])
+		rms = numpy.array([row[1] for row in rows])
+		count = numpy.array([row[2] for row in rows])
+		bad = (count < min_fraction * box * box) | numpy.isnan(sky)
+		self.sky = self.fill(sky, bad)
+		self.rms = self.fill(rms, bad)
+		if filter_size > 1:
+			self.sky = median_filter(self.sky, size=filter_size, mode='nearest')
+			self.rms = median_filter(self.rms, size=filter_size, mode='nearest')
+
+	def fill(self, mesh, bad):
+		"""Replace the bad boxes of a mesh by the median of their good neighbours, growing inwards until none are left.
+
+		@type mesh: numpy array
+		@param mesh: (my, mx) mesh
+		@type bad: numpy array
+		@param bad: (my, mx) boolean array of the boxes to replace
+		@rtype: numpy array
+		@return: filled copy of mesh
+
+		"""
+		mesh = numpy.where(bad, numpy.nan, mesh)
+		if numpy.all(bad):
+			return numpy.zeros(mesh.shape)
+		while numpy.isnan(mesh).any():
+			padded = numpy.pad(mesh, 1, mode='constant', constant_values=numpy.nan)
+			neighbours = numpy.stack([padded[1 + dy:1 + dy + mesh.shape[0], 1 + dx:1 + dx + mesh.shape[1]] for dy in (-1, 0, 1) for dx in (-1, 0, 1)])
+			with warnings.catch_warnings():
+				warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN neighbourhoods
+				grown = numpy.nanmedian(neighbours, axis=0)
+			mesh = numpy.where(numpy.isnan(mesh), grown, mesh)
+		return mesh
+
+	def at(self, y, x, mesh=None):
+		"""Smooth background at (fractional) pixel positions of the image.
+
+		@type y: numpy array
+		@param y: y pixel positions
+		@type x: numpy array
+		@param x: x pixel positions, the same shape as y
+		@type mesh: numpy array
+		@param mesh: mesh to interpolate, the background if None (or self.rms for the noise)
+		@rtype: numpy array
+		@return: interpolated values, the shape of y
+
+		"""
+		if mesh is None:
+			mesh = self.sky
+		# box j is centered on pixel (j + 0.5) * box - 0.5
+		fy = (numpy.asarray(y, dtype=float) + 0.5) / self.box - 0.5
+		fx = (numpy.asarray(x, dtype=float) + 0.5) / self.box - 0.5
+		return map_coordinates(mesh, [fy, fx], order=self.order, mode='nearest')
+
+	def tile(self, limits, mesh=None):
+		"""Smooth background of one tile of the image.
+
+		@type limits: tuple
+		@param limits: (ylo, yhi, xlo, xhi) of the tile
+		@type mesh: numpy array
+		@param mesh: mesh to interpolate, the background if None (or self.rms for the noise)
+		@rtype: numpy array
+		@return: (yhi - ylo, xhi - xlo) background
+
+		"""
+		ylo, yhi, xlo, xhi = limits
+		y, x = numpy.meshgrid(numpy.arange(ylo, yhi), numpy.arange(xlo, xhi), indexing='ij')
+		return self.at(y, x, mesh)
@@ -0,0 +1,227 @@
+#
+# Galaxy catalog: one row per galaxy of a sample in a structured numpy array, instead of path tuples, ID lists and dicts
+# Each row holds the ID (as a number, and as the text of the file names, zero padding and all), the redshift, the rest
+# frame filter and which filters have a file.  The id_list.csv is parsed by numpy.loadtxt and the filter folders are
+# matched to it with searchsorted, so a million galaxy sample loads in seconds; IDs are looked up through a dictionary,
+# and select() and sort() return new catalogs without copying the file names.
+#
+# You can freely use the code
+#
+
+import numpy
+import os
+
+def catalog_dtype(nfilters, id_chars=16):
+	"""
+	@type nfilters: integer
+	@param nfilters: number of filters
+	@type id_chars: integer
+	@param id_chars: longest ID text
+	@rtype: numpy dtype
+	@return: dtype of the catalog rows
+	"""
+	return numpy.dtype([('id', numpy.int64),
+		('name', 'U%d' % id_chars),  # the ID as the file names spell it, e.g. 00983
+		('redshift', numpy.float64),
+		('restframe', numpy.int8),  # index into filter_list, -1 if unknown
+		('files', numpy.int32, (nfilters,))])  # index into Catalog.names[filter], -1 if there is no file
+
+def read_id_list(filename, filter_list):
+	"""Parse an id_list.csv (id, redshift, rest frame filter, with or without a header row).
+
+	@type filename: string
+	@param filename: name of file which contains desired data
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@rtype: tuple
+	@return: (id, id text, redshift, rest frame filter index) arrays; ValueError names the line of a malformed row
+
+	"""
+	with open(filename, encoding='utf-8-sig') as fin:
+		first = fin.readline()
+	header = int(not first.split(',')[0].strip().isdigit())
+	table = numpy.loadtxt(filename, delimiter=',', skiprows=header, usecols=(0, 1, 2), encoding='utf-8-sig', ndmin=1,
+		dtype=[('id', 'U32'), ('redshift', numpy.float64), ('restframe', 'U16')])
+	values, inverse = numpy.unique(numpy.char.strip(table['restframe']), return_inverse=True)
+	lookup = numpy.array([filter_list.index(value) if value in filter_list else -1 for value in values.tolist()], numpy.int8)
+	text = numpy.char.strip(table['id'])
+	return (text.astype(numpy.int64), text, table['redshift'], lookup[inverse].reshape(-1))
+
+def scan_files(folder_fn, filter_list):
+	"""IDs of the ceers_<filter>_<id>.fits files of each filter folder.
+
+	@type folder_fn: string
+	@param folder_fn: name of folder which contains filter folders with desired data
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@rtype: list
+	@return: list of (sorted id array, id text array, file name array in the same order), one per filter
+
+	"""
+	scanned = []
+	for filt in filter_list:
+		prefix = 'ceers_' + filt + '_'
+		path = os.path.join(folder_fn, filt)
+		names = sorted(os.listdir(path)) if os.path.isdir(path) else []
+		names = [name for name in names if name.startswith(prefix) and name.endswith('.fits') and name[len(prefix):-5].isdigit()]
+		text = numpy.array([name[len(prefix):-5] for name in names] or [], 'U')
+		ids = text.astype(numpy.int64) if names else numpy.array([], numpy.int64)
+		order = numpy.argsort(ids, kind='stable')
+		scanned.append((ids[order], text[order], numpy.array(names)[order] if names else numpy.array([], 'U1')))
+	return scanned
+
+class Catalog:
+	"""Galaxies of one sample; rows is the structured array, see catalog_dtype()."""
+
+	def __init__(self, rows, filter_list, folder_fn=None, names=None):
+		"""
+		@type rows: numpy array
+		@param rows: structured array of catalog_dtype(len(filter_list))
+		@type filter_list: list
+		@param filter_list: list of filter name strings
+		@type folder_fn: string
+		@param folder_fn: name of folder which contains filter folders with desired data
+		@type names: list
+		@param names: one array of file names per filter, which the files field indexes
+
+		"""
+		self.rows = rows
+		self.filter_list = list(filter_list)
+		self.folder_fn = folder_fn
+		self.names = names or [numpy.array([], 'U1') for filt in filter_list]
+		self._index = None
+
+	def __len__(self):
+		return len(self.rows)
+
+	def __iter__(self):
+		return iter(self.ids())
+
+	def index(self, f_id):
+		"""Row number of a galaxy, through a dictionary built on first use.
+
+		@type f_id: string or integer
+		@param f_id: ID of the sample
+		@rtype: integer
+		@return: row number; KeyError if the galaxy isn't in the catalog
+
+		"""
+		if self._index is None:
+			self._index = dict(zip(self.rows['id'].tolist(), range(len(self.rows))))
+		return self._index[int(f_id)]
+
+	def __contains__(self, f_id):
+		try:
+			self.index(f_id)
+		except (KeyError, ValueError):
+			return False
+		return True
+
+	def row(self, f_id):
+		"""
+		@rtype: numpy.void
+		@return: the row of a galaxy
+		"""
+		return self.rows[self.index(f_id)]
+
+	def ids(self):
+		"""
+		@rtype: list
+		@return: list of the ID strings as the file names spell them, in catalog order
+		"""
+		return self.rows['name'].tolist()
+
+	def restframe(self, f_id):
+		"""
+		@rtype: string
+		@return: rest frame filter of a galaxy, None if unknown
+		"""
+		i = self.rows['restframe'][self.index(f_id)]
+		return self.filter_list[i] if i >= 0 else None
+
+	def restframes(self):
+		"""
+		@rtype: dictionary
+		@return: dictionary where the key is the ID of a sample, and the value is the rest frame filter, as get_restframe_dict()
+		"""
+		known = self.rows[self.rows['restframe'] >= 0]
+		return dict(zip(known['name'].tolist(), [self.filter_list[i] for i in known['restframe'].tolist()]))
+
+	def files(self, f_id):
+		"""
+		@rtype: list
+		@return: list of the .fits file names of a galaxy, in the order of filter_list, None where there is no file
+		"""
+		files = self.rows['files'][self.index(f_id)]
+		return [os.path.join(self.folder_fn, filt, str(self.names[j][files[j]])) if files[j] >= 0 else None for j, filt in enumerate(self.filter_list)]
+
+	def complete(self):
+		"""
+		@rtype: numpy array
+		@return: boolean array, True for the galaxies which have a file for every filter
+		"""
+		return (self.rows['files'] >= 0).all(axis=1)
+
+	def with_files(self):
+		"""
+		@rtype: Catalog
+		@return: new catalog of the galaxies which have a file for at least one filter (not those only in the csv)
+		"""
+		return self.select((self.rows['files'] >= 0).any(axis=1))
+
+	def select(self, mask):
+		"""Catalog of some of the galaxies, e.g. cat.select(cat.rows['redshift'] > 2).
+
+		@type mask: numpy array
+		@param mask: boolean array, or array of row numbers
+		@rtype: Catalog
+		@return: new catalog sharing the file names
+
+		"""
+		return Catalog(self.rows[mask], self.filter_list, self.folder_fn, self.names)
+
+	def sort(self, field='id'):
+		"""
+		@type field: string
+		@param field: field to sort by, e.g. 'redshift'
+		@rtype: Catalog
+		@return: new catalog in that order (stable)
+		"""
+		return self.select(numpy.argsort(self.rows[field], kind='stable'))
+
+def load_catalog(folder_fn, filter_list, id_list=None):
+	"""Catalog of a sample folder: the galaxies of its id_list.csv and of its filter folders.
+
+	@type folder_fn: string
+	@param folder_fn: name of folder which contains filter folders with desired data
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@type id_list: string
+	@param id_list: csv of id, redshift, rest frame filter; <folder_fn>/id_list.csv if None (skipped if it doesn't exist)
+	@rtype: Catalog
+	@return: catalog sorted by ID; galaxies with files but not in the csv have no redshift or rest frame filter
+
+	"""
+	id_list = id_list or os.path.join(folder_fn, 'id_list.csv')
+	if os.path.exists(id_list):
+		ids, text, redshift, restframe = read_id_list(id_list, filter_list)
+	else:
+		ids, text, redshift, restframe = numpy.array([], numpy.int64), numpy.array([], 'U1'), numpy.array([]), numpy.array([], numpy.int8)
+	scanned = scan_files(folder_fn, filter_list)
+	all_ids = numpy.unique(numpy.concatenate([ids] + [file_ids for file_ids, file_text, names in scanned]))
+	id_chars = max([16] + [int(numpy.char.str_len(array).max()) for array in [text] + [file_text for file_ids, file_text, names in scanned] if len(array)])
+	rows = numpy.zeros(len(all_ids), catalog_dtype(len(filter_list), id_chars))
+	rows['id'] = all_ids
+	rows['redshift'] = numpy.nan
+	rows['restframe'] = -1
+	listed = numpy.searchsorted(all_ids, ids)
+	rows['name'][listed] = text
+	rows['redshift'][listed] = redshift
+	rows['restframe'][listed] = restframe
+	# The ID text of the files wins over that of the csv, so the file names can be rebuilt from it
+	for j, (file_ids, file_text, names) in reversed(list(enumerate(scanned))):
+		rows['name'][numpy.searchsorted(all_ids, file_ids)] = file_text
+	for j, (file_ids, file_text, names) in enumerate(scanned):
+		rows['files'][:, j] = -1
+		rows['files'][numpy.searchsorted(all_ids, file_ids), j] = numpy.arange(len(file_ids))
+	return Catalog(rows, filter_list, folder_fn, [names for file_ids, file_text, names in scanned])
@@ -0,0 +1,366 @@
+#
+# Command line entry point: python cli.py {collage,convert,compare,atlas,restframe,survey,ingest,trilogy,index,merge,shards} ...
+# Arguments are parsed before anything heavy is imported, and each subcommand imports only what it needs,
+# so --help and index start right away instead of waiting for astropy, matplotlib and scipy.
+#
+# You can freely use the code
+#
+
+import argparse
+import collections
+import contextlib
+import csv
+import os
+import sys
+import time
+
+scale_modes = ['sqrt',
+		'power',
+		'log',
+		'linear',
+		'asinh_beta_01',
+		'asinh_beta_05',
+		'asinh_beta_20',
+		'histeq',
+		'logistic']
+
+filter_list = ['f115w',
+		'f150w',
+		'f200w',
+		'f277w',
+		'f356w',
+		'f410m',
+		'f444w',]
+
+def sample_ids(folder_fn, filter_list, complete=True):
+	"""List the IDs of the galaxies of a sample folder from the file names, without opening any file.
+
+	@type folder_fn: string
+	@param folder_fn: name of folder which contains filter folders with desired data
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@type complete: boolean
+	@param complete: only the galaxies which have a file for every filter
+	@rtype: dictionary
+	@return: dictionary where the key is the ID of a sample, and the value is the list of filters it has, sorted by ID
+
+	"""
+	found = collections.defaultdict(list)
+	for filt in filter_list:
+		path = os.path.join(folder_fn, filt)
+		if not os.path.isdir(path):
+			continue
+		for name in os.listdir(path):
+			prefix = 'ceers_' + filt + '_'
+			if name.startswith(prefix) and name.endswith('.fits'):
+				found[name[len(prefix):-5]].append(filt)
+	return dict([(f_id, found[f_id]) for f_id in sorted(found) if (not complete) or (len(found[f_id]) == len(filter_list))])
+
+def load_restframes(args):
+	"""Rest frame filters of the sample, from --restframes or <sample>/id_list.csv; None for galaxies which aren't listed.
+
+	@type args: argparse.Namespace
+	@param args: parsed arguments
+	@rtype: dictionary
+	@return: dictionary where the key is the ID of a sample, and the value is the rest frame filter
+
+	"""
+	filename = args.restframes or os.path.join(args.sample, 'id_list.csv')
+	restframes = collections.defaultdict(lambda: None)
+	if os.path.exists(filename):
+		import fits_to_png_bulk
+		restframes.update(fits_to_png_bulk.get_restframe_dict(filename))
+	return restframes
+
+def render_bulk(render, out_folder, args):
+	"""Run save_collage_bulk() or save_comparison_bulk() over the sample, or over one shard of it with --shard."""
+	import numpy
+	import fits_to_png_bulk
+	dtype = numpy.float32 if args.float32 else numpy.float64
+	params = dict(mode_list=args.modes, sig_fract=args.sig_fract, percent_fract=args.percent_fract, restframes=load_restframes(args), color=args.cmap, size_inches=args.size, dpi=args.dpi, dtype=dtype, gate=not args.no_gate, norm=load_norm(args), back_box=args.back_box, register=args.register, psf_match=args.psf_match)
+	if args.telemetry:
+		import telemetry
+		job = args.command + ('_shard_%d_of_%d' % args.shard if args.shard else '')
+		params['telemetry'] = telemetry.Telemetry(args.telemetry, interval=args.telemetry_interval, job=job)
+	try:
+		with params['telemetry'] if args.telemetry else contextlib.nullcontext():
+			if args.shard:
+				import shard
+				shard.run_shard(render, args.sample, out_folder, args.filters, args.shard, **params)
+			else:
+				render(args.sample, filter_list=args.filters, **params)
+	except fits_to_png_bulk.GalaxiesFailed as error:
+		# the other samples were rendered; the tracebacks of the failed ones were printed as they failed
+		sys.exit(str(error))
+
+def load_norm(args):
+	"""The survey normalization of --norm (see survey_norm.py), or None."""
+	if not args.norm:
+		return None
+	import survey_norm
+	return survey_norm.load_norm(args.norm)
+
+def run_collage(args):
+	import fits_to_png_bulk
+	render_bulk(fits_to_png_bulk.save_collage_bulk, args.sample + '_collage', args)
+
+def run_compare(args):
+	import fits_to_png_bulk
+	for mode in args.modes:
+		os.makedirs(args.sample + '_RGBComp/' + mode, exist_ok=True)
+	render_bulk(fits_to_png_bulk.save_comparison_bulk, args.sample + '_RGBComp', args)
+
+def run_convert(args):
+	import numpy
+	import fits_to_png_bulk
+	dtype = numpy.float32 if args.float32 else numpy.float64
+	norm = load_norm(args)
+	galaxies = sample_ids(args.sample, args.filters, complete=False)
+	if args.ids:
+		galaxies = dict([(f_id, galaxies.get(f_id, [])) for f_id in args.ids])
+	for mode in args.modes:
+		for f_id, filters in galaxies.items():
+			for filt in filters:
+				name = 'ceers_' + filt + '_' + f_id
+				new_img = fits_to_png_bulk.img_scale_getfig(os.path.join(args.sample, filt, name + '.fits'), args.sig_fract, args.percent_fract, mode, min_val=0.0, dtype=dtype, norm=norm)
+				fits_to_png_bulk.img_scale_savefig(new_img, name, filt, args.sample, mode, color=args.cmap, size_inches=args.size, dpi=args.dpi, vmax=None if norm is None else 1.0)
+
+def run_atlas(args):
+	import numpy
+	import fits_to_png_bulk
+	import atlas
+	dtype = numpy.float32 if args.float32 else numpy.float64
+	outroot = args.out or os.path.join(args.sample + '_atlas', 'atlas')
+	import prefetch
+	f_ids = list(sample_ids(args.sample, args.filters))
+	norm = load_norm(args)
+	writer = atlas.AtlasWriter(outroot, cols=args.cols, rows=args.rows)
+	# The quality gate judges each galaxy on the data read for it (see prefetch.py)
+	rejected = {}
+	for galaxy in prefetch.iter_galaxies(args.sample, f_ids, args.filters, sig_fract=args.sig_fract, percent_fract=args.percent_fract, dtype=dtype, gate=not args.no_gate):
+		if galaxy.rejected is not None:
+			rejected[galaxy.f_id] = galaxy.rejected
+			continue
+		f_id = galaxy.f_id
+		channel_data = galaxy.channel_data()
+		for mode in args.modes:
+			for filt, (img_data, img_data_raw, width, height) in zip(args.filters, channel_data):
+				img = fits_to_png_bulk.scale_data(img_data, img_data_raw, mode, min_val=0.0, norm=norm, filt=filt)
+				writer.add((f_id, mode, filt), atlas.to_pixels(img, args.cmap), group=mode)
+	fits_to_png_bulk.report_rejected(os.path.dirname(outroot) or '.', rejected, len(f_ids), args.filters)
+	print('%d panels in %d sheets, index in %s.json' % (len(writer.panels), writer.close(), outroot))
+
+def run_restframe(args):
+	import numpy
+	import fits_to_png_bulk
+	import atlas
+	dtype = numpy.float32 if args.float32 else numpy.float64
+	writer = atlas.AtlasWriter(args.atlas, cols=args.cols, rows=args.rows) if args.atlas else None
+	fits_to_png_bulk.save_restframe_bulk(args.sample, args.modes, args.filters, args.sig_fract, args.percent_fract, load_restframes(args), color=args.cmap, dtype=dtype, gate=not args.no_gate, batch=args.batch, writer=writer, norm=load_norm(args), processes=args.processes, back_box=args.back_box, register=args.register, psf_match=args.psf_match)
+	if writer is not None:
+		print('%d panels in %d sheets, index in %s.json' % (len(writer.panels), writer.close(), args.atlas))
+
+def run_survey(args):
+	import survey_norm
+	start = time.perf_counter()
+	norm = survey_norm.reduce_sample(args.sample, args.filters, sig_fract=args.sig_fract, percent_fract=args.percent_fract, processes=args.processes)
+	norm.low_cut = args.low_cut
+	norm.high_cut = args.high_cut
+	out = args.out or args.sample + '_norm.npz'
+	norm.save(out)
+	print('%d galaxies in %.1f s, saved in %s' % (norm.info['galaxies'], time.perf_counter() - start, out))
+	for filt in args.filters:
+		print('%-6s raw %11.4g to %-11.4g sky subtracted %11.4g to %-11.4g' % ((filt,) + norm.range(filt, 'raw') + norm.range(filt, 'sky')))
+
+def run_ingest(args):
+	import numpy
+	import ingest
+	dtype = numpy.float32 if args.float32 else numpy.float64
+	watcher = ingest.Ingest(args.sample, args.modes, args.filters, sig_fract=args.sig_fract, percent_fract=args.percent_fract, color=args.cmap, size_inches=args.size, dpi=args.dpi, dtype=dtype, gate=not args.no_gate, norm=args.norm, back_box=args.back_box, register=args.register, psf_match=args.psf_match, restframes=args.restframes, interval=args.interval, settle=args.settle, drain=args.drain, workers=args.workers, cursor=args.cursor)
+	if args.telemetry:
+		import telemetry
+		watcher.telemetry = telemetry.Telemetry(args.telemetry, interval=args.telemetry_interval, job='ingest')
+		with watcher.telemetry:
+			watcher.run(once=args.once)
+	else:
+		watcher.run(once=args.once)
+
+def run_trilogy(args):
+	import Trilogy_rgb
+	Trilogy_rgb.main(['Trilogy_rgb.py'] + args.trilogy_args)
+
+def run_index(args):
+	import catalog
+	cat = catalog.load_catalog(args.sample, args.filters, args.restframes)
+	has = cat.rows['files'] >= 0
+	out = open(args.out, 'w', newline='') if args.out else sys.stdout
+	writer = csv.writer(out)
+	writer.writerow(['id', 'restframe', 'complete'] + args.filters)
+	for f_id, restframe, files in zip(cat.ids(), cat.rows['restframe'].tolist(), has.astype(int).tolist()):
+		writer.writerow([f_id, args.filters[restframe] if restframe >= 0 else '', int(all(files))] + files)
+	if args.out:
+		out.close()
+
+def run_merge(args):
+	import shard
+	merged = shard.merge(args.out_folder)
+	for timing in merged['timing']:
+		print('shard %(shard)d on %(host)s: %(samples)d samples, %(seconds).1f s (%(read_wait).1f s waiting for reads)' % timing)
+	print('%d samples, %d rejected, %d failed, %d images; slowest shard %.1f s, %.2f x the mean' % (len(merged['samples']), len(merged['rejected']), len(merged['failed']), len(merged['outputs']), merged['seconds'], merged['imbalance']))
+	for f_id, error in sorted(merged['failed'].items()):
+		print('  %s failed: %s' % (f_id, error))
+	if merged['missing'] or merged['duplicates']:
+		print('Incomplete: shards %s missing, %d samples in more than one shard' % (merged['missing'], len(merged['duplicates'])))
+		sys.exit(1)
+
+def run_shards(args):
+	"""Run the shards of a command as local processes, then merge them, to try a sharded run on one machine."""
+	import shard
+	command = make_parser().parse_args(args.command_args)
+	if command.command not in ('collage', 'compare'):
+		sys.exit('shards runs collage or compare, not ' + command.command)
+	codes = shard.run_local(args.command_args, args.n)
+	if any(codes):
+		sys.exit('Shards failed with exit codes %s' % codes)
+	args.out_folder = command.sample + ('_collage' if command.command == 'collage' else '_RGBComp')
+	run_merge(args)
+
+def add_render_options(parser):
+	parser.add_argument('sample', help='sample folder, e.g. sample_2')
+	parser.add_argument('--modes', nargs='+', default=['log'], choices=scale_modes, metavar='MODE', help='scaling modes: ' + ', '.join(scale_modes) + ' (default: log)')
+	parser.add_argument('--filters', nargs='+', default=filter_list, help='filter folders, in order (default: the 7 NIRCam filters)')
+	parser.add_argument('--sig-fract', type=float, default=5.0, help='fraction of sigma clipping for the sky (default: 5.0)')
+	parser.add_argument('--percent-fract', type=float, default=0.01, help='convergence fraction for the sky (default: 0.01)')
+	parser.add_argument('--cmap', default='Greys', help='matplotlib colormap (default: Greys)')
+	parser.add_argument('--size', type=float, default=6.8, help='size of the images, in inches (default: 6.8)')
+	parser.add_argument('--dpi', type=int, default=300, help='dots per inch (default: 300)')
+	parser.add_argument('--float32', action='store_true', help='work in float32, see precision_report.py')
+	parser.add_argument('--restframes', help='csv of id, redshift, rest frame filter (default: <sample>/id_list.csv)')
+	parser.add_argument('--norm', metavar='NPZ', help='scale with the frozen survey normalization made by the survey subcommand, instead of per image')
+
+def add_stage_options(parser):
+	parser.add_argument('--back-box', type=int, metavar='PIXELS', help='subtract a background varying across the image, measured in boxes of this size, instead of one sky value (see background.py)')
+	parser.add_argument('--register', action='store_true', help='shift every filter onto the R channel by its sub-pixel offset before scaling (see registration.py)')
+	parser.add_argument('--psf-match', action='store_true', help='convolve every filter to the broadest PSF before scaling, batched per galaxy (see psfmatch.py)')
+
+def shard_arg(text):
+	import shard
+	try:
+		return shard.parse_shard(text)
+	except ValueError as error:
+		raise argparse.ArgumentTypeError(str(error))
+
+def make_parser():
+	parser = argparse.ArgumentParser(prog='cli.py', description='Make images of the CEERS disk galaxy samples.')
+	subparsers = parser.add_subparsers(dest='command', required=True)
+
+	collage = subparsers.add_parser('collage', help='one collage per galaxy: every filter, the rest frame filter and RGB')
+	add_render_options(collage)
+	add_stage_options(collage)
+	collage.add_argument('--no-gate', action='store_true', help='render every galaxy, even those the quality gate rejects (see quality.py)')
+	collage.add_argument('--shard', type=shard_arg, metavar='K/N', help='render only shard K of N of the sample, and write its manifest (see shard.py)')
+	collage.add_argument('--telemetry', metavar='OUTROOT', help='write live metrics to OUTROOT.prom (Prometheus textfile format) and OUTROOT.json (see telemetry.py)')
+	collage.add_argument('--telemetry-interval', type=float, default=10.0, help='seconds between telemetry writes (default: 10)')
+	collage.set_defaults(func=run_collage)
+
+	convert = subparsers.add_parser('convert', help='one image per file, in <sample>_converted/<mode>/<filter>')
+	add_render_options(convert)
+	convert.add_argument('--ids', nargs='+', help='only these galaxies')
+	convert.set_defaults(func=run_convert)
+
+	compare = subparsers.add_parser('compare', help='one RGB comparison sheet per galaxy, in <sample>_RGBComp/<mode>')
+	add_render_options(compare)
+	add_stage_options(compare)
+	compare.add_argument('--no-gate', action='store_true', help='render every galaxy, even those the quality gate rejects (see quality.py)')
+	compare.add_argument('--shard', type=shard_arg, metavar='K/N', help='render only shard K of N of the sample, and write its manifest (see shard.py)')
+	compare.add_argument('--telemetry', metavar='OUTROOT', help='write live metrics to OUTROOT.prom (Prometheus textfile format) and OUTROOT.json (see telemetry.py)')
+	compare.add_argument('--telemetry-interval', type=float, default=10.0, help='seconds between telemetry writes (default: 10)')
+	compare.set_defaults(func=run_compare)
+
+	atlas = subparsers.add_parser('atlas', help='every filter of every galaxy packed into sheets, with an index, in <sample>_atlas')
+	atlas.add_argument('sample', help='sample folder, e.g. sample_2')
+	atlas.add_argument('--modes', nargs='+', default=['log'], choices=scale_modes, metavar='MODE', help='scaling modes: ' + ', '.join(scale_modes) + ' (default: log)')
+	atlas.add_argument('--filters', nargs='+', default=filter_list, help='filter folders, in order (default: the 7 NIRCam filters)')
+	atlas.add_argument('--sig-fract', type=float, default=5.0, help='fraction of sigma clipping for the sky (default: 5.0)')
+	atlas.add_argument('--percent-fract', type=float, default=0.01, help='convergence fraction for the sky (default: 0.01)')
+	atlas.add_argument('--cmap', default='Greys', help='matplotlib colormap (default: Greys)')
+	atlas.add_argument('--float32', action='store_true', help='work in float32, see precision_report.py')
+	atlas.add_argument('--cols', type=int, default=32, help='panels per row of a sheet (default: 32)')
+	atlas.add_argument('--rows', type=int, default=32, help='rows of panels per sheet (default: 32)')
+	atlas.add_argument('--out', help='output name without extension (default: <sample>_atlas/atlas)')
+	atlas.add_argument('--no-gate', action='store_true', help='include the galaxies the quality gate rejects (see quality.py)')
+	atlas.add_argument('--norm', metavar='NPZ', help='scale with the frozen survey normalization made by the survey subcommand, instead of per image')
+	atlas.set_defaults(func=run_atlas)
+
+	restframe = subparsers.add_parser('restframe', help='only the rest frame filter and RGB image of each galaxy, in <sample>_restframe/<mode> and rgb')
+	add_render_options(restframe)
+	add_stage_options(restframe)
+	restframe.add_argument('--batch', type=int, default=64, help='galaxies scaled at once (default: 64)')
+	restframe.add_argument('--processes', type=int, default=1, help='scale the batches in worker processes, through shared memory (default: 1, in this process)')
+	restframe.add_argument('--atlas', metavar='OUTROOT', help='pack the panels into atlas sheets (see atlas.py) instead of .png files')
+	restframe.add_argument('--cols', type=int, default=32, help='panels per row of an atlas sheet (default: 32)')
+	restframe.add_argument('--rows', type=int, default=32, help='rows of panels per atlas sheet (default: 32)')
+	restframe.add_argument('--no-gate', action='store_true', help='render every galaxy, even those the quality gate rejects (see quality.py)')
+	restframe.set_defaults(func=run_restframe)
+
+	survey = subparsers.add_parser('survey', help='histogram every filter of a sample, for a survey-wide normalization (--norm)')
+	survey.add_argument('sample', help='sample folder, e.g. sample_2')
+	survey.add_argument('--filters', nargs='+', default=filter_list, help='filter folders (default: the 7 NIRCam filters)')
+	survey.add_argument('--sig-fract', type=float, default=5.0, help='fraction of sigma clipping for the sky (default: 5.0)')
+	survey.add_argument('--percent-fract', type=float, default=0.01, help='convergence fraction for the sky (default: 0.01)')
+	survey.add_argument('--low-cut', type=float, default=0.1, help='percent of the pixels below the frozen minimum (default: 0.1)')
+	survey.add_argument('--high-cut', type=float, default=0.1, help='percent of the pixels above the frozen maximum (default: 0.1)')
+	survey.add_argument('--processes', type=int, help='worker processes (default: one per CPU)')
+	survey.add_argument('--out', help='output file (default: <sample>_norm.npz)')
+	survey.set_defaults(func=run_survey)
+
+	ingest = subparsers.add_parser('ingest', help='watch a sample folder and render each galaxy as soon as all its filter files are there')
+	add_render_options(ingest)
+	add_stage_options(ingest)
+	ingest.add_argument('--interval', type=float, default=5.0, help='seconds between polls of the filter folders (default: 5)')
+	ingest.add_argument('--settle', type=float, default=10.0, help='seconds a galaxy\'s files must be unchanged before it is rendered (default: 10)')
+	ingest.add_argument('--drain', type=float, default=300.0, help='seconds to wait for the galaxies being rendered when stopping (default: 300)')
+	ingest.add_argument('--workers', type=int, help='worker processes (default: one per CPU)')
+	ingest.add_argument('--cursor', help='file of the galaxies done, so a restart skips them (default: <sample>_collage/ingest_cursor.csv)')
+	ingest.add_argument('--once', action='store_true', help='stop when nothing is left to render, instead of watching')
+	ingest.add_argument('--no-gate', action='store_true', help='render every galaxy, even those the quality gate rejects (see quality.py)')
+	ingest.add_argument('--telemetry', metavar='OUTROOT', help='write live metrics to OUTROOT.prom and OUTROOT.json (see telemetry.py)')
+	ingest.add_argument('--telemetry-interval', type=float, default=10.0, help='seconds between telemetry writes (default: 10)')
+	ingest.set_defaults(func=run_ingest)
+
+	trilogy = subparsers.add_parser('trilogy', help='run Trilogy_rgb.py: trilogy [trilogy.in | image.fits] [-option value ...]')
+	trilogy.add_argument('trilogy_args', nargs=argparse.REMAINDER, help='arguments of Trilogy_rgb.py')
+	trilogy.set_defaults(func=run_trilogy)
+
+	index = subparsers.add_parser('index', help='csv of the galaxies of a sample, their rest frame filter and the filters they have')
+	index.add_argument('sample', help='sample folder, e.g. sample_2')
+	index.add_argument('--filters', nargs='+', default=filter_list, help='filter folders (default: the 7 NIRCam filters)')
+	index.add_argument('--restframes', help='csv of id, redshift, rest frame filter (default: <sample>/id_list.csv)')
+	index.add_argument('--out', help='output file (default: standard output)')
+	index.set_defaults(func=run_index)
+
+	merge = subparsers.add_parser('merge', help='merge the manifests and reports of the --shard runs in an output folder')
+	merge.add_argument('out_folder', help='output folder of the shards, e.g. sample_2_collage')
+	merge.set_defaults(func=run_merge)
+
+	shards = subparsers.add_parser('shards', help='run N shards of a collage or compare command as local processes, then merge')
+	shards.add_argument('n', type=int, help='number of shards')
+	shards.add_argument('command_args', nargs=argparse.REMAINDER, help='the command, e.g. collage small_sample --modes log')
+	shards.set_defaults(func=run_shards)
+
+
+	return parser
+
+def main(argv=None):
+	if argv is None:
+		argv = sys.argv[1:]
+	if argv[:1] == ['trilogy'] and argv[1:2] not in (['-h'], ['--help']):
+		# Trilogy's own -option value arguments aren't for argparse
+		args = argparse.Namespace(trilogy_args=argv[1:])
+		run_trilogy(args)
+		return
+	args = make_parser().parse_args(argv)
+	args.func(args)
+
+if __name__ == "__main__":
+	main()
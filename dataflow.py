@@ -0,0 +1,226 @@
+#
+# Lazy dataflow graph for the bulk pipeline: load, sky, scale, compose (RGB) and render are nodes keyed by their inputs
+# Asking a Graph for a node computes only the nodes it depends on, and every node is memoized (least recently used
+# first out, up to max_bytes), so e.g. the sky of a galaxy is clipped once for all its scaling modes, the RGB image of
+# a collage is made once per galaxy instead of once per mode, and the log, histeq and logistic modes never clip the sky.
+#
+# You can freely use the code
+#
+
+import numpy
+import threading
+import time
+from collections import OrderedDict, Counter
+import fits_to_png_bulk
+
+# fits_to_png_bulk.scale_data() modes which only use the raw pixel data
+raw_modes = ['log', 'histeq', 'logistic']
+
+class Node:
+	"""One step of the pipeline: func(*values of inputs, **params), identified by a key built from the same."""
+
+	def __init__(self, func, inputs=(), **params):
+		"""
+		@type func: function
+		@param func: stage function
+		@type inputs: list
+		@param inputs: list of the nodes whose values are the positional arguments of func
+		@param params: keyword arguments of func; must be hashable
+
+		"""
+		self.func = func
+		self.inputs = tuple(inputs)
+		self.params = params
+		self.key = (func.__name__,) + tuple([node.key for node in self.inputs]) + tuple(sorted(params.items()))
+
+	def __repr__(self):
+		return 'Node%r' % (self.key,)
+
+def nbytes(value):
+	"""Memory held by a value, roughly."""
+	if isinstance(value, numpy.ndarray):
+		return value.nbytes
+	if isinstance(value, (tuple, list)):
+		return sum([nbytes(item) for item in value])
+	return 64
+
+class Graph:
+	"""Evaluates nodes on demand and memoizes their values, evicting the least recently used past max_bytes."""
+
+	def __init__(self, max_bytes=256 * 2**20, telemetry=None):
+		"""
+		@type max_bytes: integer
+		@param max_bytes: memory the memoized values may take (256 MB holds several hundred 7 filter galaxies)
+		@type telemetry: telemetry.Telemetry
+		@param telemetry: observe the time each stage takes, as stage_seconds{stage=...}
+
+		"""
+		self.max_bytes = max_bytes
+		self.telemetry = telemetry
+		self.memo = OrderedDict()
+		self.nbytes = 0
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.evictions = 0
+		self.computed = Counter()  # stage name: times computed
+
+	def get(self, node):
+		"""Value of a node, computing it and the inputs it needs unless they are memoized.
+
+		@type node: Node
+		@param node: node to evaluate
+		@rtype: object
+		@return: value of the node
+
+		"""
+		with self.lock:
+			if node.key in self.memo:
+				self.memo.move_to_end(node.key)
+				self.hits += 1
+				return self.memo[node.key]
+		inputs = [self.get(input_node) for input_node in node.inputs]
+		start = time.perf_counter()
+		value = node.func(*inputs, **node.params)
+		if self.telemetry is not None:
+			self.telemetry.observe('stage_seconds', time.perf_counter() - start, stage=node.key[0])
+		with self.lock:
+			if node.key not in self.memo:
+				self.memo[node.key] = value
+				self.nbytes += nbytes(value)
+				self.computed[node.key[0]] += 1
+			self.memo.move_to_end(node.key)
+			self.evict()
+		return value
+
+	def put(self, node, value):
+		"""Memoize a value computed elsewhere, e.g. data read ahead by prefetch.py.
+
+		@type node: Node
+		@param node: node the value is of
+		@type value: object
+		@param value: its value
+		@rtype: None
+
+		"""
+		with self.lock:
+			if node.key in self.memo:
+				self.nbytes -= nbytes(self.memo.pop(node.key))
+			self.memo[node.key] = value
+			self.nbytes += nbytes(value)
+			self.evict()
+
+	def evict(self):
+		"""Drop the least recently used values until the memo is within max_bytes, called with the lock held.  The most
+		recently used, the value just memoized, is kept even if it alone is over."""
+		while (self.nbytes > self.max_bytes) and (len(self.memo) > 1):
+			key, evicted = self.memo.popitem(last=False)
+			self.nbytes -= nbytes(evicted)
+			self.evictions += 1
+
+	def stats(self):
+		"""
+		@rtype: dictionary
+		@return: memoized nodes and bytes, hits, evictions, and how many times each stage was computed
+		"""
+		return {'memoized': len(self.memo), 'bytes': self.nbytes, 'hits': self.hits, 'evictions': self.evictions, 'computed': dict(self.computed)}
+
+#################################
+# Stages
+
+def read(fn, dtype, psf_target=None, shift=None):
+	"""Raw pixel data of a .fits file, as get_fits_data() reads it; shifted by shift (see registration.py) and convolved to
+	the PSF of psf_target (see psfmatch.py) if given, as fits_to_png_bulk.align_and_match() does to the whole galaxy."""
+	import astropy.io.fits as pyfits
+	with pyfits.open(fn) as hdulist:
+		data = numpy.array(hdulist[0].data, dtype=dtype)
+	if shift is not None:
+		import registration
+		data = registration.shift_stack(data, shift)
+	if psf_target is not None:
+		import psfmatch
+		data = psfmatch.match_stack(data[None], [psfmatch.filter_of(fn)], psf_target, pad=psfmatch.common_margin(psf_target))[0]
+	return data
+
+def subtract(img_data_raw, sig_fract, percent_fract, back_box=None):
+	"""Raw pixel data minus the sky, see fits_to_png_bulk.subtract_sky()."""
+	return fits_to_png_bulk.subtract_sky(img_data_raw, sig_fract, percent_fract, back_box=back_box)
+
+def scale(img_data, img_data_raw, mode, min_val=None, norm=None, filt=None):
+	"""Scaled data, see fits_to_png_bulk.scale_data()."""
+	return fits_to_png_bulk.scale_data(img_data, img_data_raw, mode, min_val=min_val, norm=norm, filt=filt)
+
+def compose(r, g, b, min_val=None, color_balance=(1, 1, 1)):
+	"""RGB array from the sky subtracted data of 3 channels, see fits_to_png_bulk.get_rgb_batch()."""
+	return fits_to_png_bulk.get_rgb_batch(((r,), (g,), (b,)), [color_balance], min_val=min_val)[0]
+
+def render(*arrays, **params):
+	"""Save a collage of scaled images and an RGB array (the last of arrays), see fits_to_png_bulk.draw_collage()."""
+	return fits_to_png_bulk.draw_collage(list(arrays[:-1]), arrays[-1], list(params.pop('filters')), **params)
+
+#################################
+# Nodes
+
+def load(fn, dtype=float, psf_target=None, shift=None):
+	"""
+	@type fn: string
+	@param fn: file location string
+	@type dtype: numpy dtype
+	@param dtype: floating point precision of the pixel data, float or numpy.float32
+	@type psf_target: string
+	@param psf_target: filter whose PSF the data is convolved to (see psfmatch.py), or None
+	@type shift: tuple
+	@param shift: (dy, dx) the data is shifted by to register it to the other filters (see registration.py), or None
+	@rtype: Node
+	@return: node of the raw pixel data
+	"""
+	params = dict(fn=fn, dtype=numpy.dtype(dtype).str)
+	if psf_target is not None:
+		params['psf_target'] = psf_target
+	if shift is not None:
+		params['shift'] = tuple([float(value) for value in shift])
+	return Node(read, **params)
+
+def sky(fn, sig_fract, percent_fract, dtype=float, back_box=None, psf_target=None, shift=None):
+	"""
+	@rtype: Node
+	@return: node of the raw pixel data minus sky, like get_fits_data()
+	"""
+	return Node(subtract, [load(fn, dtype, psf_target, shift)], sig_fract=sig_fract, percent_fract=percent_fract, back_box=back_box)
+
+def scaled(fn, mode, sig_fract, percent_fract, min_val=None, dtype=float, back_box=None, norm=None, psf_target=None, shift=None):
+	"""
+	@rtype: Node
+	@return: node of the scaled data, like img_scale_getfig(); the raw_modes don't depend on the sky
+	"""
+	raw = load(fn, dtype, psf_target, shift)
+	data = raw if mode in raw_modes else sky(fn, sig_fract, percent_fract, dtype, back_box, psf_target, shift)
+	if norm is None:
+		return Node(scale, [data, raw], mode=mode, min_val=min_val)
+	return Node(scale, [data, raw], mode=mode, min_val=min_val, norm=norm, filt=fits_to_png_bulk.path_to_info(fn, '')[2])
+
+def rgb(channel_list, sig_fract=3.0, percent_fract=5.0-4, min_val=None, color_balance=(1, 1, 1), dtype=float, back_box=None, psf_target=None, shifts=None):
+	"""
+	@rtype: Node
+	@return: node of the RGB array, like get_rgb() (with the same default sky clipping)
+	"""
+	if shifts is None:
+		shifts = [None] * len(channel_list)
+	return Node(compose, [sky(fn, sig_fract, percent_fract, dtype, back_box, psf_target, shift) for fn, shift in zip(channel_list, shifts)], min_val=min_val, color_balance=tuple(color_balance))
+
+def collage(fn_list, sig_fract, percent_fract, min_val, filters, mode, folder_fn, color='hot', size_inches=3.4, dpi=300, restframe=None, dtype=float, norm=None, back_box=None, psf_target=None, shifts=None):
+	"""The same collage as fits_to_png_bulk.img_scale_collage(), as a node; with psf_target, of the filters convolved to
+	its PSF, with shifts (one (dy, dx) per file, see fits_to_png_bulk.align_and_match()), of the filters registered, and
+	with back_box, with a background mesh subtracted instead of one sky value (see fits_to_png_bulk.subtract_sky()).
+
+	@rtype: Node
+	@return: node whose value is the path of the saved .png
+	"""
+	if shifts is None:
+		shifts = [None] * len(fn_list)
+	images = [scaled(fn, mode, sig_fract, percent_fract, min_val, dtype, back_box, norm, psf_target, shift) for fn, shift in zip(fn_list, shifts)]
+	rgb_node = rgb((fn_list[6], fn_list[4], fn_list[1]), min_val=min_val, dtype=dtype, back_box=back_box, psf_target=psf_target, shifts=(shifts[6], shifts[4], shifts[1]))
+	name = 'ceers_' + fits_to_png_bulk.fits_id(fn_list[0])
+	params = dict(filters=tuple(filters), title=name, out_path=folder_fn + '_collage/' + mode, out_name=name + '_' + mode + '.png', color=color, size_inches=size_inches, dpi=dpi, restframe=restframe)
+	if norm is not None:
+		params['vmax'] = 1.0
+	return Node(render, images + [rgb_node], **params)
@@ -8,12 +8,11 @@
 # 
 
 import numpy
-import matplotlib as mpl
 import astropy.io.fits as pyfits
 import img_scale
-import pylab
+import registration
+import psfmatch
 import os
-from alive_progress import alive_bar
 import time
 import csv
 import warnings
@@ -29,14 +28,12 @@ def get_restframe_dict(filename):
 	"""
 	rframe_dict = {}
 	
-	with open(filename, newline='') as rframe_csv:
+	# utf-8-sig: the spreadsheets are saved with a byte order mark; rows without a numeric ID (the header) are skipped
+	with open(filename, newline='', encoding='utf-8-sig') as rframe_csv:
 		rframe_reader = csv.reader(rframe_csv)
 		for row in rframe_reader:
-			try:
-				sample_id = int(row[0])
-				rframe_dict[row[0]] = row[2]
-			except:
-				continue
+			if row and row[0].strip().isdigit():
+				rframe_dict[row[0].strip()] = row[2].strip()
 	return rframe_dict
 
 def make_path_collage(folder_fn, mode_list):
@@ -66,13 +63,81 @@ def path_to_info(path_name, folder_name):
 	@return: (shortened path string, file name string, filter string)
 	
 	"""
-	sps = path_name[-29 - len(folder_name):] #Shortened Path String
-	fns = path_name[-22:-5]                  #File Name String
-	fts = path_name[-16:-11]                 #Filter String
+	fns = os.path.basename(path_name)[:-5]           #File Name String, ceers_<filter>_<id>
+	fts = fns.split('_')[1]                          #Filter String
+	sps = os.path.join(folder_name, fts, fns + '.fits') #Shortened Path String
 	
 	return (sps, fns, fts)
 
-def get_fits_data(fn, sig_fract, percent_fract):
+def fits_id(fn):
+	"""Get the ID of a sample from one of its file names, whatever its number of digits.
+	
+	@type fn: string
+	@param fn: file name string, .../ceers_<filter>_<id>.fits
+	@rtype: string
+	@return: ID of the sample
+	
+	"""
+	return os.path.basename(fn)[:-5].split('_', 2)[2]
+
+def galaxy_files(folder_fn, f_id, filter_list):
+	"""Build the .fits file names of one sample for each filter.
+	
+	@type folder_fn: string
+	@param folder_fn: name of folder which contains filter folders with desired data
+	@type f_id: string
+	@param f_id: ID of the sample
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@rtype: list
+	@return: list of file name strings, in the order of filter_list
+	
+	"""
+	return [folder_fn + '/' + filt + '/ceers_' + filt + '_' + f_id + '.fits' for filt in filter_list]
+
+def report_rejected(out_folder, rejected, total, filter_list, report='rejected.csv'):
+	"""List the samples which failed the quality gate in out_folder/<report>, if any did.
+	
+	@type out_folder: string
+	@param out_folder: folder the images of the samples are saved in
+	@type rejected: dictionary
+	@param rejected: dictionary where the key is the ID of a sample, and the value is (reasons, statistics), as from quality.check_galaxy()
+	@type total: integer
+	@param total: number of samples judged
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@type report: string
+	@param report: name of the report, e.g. one per shard (see shard.py)
+	@rtype: None
+	
+	"""
+	import quality
+	if rejected:
+		os.makedirs(out_folder, exist_ok=True)
+		report = out_folder + '/' + report
+		quality.write_report(report, rejected, filter_list)
+		print(str(len(rejected)) + ' of ' + str(total) + ' samples rejected, see ' + report)
+
+def load_galaxy(fn_list, sig_fract, percent_fract, dtype=float, back_box=None):
+	"""Load the pixel data of every file of one sample, once.
+	
+	@type fn_list: list
+	@param fn_list: list of file name strings
+	@type sig_fract: float
+	@param sig_fract: fraction of sigma clipping
+	@type percent_fract: float
+	@param percent_fract: convergence fraction
+	@type dtype: numpy dtype
+	@param dtype: floating point precision of the pixel data, float or numpy.float32
+	@type back_box: integer
+	@param back_box: subtract a background varying across the image, measured in boxes of this size (see subtract_sky()), instead of one sky value
+	@rtype: list
+	@return: list of (img_data, img_data_raw, width, height) tuples from get_fits_data(), in the order of fn_list
+	
+	"""
+	return [get_fits_data(fn, sig_fract, percent_fract, dtype=dtype, back_box=back_box) for fn in fn_list]
+
+def get_fits_data(fn, sig_fract, percent_fract, dtype=float, back_box=None):
 	"""Get pixel data from .fits file and return numpy pixel arrays.
 	
 	@type fn: string
@@ -81,6 +146,10 @@ def get_fits_data(fn, sig_fract, percent_fract):
 	@param sig_fract: fraction of sigma clipping
 	@type percent_fract: float
 	@param percent_fract: convergence fraction
+	@type dtype: numpy dtype
+	@param dtype: floating point precision of the pixel data, float or numpy.float32
+	@type back_box: integer
+	@param back_box: subtract a background varying across the image, measured in boxes of this size (see subtract_sky()), instead of one sky value
 	@rtype: tuple
 	@return: (raw pixel data minus sky value ,raw pixel data array)
 	
@@ -92,16 +161,37 @@ def get_fits_data(fn, sig_fract, percent_fract):
 	width=img_data_raw.shape[0]
 	height=img_data_raw.shape[1]
 	# print("#INFO : ", fn, width, height)
-	img_data_raw = numpy.array(img_data_raw, dtype=float)
-	# sky, num_iter = img_scale.sky_median_sig_clip(img_data, sig_fract, percent_fract, max_iter=100)
-	sky, num_iter = img_scale.sky_mean_sig_clip(img_data_raw, sig_fract, percent_fract, max_iter=10)
-	# print("sky = ", sky, '(', num_iter, ')')
-	img_data = img_data_raw - sky
+	img_data_raw = numpy.array(img_data_raw, dtype=dtype)
+	img_data = subtract_sky(img_data_raw, sig_fract, percent_fract, back_box=back_box)
 	# print("... min. and max. value : ", numpy.min(img_data), numpy.max(img_data))
 
 	return (img_data, img_data_raw, width, height)
 
-def img_scale_getfig(fn, sig_fract, percent_fract, mode, min_val=None):
+def subtract_sky(img_data_raw, sig_fract, percent_fract, back_box=None):
+	"""Subtract the sigma clipped sky value from raw pixel data.
+	
+	@type img_data_raw: numpy array
+	@param img_data_raw: raw pixel data array
+	@type sig_fract: float
+	@param sig_fract: fraction of sigma clipping
+	@type percent_fract: float
+	@param percent_fract: convergence fraction
+	@type back_box: integer
+	@param back_box: if given, subtract a background.BackgroundMesh measured in boxes of this size instead of one sky value
+	@rtype: numpy array
+	@return: raw pixel data minus sky value
+	
+	"""
+	if back_box:
+		import background  # scipy.ndimage, only needed here
+		mesh = background.BackgroundMesh(img_data_raw, box=back_box, sig_fract=sig_fract, percent_fract=percent_fract, workers=1)
+		return img_data_raw - mesh.tile((0, img_data_raw.shape[0], 0, img_data_raw.shape[1])).astype(img_data_raw.dtype)
+	# sky, num_iter = img_scale.sky_median_sig_clip(img_data, sig_fract, percent_fract, max_iter=100)
+	sky, num_iter = img_scale.sky_mean_sig_clip(img_data_raw, sig_fract, percent_fract, max_iter=10)
+	# print("sky = ", sky, '(', num_iter, ')')
+	return img_data_raw - sky
+
+def img_scale_getfig(fn, sig_fract, percent_fract, mode, min_val=None, dtype=float, norm=None):
 	"""Get pixel data from .fits file, scale it, turn it into a pyplot image.
 	
 	@type fn: string
@@ -114,12 +204,39 @@ def img_scale_getfig(fn, sig_fract, percent_fract, mode, min_val=None):
 	@param mode: method of scaling
 	@type min_val: float
 	@param min_val: minimum data value
+	@type dtype: numpy dtype
+	@param dtype: floating point precision of the pixel data, float or numpy.float32
+	@type norm: survey_norm.SurveyNorm
+	@param norm: scale with the frozen range (and CDF, for histeq) of the whole sample instead of those of the image
 	@rtype: numpy array
 	@return: image data array
 	
 	"""
-	(img_data, img_data_raw, width, height) = get_fits_data(fn, sig_fract, percent_fract)
+	(img_data, img_data_raw, width, height) = get_fits_data(fn, sig_fract, percent_fract, dtype=dtype)
+	
+	return scale_data(img_data, img_data_raw, mode, min_val=min_val, norm=norm, filt=path_to_info(fn, '')[2])
+
+def scale_data(img_data, img_data_raw, mode, min_val=None, norm=None, filt=None):
+	"""Scale pixel data which has already been loaded by get_fits_data().
 	
+	@type img_data: numpy array
+	@param img_data: raw pixel data minus sky value
+	@type img_data_raw: numpy array
+	@param img_data_raw: raw pixel data array
+	@type mode: string
+	@param mode: method of scaling
+	@type min_val: float
+	@param min_val: minimum data value
+	@type norm: survey_norm.SurveyNorm
+	@param norm: scale with the frozen range (and CDF, for histeq) of the whole sample instead of those of the image
+	@type filt: string
+	@param filt: filter of the data, for norm
+	@rtype: numpy array
+	@return: image data array
+	
+	"""
+	if norm is not None:
+		return norm.scale(img_data, img_data_raw, filt, mode, min_val=min_val)
 	if mode == 'sqrt':
 		new_img = img_scale.sqrt(img_data, scale_min = min_val)
 	elif mode == 'power':
@@ -141,7 +258,42 @@ def img_scale_getfig(fn, sig_fract, percent_fract, mode, min_val=None):
 
 	return new_img
 
-def img_scale_savefig(new_img, fn, filt, folder_fn, mode, color=pylab.cm.hot, size_inches=3.4, dpi=300):
+# scale_data() modes as img_scale.stretch_batch() calls: (mode, parameters, scales the raw data, uses min_val)
+batch_modes = {'sqrt': ('sqrt', {}, False, True),
+		'power': ('power', {'power_index': 3.0}, False, True),
+		'log': ('log', {'exponent': 1000}, True, True),
+		'linear': ('linear', {}, False, True),
+		'asinh_beta_01': ('asinh', {'non_linear': 0.01}, False, True),
+		'asinh_beta_05': ('asinh', {'non_linear': 0.5}, False, True),
+		'asinh_beta_20': ('asinh', {'non_linear': 2.0}, False, True),
+		'histeq': ('histeq', {'num_bins': 256}, True, False),
+		'logistic': ('logistic', {'center': 0.03, 'slope': 0.3}, True, False),}
+
+def scale_data_batch(img_data, img_data_raw, mode, min_val=None, norm=None, filt=None):
+	"""Scale a stack of images at once, the same as scale_data() on each of them.
+	
+	@type img_data: numpy array
+	@param img_data: (images, width, height) raw pixel data minus sky value (not used by the modes which scale the raw data)
+	@type img_data_raw: numpy array
+	@param img_data_raw: (images, width, height) raw pixel data array
+	@type mode: string
+	@param mode: method of scaling
+	@type min_val: float
+	@param min_val: minimum data value
+	@type norm: survey_norm.SurveyNorm
+	@param norm: scale with the frozen range (and CDF, for histeq) of the whole sample instead of those of the image
+	@type filt: string
+	@param filt: filter of the data, for norm
+	@rtype: numpy array
+	@return: (images, width, height) image data array
+	
+	"""
+	if norm is not None:
+		return norm.scale(img_data, img_data_raw, filt, mode, min_val=min_val)
+	func_name, params, raw, uses_min_val = batch_modes.get(mode, batch_modes['linear'])
+	return img_scale.stretch_batch(img_data_raw if raw else img_data, func_name, scale_min=min_val if uses_min_val else None, **params)
+
+def img_scale_savefig(new_img, fn, filt, folder_fn, mode, color='hot', size_inches=3.4, dpi=300, vmax=None):
 	"""Save a .png image of the numpy pixel data from img_scale_getfig().
 	
 	@type new_img: numpy array
@@ -154,16 +306,19 @@ def img_scale_savefig(new_img, fn, filt, folder_fn, mode, color=pylab.cm.hot, si
 	@param folder_fn: sample folder name string
 	@type mode: string
 	@param mode: method of scaling
-	@type color: matplotlib colormap
+	@type color: matplotlib colormap or colormap name
 	@param color: colormap to use for saved image
 	@type size_inches: float
 	@param size_inches: size of output image
 	@type dpi: integer
 	@param dpi: dots per inch of output image
+	@type vmax: float
+	@param vmax: value drawn at the top of the colormap (0 at the bottom), e.g. 1 for a survey normalization; each image's own range if None
 	@rtype: None
 	@return: saves a pyplot figure as .png
 	
 	"""
+	import pylab  # deferred: it is the slowest import, and only needed to draw
 	fig = pylab.gcf()
 	fig.set_size_inches(size_inches, size_inches)
 	
@@ -172,13 +327,13 @@ def img_scale_savefig(new_img, fn, filt, folder_fn, mode, color=pylab.cm.hot, si
 	if not os.path.exists(out_path):
 		os.makedirs(out_path)
 	
-	pylab.imshow(new_img, interpolation='nearest', origin='lower', cmap=color)
+	pylab.imshow(new_img, interpolation='nearest', origin='lower', cmap=color, vmin=None if vmax is None else 0.0, vmax=vmax)
 	pylab.axis('off')
 	pylab.tight_layout()
 	pylab.savefig(out_path + '/' + fn + '_' + mode + '.png', dpi=(dpi))
 	pylab.clf()
 
-def img_scale_collage(fn_list, sig_fract, percent_fract, min_val, filters, mode, folder_fn, color=pylab.cm.hot, size_inches=3.4, dpi=300, restframe=None):
+def img_scale_collage(fn_list, sig_fract, percent_fract, min_val, filters, mode, folder_fn, color='hot', size_inches=3.4, dpi=300, restframe=None, dtype=float):
 	"""Save a collage .png image of the fits data for each filter..
 	
 	@type fn: list
@@ -195,53 +350,87 @@ def img_scale_collage(fn_list, sig_fract, percent_fract, min_val, filters, mode,
 	@param mode: method of scaling
 	@type folder_fn: string
 	@param folder_fn: name of folder which contains filter folders with desired data
-	@type color: matplotlib colormap
+	@type color: matplotlib colormap or colormap name
 	@param color: colormap to use for saved image
 	@type size_inches: float
 	@param size_inches: size of output image
 	@type dpi: integer
 	@param dpi: dots per inch of output image
+	@type dtype: numpy dtype
+	@param dtype: floating point precision of the pixel data, float or numpy.float32
 	@rtype: None
 	@return: saves a pyplot figure as .png
 	
 	"""
+	images = [img_scale_getfig(fn, sig_fract, percent_fract, mode, min_val = min_val, dtype=dtype) for fn in fn_list]
+	
+	r = fn_list[6]
+	g = fn_list[4]
+	b = fn_list[1]
+	
+	rgb_array = get_rgb((r,g,b), min_val=min_val, dtype=dtype)
+	
+	draw_collage(images, rgb_array, filters, 'ceers_' + fits_id(fn_list[0]), folder_fn + '_collage/' + mode, 'ceers_' + fits_id(fn_list[0]) + '_' + mode + '.png', color=color, size_inches=size_inches, dpi=dpi, restframe=restframe)
+
+def draw_collage(images, rgb_array, filters, title, out_path, out_name, color='hot', size_inches=3.4, dpi=300, restframe=None, vmax=None):
+	"""Draw and save the 3x3 collage of img_scale_collage(): each filter, RGB, and the rest frame filter.
+	
+	@type images: list
+	@param images: list of scaled image data arrays, one per filter
+	@type rgb_array: numpy array
+	@param rgb_array: RGB array from get_rgb()
+	@type filters: list
+	@param filters: list of filter name strings
+	@type title: string
+	@param title: title of the collage
+	@type out_path: string
+	@param out_path: folder to save the collage in, made if it doesn't exist
+	@type out_name: string
+	@param out_name: file name of the collage
+	@type color: matplotlib colormap or colormap name
+	@param color: colormap to use for saved image
+	@type size_inches: float
+	@param size_inches: size of output image
+	@type dpi: integer
+	@param dpi: dots per inch of output image
+	@type restframe: string
+	@param restframe: rest frame filter, drawn again in the last panel
+	@type vmax: float
+	@param vmax: value drawn at the top of the colormap (0 at the bottom), e.g. 1 for a survey normalization; each image's own range if None
+	@rtype: string
+	@return: path of the saved .png
+	
+	"""
+	import pylab
 	fig, ((ax1, ax2, ax3), (ax4, ax5, ax6), (ax7, ax8, ax9)) = pylab.subplots(3, 3)
 	fig.set_size_inches(size_inches, size_inches)
 	
 	axes = [ax1, ax2, ax3, ax4, ax5, ax6, ax7, ax8, ax9]
+	vmin = None if vmax is None else 0.0
 	
-	for i, fn in enumerate(fn_list):
-		new_img = img_scale_getfig(fn, sig_fract, percent_fract, mode, min_val = min_val)
-		
+	for i, new_img in enumerate(images):
 		axes[i].set_title(str(i + 1) + ') ' + filters[i])
 		axes[i].axis('off')
-		axes[i].imshow(new_img, interpolation='nearest', origin='lower', cmap=color)
+		axes[i].imshow(new_img, interpolation='nearest', origin='lower', cmap=color, vmin=vmin, vmax=vmax)
 		
 		if restframe == filters[i]:
 			axes[8].set_title('Rest Frame) ' + filters[i])
 			axes[8].axis('off')
-			axes[8].imshow(new_img, interpolation='nearest', origin='lower', cmap=color)
-			
-	r = fn_list[6]
-	g = fn_list[4]
-	b = fn_list[1]
-	
-	rgb_array = get_rgb((r,g,b), min_val=min_val)
+			axes[8].imshow(new_img, interpolation='nearest', origin='lower', cmap=color, vmin=vmin, vmax=vmax)
 	
 	axes[7].set_title('RGB')
 	axes[7].axis('off')
 	axes[7].imshow(rgb_array, interpolation='nearest', origin='lower')
 	
-	out_path = folder_fn + '_collage/' + mode
-	
 	if not os.path.exists(out_path):
 		os.makedirs(out_path)
 	
-	pylab.suptitle('ceers_' + fn_list[0][-10:-5])
-	pylab.savefig(out_path + '/ceers_' + fn_list[0][-10:-5] + '_' + mode + '.png', dpi=(dpi))
+	pylab.suptitle(title)
+	pylab.savefig(out_path + '/' + out_name, dpi=(dpi))
 	pylab.close('all')
+	return out_path + '/' + out_name
 
-def get_rgb(channel_list, sig_fract=3.0, percent_fract=5.0-4, min_val=None, color_balance=(1,1,1)):
+def get_rgb(channel_list, sig_fract=3.0, percent_fract=5.0-4, min_val=None, color_balance=(1,1,1), dtype=float, register=False, psf_match=False):
 	"""Get RGB Image Data from 3 Channels
 	
 	@type channel_list: list
@@ -254,31 +443,145 @@ def get_rgb(channel_list, sig_fract=3.0, percent_fract=5.0-4, min_val=None, colo
 	@param min_val: minimum data value
 	@type color_balance: tuple
 	@param color_balance: scaling factor for each channel
+	@type dtype: numpy dtype
+	@param dtype: floating point precision of the pixel data, float or numpy.float32
+	@type register: boolean
+	@param register: shift G and B onto R by their sub-pixel offsets (see registration.py) before combining
+	@type psf_match: boolean
+	@param psf_match: convolve the channels to the broadest PSF among them (see psfmatch.py) before combining; the filters are read from the file names
 	@rtype: numpy array
 	@return: RGB array ready for insertion into a matplotlib figure
 	
 	"""
-	img_data_r = get_fits_data(channel_list[0], sig_fract, percent_fract)
-	img_data_g = get_fits_data(channel_list[1], sig_fract, percent_fract)
-	img_data_b = get_fits_data(channel_list[2], sig_fract, percent_fract)
+	channel_data = load_galaxy(channel_list, sig_fract, percent_fract, dtype=dtype)
+	if register:
+		channel_data, shifts = registration.align_galaxy(channel_data, reference=0, max_shift=3)
+	if psf_match:
+		channel_data = psfmatch.match_galaxy(channel_data, [psfmatch.filter_of(fn) for fn in channel_list])
+	
+	rgb_array = get_rgb_batch(channel_data, [color_balance], min_val=min_val)[0]
+	
+	return rgb_array
+
+def align_and_match(raw, filter_list, reference=None, psf_target=None, max_shift=3):
+	"""Register the filters of one sample to one of them (see registration.py), then convolve them to one PSF (see
+	psfmatch.py), before the sky is subtracted; the order of get_rgb(register=True, psf_match=True).
 	
-	rgb_array = numpy.empty((img_data_r[2],img_data_r[3],3), dtype=float)
+	@type raw: numpy array
+	@param raw: (filters, width, height) raw pixel data
+	@type filter_list: list
+	@param filter_list: list of filter name strings, one per image of raw
+	@type reference: integer
+	@param reference: index of the filter the others are registered to, or None not to register them
+	@type psf_target: string
+	@param psf_target: filter whose PSF the others are convolved to, or None not to match them
+	@type max_shift: float
+	@param max_shift: largest shift (pixels) searched for along each axis
+	@rtype: tuple
+	@return: (stack, (filters, 2) shifts (dy, dx) applied to each filter, or None if not registered)
 	
-	r = img_scale.asinh(img_data_r[0] * color_balance[0], scale_min = min_val, non_linear=0.005)
-	g = img_scale.asinh(img_data_g[0] * color_balance[1], scale_min = min_val, non_linear=0.005)
-	b = img_scale.asinh(img_data_b[0] * color_balance[2], scale_min = min_val, non_linear=0.005)
 	"""
-	r = img_scale.log(img_data_r[0] * color_balance[0], scale_min = min_val)
-	g = img_scale.log(img_data_g[0] * color_balance[1], scale_min = min_val)
-	b = img_scale.log(img_data_b[0] * color_balance[2], scale_min = min_val)
+	shifts = None
+	if reference is not None:
+		# Measured with the sky level (roughly, the median) taken off, which the window would otherwise turn into a
+		# bright blob that pulls every shift towards 0
+		level = numpy.median(raw, axis=(1, 2))[:, None, None]
+		offsets = registration.Registration(raw[reference] - level[reference], max_shift=max_shift).estimate(raw - level)
+		offsets[reference] = 0
+		shifts = -offsets
+		raw = registration.shift_stack(raw, shifts)
+	if psf_target is not None:
+		raw = psfmatch.match_stack(raw, filter_list, psf_target, pad=psfmatch.common_margin(psf_target))
+	return (raw, shifts)
+
+def get_rgb_batch(channel_data, color_balances, min_val=None, non_linear=0.005):
+	"""Get RGB Image Data for several color balances from 3 already loaded channels
+	
+	@type channel_data: list
+	@param channel_data: (img_data, img_data_raw, width, height) tuples from get_fits_data() for R, G and B
+	@type color_balances: list
+	@param color_balances: list of (R, G, B) scaling factor tuples
+	@type min_val: float
+	@param min_val: minimum data value
+	@type non_linear: float or numpy array
+	@param non_linear: asinh non-linearity factor, or one per color balance with shape (len(color_balances), 1)
+	@rtype: numpy array
+	@return: (len(color_balances), width, height, 3) array of RGB images
+	
 	"""
-	rgb_array[:,:,0] = r
-	rgb_array[:,:,1] = g
-	rgb_array[:,:,2] = b
+	data = numpy.stack([channel[0] for channel in channel_data])
+	balances = numpy.asarray(color_balances, dtype=data.dtype).reshape(-1, 3)
 	
-	return rgb_array
+	rgb_arrays = img_scale.stretch_batch(data * balances[:, :, None, None], 'asinh', scale_min=min_val, non_linear=non_linear)
+	
+	return numpy.moveaxis(rgb_arrays, 1, -1)
+
+def run_summary(f_ids):
+	"""Empty summary of a bulk run, which the save_*_bulk() functions fill in and return.
+	
+	@type f_ids: list
+	@param f_ids: list of the sample ID strings of the run
+	@rtype: dictionary
+	@return: samples (the IDs), rendered (ID: seconds spent on it), rejected (IDs the quality gate dropped), failed
+	(ID: the error reading or rendering it raised), outputs (paths of the saved images), warnings (ID: messages),
+	read_wait and seconds (wall time of the run)
+	
+	"""
+	return {'samples': list(f_ids), 'rendered': {}, 'rejected': [], 'failed': {}, 'outputs': [], 'warnings': {}, 'read_wait': 0.0, 'seconds': 0.0}
+
+class GalaxiesFailed(RuntimeError):
+	"""Raised by the save_*_bulk() functions at the end of a run in which some galaxies failed; the others were rendered."""
+
+	def __init__(self, summary):
+		"""
+		@type summary: dictionary
+		@param summary: summary of the whole run (see run_summary())
+
+		"""
+		RuntimeError.__init__(self, '%d of %d samples failed: %s' % (len(summary['failed']), len(summary['samples']), ', '.join(sorted(summary['failed']))))
+		self.summary = summary
 
-def save_collage_bulk(folder_fn, mode_list, filter_list, sig_fract, percent_fract, restframes, color=pylab.cm.hot, size_inches=3.4, dpi=300):
+def galaxy_failed(summary, f_id, error, telemetry=None):
+	"""Record a sample whose read or rendering raised, so the run can go on with the next one.
+	
+	@type summary: dictionary
+	@param summary: summary of the run (see run_summary())
+	@type f_id: string
+	@param f_id: ID of the sample
+	@type error: Exception
+	@param error: what it raised
+	@type telemetry: telemetry.Telemetry
+	@param telemetry: counts it in galaxies_failed_total
+	@rtype: None
+	
+	"""
+	import traceback
+	print('Sample ' + f_id + ' failed:')
+	traceback.print_exception(type(error), error, error.__traceback__)
+	summary['failed'][f_id] = repr(error)
+	if telemetry is not None:
+		telemetry.inc('galaxies_failed_total')
+
+def finish_run(summary, start, stats):
+	"""Fill in the timing of a bulk run, and raise GalaxiesFailed if any of its samples failed.
+	
+	@type summary: dictionary
+	@param summary: summary of the run (see run_summary())
+	@type start: float
+	@param start: time.perf_counter() when the run started
+	@type stats: dictionary
+	@param stats: read ahead statistics of the run (see prefetch.GalaxyPrefetcher.stats())
+	@rtype: dictionary
+	@return: summary
+	
+	"""
+	summary['read_wait'] = stats['stall_time']
+	summary['seconds'] = time.perf_counter() - start
+	if summary['failed']:
+		raise GalaxiesFailed(summary)
+	return summary
+
+def save_collage_bulk(folder_fn, mode_list, filter_list, sig_fract, percent_fract, restframes, color='hot', size_inches=3.4, dpi=300, dtype=float, gate=True, prefetch_depth=4, f_ids=None, report='rejected.csv', telemetry=None, norm=None, back_box=None, register=False, psf_match=False):
 	"""Get all .fits files in a given folder
 	
 	@type folder_fn: 
@@ -293,49 +596,108 @@ def save_collage_bulk(folder_fn, mode_list, filter_list, sig_fract, percent_frac
 	@param percent_fract: convergence fraction
 	@type restframes: dictionary
 	@param restframes: dictionary where the key is the ID of a particular sample, and the value is the rest frame filter
-	@type color: matplotlib colormap
+	@type color: matplotlib colormap or colormap name
 	@param color: colormap to use for saved image
 	@type size_inches: float
 	@param size_inches: size of output image
 	@type dpi: integer
 	@param dpi: dots per inch of output image
-	@rtype: None
-	@return: saves a pyplot figure as .png
+	@type dtype: numpy dtype
+	@param dtype: floating point precision of the pixel data, float or numpy.float32
+	@type gate: boolean
+	@param gate: skip the samples which fail the quality gate (quality.py), judged on the data read to render them
+	@type prefetch_depth: integer
+	@param prefetch_depth: samples read ahead on background threads (see prefetch.py)
+	@type f_ids: list
+	@param f_ids: list of the sample ID strings to render, e.g. a shard (see shard.py); every sample of the folder if None
+	@type report: string
+	@param report: name of the quality gate report in the output folder
+	@type telemetry: telemetry.Telemetry
+	@param telemetry: publish the progress, stage latencies and queue depths of the run to it (see telemetry.py)
+	@type norm: survey_norm.SurveyNorm
+	@param norm: scale with the frozen range (and CDF, for histeq) of the whole sample instead of those of the image
+	@type back_box: integer
+	@param back_box: subtract from the filters and the RGB channels a background varying across the image, measured in boxes of this size (see subtract_sky()), instead of one sky value
+	@type register: boolean
+	@param register: shift every filter onto the R channel of the RGB image (the 7th filter) by its sub-pixel offset (see
+	registration.py) before it is scaled and composed, in the reading threads
+	@type psf_match: boolean
+	@param psf_match: convolve every filter to the broadest PSF of filter_list (see psfmatch.py) before it is scaled and
+	composed, in one batched pass over each galaxy's stack of filters, in the reading threads
+	@rtype: dictionary
+	@return: saves a pyplot figure as .png; returns the summary of the run (see run_summary()), or raises GalaxiesFailed
+	with it at the end if any sample failed
 	
 	"""
 	
-	# Getting the current work directory (cwd)
-	thisdir = os.getcwd()
-	fn_list = []
-
-	# r=root, d=directories, f = files
-	for r, d, f in os.walk(thisdir):
-		for file in f:
-			if file.endswith(".fits") and (folder_fn in r):
-				if path_to_info(os.path.join(r, file), folder_fn) not in fn_list:
-					fn_list.append(path_to_info(os.path.join(r, file), folder_fn))
-	
-	file_ids_unique = []
-	for i in fn_list:
-		if i[1][-5:] not in file_ids_unique:
-			file_ids_unique.append(i[1][-5:])
+	# The samples with a file in any of the filter folders (see catalog.py)
+	start = time.perf_counter()
+	import catalog
+	file_ids_unique = catalog.load_catalog(folder_fn, filter_list).with_files().ids() if f_ids is None else list(f_ids)
+	summary = run_summary(file_ids_unique)
+	if telemetry is not None:
+		telemetry.set('galaxies_total', len(summary['samples']))
 	
+	# One galaxy at a time, through a dataflow.Graph, so what the modes share (the data, the sky, the RGB image) is computed once
+	# The next galaxies are read on background threads meanwhile, and judged by the quality gate on the data read there;
+	# the sky is left to this thread, where its warnings are caught
+	import dataflow
+	import prefetch
+	graph = dataflow.Graph(telemetry=telemetry)
+	psf_target = psfmatch.broadest(filter_list) if psf_match else None
+	galaxies = prefetch.iter_galaxies(folder_fn, file_ids_unique, filter_list, depth=prefetch_depth, dtype=dtype, sky=False, gate=gate, register=6 if register else None, psf_target=psf_target, failures=True, telemetry=telemetry)
+	if telemetry is not None:
+		telemetry.gauge('memo_bytes', lambda: graph.nbytes)
+	rejected = {}
+	from alive_progress import alive_bar
 	with alive_bar(len(file_ids_unique) * len(mode_list), title='Total Progress') as bar:
-		for index, mode in enumerate(mode_list):
-			print('Processing: ' + mode)
-			for f_id in file_ids_unique:
-				with warnings.catch_warnings(record=True) as caught_warnings:
-					files = []
-					for filt in filter_list:
-						files.append(folder_fn + '/' + filt + '/ceers_' + filt + '_' + f_id + '.fits')
-					img_scale_collage(files, sig_fract, percent_fract, 0.0, filter_list, mode, folder_fn, color=color, size_inches=size_inches, dpi=dpi, restframe=restframes[f_id])
-					if caught_warnings:
-						print('Something happened on sample ' + f_id)
-						for warn in caught_warnings:
-							print(f"{warn.message}")
-				bar()
-
-def collage_rgb_comparison(fn_list, sig_fract, percent_fract, min_val, filters, mode, folder_name, color=pylab.cm.hot, size_inches=3.4, dpi=300, restframe=None):
+		for galaxy in galaxies:
+			if galaxy.error is not None:
+				galaxy_failed(summary, galaxy.f_id, galaxy.error, telemetry)
+				bar(len(mode_list), skipped=True)
+				continue
+			if galaxy.rejected is not None:
+				rejected[galaxy.f_id] = galaxy.rejected
+				if telemetry is not None:
+					telemetry.inc('galaxies_rejected_total')
+				bar(len(mode_list), skipped=True)
+				continue
+			galaxy_start = time.perf_counter()
+			f_id = galaxy.f_id
+			files = galaxy.files
+			shifts = [None] * len(files) if galaxy.shifts is None else galaxy.shifts
+			for fn, raw, shift in zip(files, galaxy.raw, shifts):
+				graph.put(dataflow.load(fn, dtype, psf_target, shift), raw)
+			# A sample which raises is recorded and skipped, and the run goes on (see finish_run())
+			done = 0
+			try:
+				for mode in mode_list:
+					with warnings.catch_warnings(record=True) as caught_warnings:
+						summary['outputs'].append(graph.get(dataflow.collage(files, sig_fract, percent_fract, 0.0, filter_list, mode, folder_fn, color=color, size_inches=size_inches, dpi=dpi, restframe=restframes[f_id], dtype=dtype, norm=norm, back_box=back_box, psf_target=psf_target, shifts=shifts)))
+						if caught_warnings:
+							print('Something happened on sample ' + f_id + ' (' + mode + ')')
+							for warn in caught_warnings:
+								print(f"{warn.message}")
+							summary['warnings'].setdefault(f_id, []).extend([mode + ': ' + str(warn.message) for warn in caught_warnings])
+					if telemetry is not None:
+						telemetry.inc('images_total')
+					bar()
+					done += 1
+			except Exception as error:
+				galaxy_failed(summary, f_id, error, telemetry)
+				bar(len(mode_list) - done, skipped=True)
+				continue
+			summary['rendered'][f_id] = time.perf_counter() - galaxy_start
+			if telemetry is not None:
+				telemetry.observe('galaxy_seconds', summary['rendered'][f_id])
+				telemetry.inc('galaxies_done_total')
+	report_rejected(folder_fn + '_collage', rejected, len(file_ids_unique), filter_list, report=report)
+	stats = galaxies.stats()
+	print('Waited %.1f s for reads (%d of %d samples), mean read ahead %.1f' % (stats['stall_time'], stats['stalls'], stats['galaxies'], stats['mean_depth']))
+	summary['rejected'] = sorted(rejected)
+	return finish_run(summary, start, stats)
+
+def collage_rgb_comparison(fn_list, sig_fract, percent_fract, min_val, filters, mode, folder_name, color='hot', size_inches=3.4, dpi=300, restframe=None, dtype=float, norm=None, channel_data=None, back_box=None):
 	"""Save a collage .png image of the fits data for each filter..
 	
 	@type fn: list
@@ -352,16 +714,25 @@ def collage_rgb_comparison(fn_list, sig_fract, percent_fract, min_val, filters,
 	@param mode: method of scaling
 	@type folder_name: string
 	@param folder_name: name of folder which contains filter folders with desired data
-	@type color: matplotlib colormap
+	@type color: matplotlib colormap or colormap name
 	@param color: colormap to use for saved image
 	@type size_inches: float
 	@param size_inches: size of output image
 	@type dpi: integer
 	@param dpi: dots per inch of output image
+	@type dtype: numpy dtype
+	@param dtype: floating point precision of the pixel data, float or numpy.float32
+	@type norm: survey_norm.SurveyNorm
+	@param norm: scale the channels with the frozen range of the whole sample instead of those of the image
+	@type channel_data: list
+	@param channel_data: the R, G and B files (fn_list[6], [4] and [1]) as load_galaxy() returns them, if already read
+	@type back_box: integer
+	@param back_box: subtract from the channels a background varying across the image, measured in boxes of this size (see subtract_sky()), instead of one sky value
 	@rtype: None
 	@return: saves a pyplot figure as .png
 	
 	"""
+	import pylab
 	fig, ((ax1, ax2, ax3), (ax4, ax5, ax6)) = pylab.subplots(2, 3)
 	fig.set_size_inches(size_inches, size_inches)
 	
@@ -375,27 +746,32 @@ def collage_rgb_comparison(fn_list, sig_fract, percent_fract, min_val, filters,
 	cb2 = (1,1.5,3)
 	cb3 = (1,3,5)
 	
-	rChannel = img_scale_getfig(r, sig_fract, percent_fract, mode, min_val = min_val)
-	gChannel = img_scale_getfig(g, sig_fract, percent_fract, mode, min_val = min_val)
-	bChannel = img_scale_getfig(b, sig_fract, percent_fract, mode, min_val = min_val)
+	if channel_data is None:
+		channel_data = load_galaxy((r,g,b), sig_fract, percent_fract, dtype=dtype, back_box=back_box)
+	
+	rChannel = scale_data(channel_data[0][0], channel_data[0][1], mode, min_val = min_val, norm=norm, filt=filters[6])
+	gChannel = scale_data(channel_data[1][0], channel_data[1][1], mode, min_val = min_val, norm=norm, filt=filters[4])
+	bChannel = scale_data(channel_data[2][0], channel_data[2][1], mode, min_val = min_val, norm=norm, filt=filters[1])
 	
-	rgb_array1 = get_rgb((r,g,b), min_val=min_val, color_balance=cb1)
-	rgb_array2 = get_rgb((r,g,b), min_val=min_val, color_balance=cb2)
-	rgb_array3 = get_rgb((r,g,b), min_val=min_val, color_balance=cb3)
+	# get_rgb() clips the sky with its own default fractions
+	rgb_data = [(subtract_sky(raw, 3.0, 5.0-4, back_box=back_box), raw, width, height) for (data, raw, width, height) in channel_data]
+	rgb_array1, rgb_array2, rgb_array3 = get_rgb_batch(rgb_data, (cb1, cb2, cb3), min_val=min_val)
 	
 	fs = 7
+	# A survey normalization is frozen: draw 0 to 1, not each channel's own range
+	vmin, vmax = (None, None) if norm is None else (0.0, 1.0)
 	
 	axes[0].set_title('Red: f444w', fontsize=fs)
 	axes[0].axis('off')
-	axes[0].imshow(rChannel, interpolation='nearest', origin='lower', cmap=color)
+	axes[0].imshow(rChannel, interpolation='nearest', origin='lower', cmap=color, vmin=vmin, vmax=vmax)
 	
 	axes[1].set_title('Green: f356w', fontsize=fs)
 	axes[1].axis('off')
-	axes[1].imshow(gChannel, interpolation='nearest', origin='lower', cmap=color)
+	axes[1].imshow(gChannel, interpolation='nearest', origin='lower', cmap=color, vmin=vmin, vmax=vmax)
 	
 	axes[2].set_title('Blue: f150w', fontsize=fs)
 	axes[2].axis('off')
-	axes[2].imshow(bChannel, interpolation='nearest', origin='lower', cmap=color)
+	axes[2].imshow(bChannel, interpolation='nearest', origin='lower', cmap=color, vmin=vmin, vmax=vmax)
 	
 	axes[3].set_title(str(cb1), fontsize=fs)
 	axes[3].axis('off')
@@ -409,11 +785,11 @@ def collage_rgb_comparison(fn_list, sig_fract, percent_fract, min_val, filters,
 	axes[5].axis('off')
 	axes[5].imshow(rgb_array3, interpolation='nearest', origin='lower')
 	
-	pylab.suptitle('ceers_' + fn_list[0][-10:-5])
-	pylab.savefig(folder_name + '_RGBComp/' + mode + '/ceers_' + fn_list[0][-10:-5] + '_' + mode + '.png', dpi=(dpi))
+	pylab.suptitle('ceers_' + fits_id(fn_list[0]))
+	pylab.savefig(folder_name + '_RGBComp/' + mode + '/ceers_' + fits_id(fn_list[0]) + '_' + mode + '.png', dpi=(dpi))
 	pylab.close('all')
 
-def save_comparison_bulk(folder_fn, mode_list, filter_list, sig_fract, percent_fract, restframes, color=pylab.cm.hot, size_inches=3.4, dpi=300):
+def save_comparison_bulk(folder_fn, mode_list, filter_list, sig_fract, percent_fract, restframes, color='hot', size_inches=3.4, dpi=300, dtype=float, gate=True, f_ids=None, report='rejected.csv', telemetry=None, norm=None, back_box=None, register=False, psf_match=False):
 	"""Get all .fits files in a given folder
 	
 	@type folder_fn: 
@@ -428,49 +804,297 @@ def save_comparison_bulk(folder_fn, mode_list, filter_list, sig_fract, percent_f
 	@param percent_fract: convergence fraction
 	@type restframes: dictionary
 	@param restframes: dictionary where the key is the ID of a particular sample, and the value is the rest frame filter
-	@type color: matplotlib colormap
+	@type color: matplotlib colormap or colormap name
 	@param color: colormap to use for saved image
 	@type size_inches: float
 	@param size_inches: size of output image
 	@type dpi: integer
 	@param dpi: dots per inch of output image
-	@rtype: None
-	@return: saves a pyplot figure as .png
+	@type dtype: numpy dtype
+	@param dtype: floating point precision of the pixel data, float or numpy.float32
+	@type gate: boolean
+	@param gate: skip the samples which fail the quality gate (quality.py), judged on the data read to render them
+	@type f_ids: list
+	@param f_ids: list of the sample ID strings to render, e.g. a shard (see shard.py); every sample of the folder if None
+	@type report: string
+	@param report: name of the quality gate report in the output folder
+	@type telemetry: telemetry.Telemetry
+	@param telemetry: publish the progress, stage latencies and queue depths of the run to it (see telemetry.py)
+	@type norm: survey_norm.SurveyNorm
+	@param norm: scale with the frozen range (and CDF, for histeq) of the whole sample instead of those of the image
+	@type back_box: integer
+	@param back_box: subtract from the filters and the RGB channels a background varying across the image, measured in boxes of this size (see subtract_sky()), instead of one sky value
+	@type register: boolean
+	@param register: shift the filters read onto the R channel of the RGB image (the 7th filter) by their sub-pixel offsets
+	(see registration.py) before they are composed, in the reading threads
+	@type psf_match: boolean
+	@param psf_match: convolve every filter to the broadest PSF of filter_list (see psfmatch.py) before it is scaled and
+	composed, in one batched pass over each galaxy's stack of filters, in the reading threads
+	@rtype: dictionary
+	@return: saves a pyplot figure as .png; returns the summary of the run (see run_summary()), or raises GalaxiesFailed
+	with it at the end if any sample failed
 	
 	"""
 	
-	# Getting the current work directory (cwd)
-	thisdir = os.getcwd()
-	fn_list = []
+	# The samples with a file in any of the filter folders (see catalog.py)
+	start = time.perf_counter()
+	import catalog
+	file_ids_unique = catalog.load_catalog(folder_fn, filter_list).with_files().ids() if f_ids is None else list(f_ids)
+	summary = run_summary(file_ids_unique)
+	if telemetry is not None:
+		telemetry.set('galaxies_total', len(summary['samples']))
+	
+	# One galaxy at a time, read ahead once for every mode; with the gate, every filter is read and judged (in the
+	# reading threads), otherwise only the R, G and B filters
+	import prefetch
+	channels = [6, 4, 1] if gate else [0, 1, 2]
+	read_filters = filter_list if gate else [filter_list[i] for i in (6, 4, 1)]
+	# PSF matched to the broadest filter of the whole filter list, whichever filters are read
+	psf_target = psfmatch.broadest(filter_list) if psf_match else None
+	galaxies = prefetch.iter_galaxies(folder_fn, file_ids_unique, read_filters, dtype=dtype, sky=False, gate=gate, register=channels[0] if register else None, psf_target=psf_target, failures=True, telemetry=telemetry)
+	rejected = {}
+	from alive_progress import alive_bar
+	with alive_bar(len(file_ids_unique) * len(mode_list), title='Total Progress') as bar:
+		for galaxy in galaxies:
+			f_id = galaxy.f_id
+			if galaxy.error is not None:
+				galaxy_failed(summary, f_id, galaxy.error, telemetry)
+				bar(len(mode_list), skipped=True)
+				continue
+			if galaxy.rejected is not None:
+				rejected[f_id] = galaxy.rejected
+				if telemetry is not None:
+					telemetry.inc('galaxies_rejected_total')
+				bar(len(mode_list), skipped=True)
+				continue
+			galaxy_start = time.perf_counter()
+			files = galaxy_files(folder_fn, f_id, filter_list)
+			# A sample which raises is recorded and skipped, and the run goes on (see finish_run())
+			done = 0
+			try:
+				channel_data = [(subtract_sky(galaxy.raw[i], sig_fract, percent_fract, back_box=back_box), galaxy.raw[i], galaxy.raw.shape[1], galaxy.raw.shape[2]) for i in channels]
+				for mode in mode_list:
+					mode_start = time.perf_counter()
+					collage_rgb_comparison(files, sig_fract, percent_fract, 0.0, filter_list, mode, folder_fn, color=color, size_inches=size_inches, dpi=dpi, restframe=restframes[f_id], dtype=dtype, norm=norm, channel_data=channel_data, back_box=back_box)
+					summary['outputs'].append(folder_fn + '_RGBComp/' + mode + '/ceers_' + f_id + '_' + mode + '.png')
+					if telemetry is not None:
+						telemetry.observe('stage_seconds', time.perf_counter() - mode_start, stage='comparison')
+						telemetry.inc('images_total')
+					bar()
+					done += 1
+			except Exception as error:
+				galaxy_failed(summary, f_id, error, telemetry)
+				bar(len(mode_list) - done, skipped=True)
+				continue
+			summary['rendered'][f_id] = time.perf_counter() - galaxy_start
+			if telemetry is not None:
+				telemetry.observe('galaxy_seconds', summary['rendered'][f_id])
+				telemetry.inc('galaxies_done_total')
+	report_rejected(folder_fn + '_RGBComp', rejected, len(file_ids_unique), filter_list, report=report)
+	stats = galaxies.stats()
+	summary['rejected'] = sorted(rejected)
+	return finish_run(summary, start, stats)
 
-	# r=root, d=directories, f = files
-	for r, d, f in os.walk(thisdir):
-		for file in f:
-			if file.endswith(".fits"):
-				if path_to_info(os.path.join(r, file), folder_fn) not in fn_list:
-					fn_list.append(path_to_info(os.path.join(r, file), folder_fn))
+def restframe_pixels(raw, mode_list, sig_fract, percent_fract, channels, color='hot', norm=None, filt=None, back_box=None):
+	"""Panels of a batch of samples of one rest frame filter, for save_restframe_bulk(), here or in a worker process.
 	
-	file_ids_unique = []
-	for i in fn_list:
-		if i[1][-5:] not in file_ids_unique:
-			file_ids_unique.append(i[1][-5:])
+	@type raw: numpy array
+	@param raw: (samples, filters, width, height) raw data, the rest frame filter first
+	@type mode_list: list
+	@param mode_list: list of scaling modes
+	@type sig_fract: float
+	@param sig_fract: fraction of sigma clipping
+	@type percent_fract: float
+	@param percent_fract: convergence fraction
+	@type channels: list
+	@param channels: index of the R, G and B filters in raw
+	@type color: string
+	@param color: name of the colormap of the rest frame panels
+	@type norm: survey_norm.SurveyNorm
+	@param norm: scale with the frozen range (and CDF, for histeq) of the whole sample instead of those of the image
+	@type filt: string
+	@param filt: rest frame filter, for norm
+	@type back_box: integer
+	@param back_box: subtract a background mesh of boxes of this size instead of one sky value (see subtract_sky())
+	@rtype: numpy array
+	@return: (modes + 1, samples, width, height, 3) uint8 pixels: the panels of each mode, then the RGB images
 	
-	with alive_bar(len(file_ids_unique) * len(mode_list), title='Total Progress') as bar:
-		for index, mode in enumerate(mode_list):
-			print('Processing: ' + mode)
-			for f_id in file_ids_unique:
-				files = []
-				for filt in filter_list:
-					files.append(folder_fn + '/' + filt + '/ceers_' + filt + '_' + f_id + '.fits')
-				collage_rgb_comparison(files, sig_fract, percent_fract, 0.0, filter_list, mode, folder_fn, color=color, size_inches=size_inches, dpi=dpi, restframe=restframes[f_id])
-				bar()
+	"""
+	import atlas
+	pixels = numpy.empty((len(mode_list) + 1, raw.shape[0]) + raw.shape[2:] + (3,), numpy.uint8)
+	rest_raw = raw[:, 0]
+	rest = numpy.stack([subtract_sky(img, sig_fract, percent_fract, back_box=back_box) for img in rest_raw])
+	for m, mode in enumerate(mode_list):
+		scaled = scale_data_batch(rest, rest_raw, mode, min_val=0.0, norm=norm, filt=filt)
+		for i, img in enumerate(scaled):
+			pixels[m, i] = atlas.to_pixels(img, color)
+	# The same sky and stretch as get_rgb((r, g, b), min_val=0.0), for the whole batch at once
+	rgb_data = numpy.stack([[subtract_sky(galaxy_raw[c], 3.0, 5.0-4, back_box=back_box) for c in channels] for galaxy_raw in raw])
+	rgb_arrays = numpy.moveaxis(img_scale.stretch_batch(rgb_data, 'asinh', scale_min=0.0, non_linear=0.005), 1, -1)
+	for i, rgb_array in enumerate(rgb_arrays):
+		pixels[-1, i] = atlas.to_pixels(rgb_array)
+	return pixels
+
+def save_restframe_bulk(folder_fn, mode_list, filter_list, sig_fract, percent_fract, restframes, color='hot', dtype=float, gate=True, batch=64, rgb_filters=('f444w', 'f356w', 'f150w'), writer=None, norm=None, back_box=None, processes=None, register=False, psf_match=False):
+	"""Targeted mode: only the rest frame filter and the RGB image of each sample, reading only those files.
+	
+	The samples are grouped by rest frame filter, and each group is read (ahead, see prefetch.py) and scaled batch
+	of samples at a time with scale_data_batch().  Each sample needs 3 or 4 files instead of 7.
+	
+	@type folder_fn: string
+	@param folder_fn: name of folder which contains filter folders with desired data
+	@type mode_list: list
+	@param mode_list: list of scaling modes
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@type sig_fract: float
+	@param sig_fract: fraction of sigma clipping
+	@type percent_fract: float
+	@param percent_fract: convergence fraction
+	@type restframes: dictionary
+	@param restframes: dictionary where the key is the ID of a particular sample, and the value is the rest frame filter
+	@type color: matplotlib colormap or colormap name
+	@param color: colormap of the rest frame panels
+	@type dtype: numpy dtype
+	@param dtype: floating point precision of the pixel data, float or numpy.float32
+	@type gate: boolean
+	@param gate: skip the samples which fail the quality gate (quality.py), judged on the files read
+	@type batch: integer
+	@param batch: samples scaled at once
+	@type rgb_filters: tuple
+	@param rgb_filters: R, G and B filters, as in img_scale_collage()
+	@type writer: atlas.AtlasWriter
+	@param writer: add the panels to this atlas instead of saving .png files
+	@type norm: survey_norm.SurveyNorm
+	@param norm: scale with the frozen range (and CDF, for histeq) of the whole sample instead of those of the image
+	@type back_box: integer
+	@param back_box: subtract from the rest frame filter and the RGB channels a background varying across the image, measured in boxes of this size (see subtract_sky()), instead of one sky value
+	@type processes: integer
+	@param processes: scale and color the batches in this many worker processes, which get them through shared memory
+	(shared_arena.py); in this process if None or 1
+	@type register: boolean
+	@param register: shift the filters read onto the R channel (rgb_filters[0]) by their sub-pixel offsets (see
+	registration.py), sample by sample, before they are scaled
+	@type psf_match: boolean
+	@param psf_match: convolve the filters read to the broadest PSF of filter_list (see psfmatch.py), in one batched pass
+	over each (batch, filters, ny, nx) stack, after registering them and before they are scaled
+	@rtype: dictionary
+	@return: dictionary of the samples which were skipped, and why
+	@return: saves <folder_fn>_restframe/<mode>/ceers_<id>_<filter>_<mode>.png and <folder_fn>_restframe/rgb/ceers_<id>_rgb.png
+	
+	"""
+	import catalog
+	import prefetch
+	import quality
+	from PIL import Image
+	out_folder = folder_fn + '_restframe'
+	psf_target = psfmatch.broadest(filter_list) if psf_match else None
+	skipped = {}
+	groups = {}
+	cat = catalog.load_catalog(folder_fn, filter_list).with_files()
+	has = cat.rows['files'] >= 0
+	for f_id, files in zip(cat.ids(), has):
+		filt = restframes.get(f_id)
+		if filt not in filter_list:
+			skipped[f_id] = 'no rest frame filter'
+		elif not all([files[filter_list.index(needed_filt)] for needed_filt in (filt,) + tuple(rgb_filters)]):
+			skipped[f_id] = 'files missing'
+		else:
+			groups.setdefault(filt, []).append(f_id)
+	
+	def save(pixels, key, group):
+		if writer is not None:
+			writer.add(key, pixels, group=group)
+			return
+		path = out_folder + '/' + group
+		if not os.path.exists(path):
+			os.makedirs(path)
+		name = 'ceers_' + key[0] + ('_rgb' if group == 'rgb' else '_' + key[2] + '_' + key[1])
+		Image.fromarray(pixels).save(path + '/' + name + '.png')
+	
+	def batches(filt, needed):
+		# Batches of samples of the same shape, read ahead, without those which fail the quality gate
+		chunk = []
+		galaxies = prefetch.iter_galaxies(folder_fn, groups[filt], needed, dtype=dtype, sky=False)
+		for index, galaxy in enumerate(galaxies):
+			chunk.append(galaxy)
+			if (len(chunk) < batch) and (index < len(groups[filt]) - 1):
+				continue
+			by_shape = {}
+			for galaxy in chunk:
+				by_shape.setdefault(galaxy.raw.shape, []).append(galaxy)
+			chunk = []
+			for members in by_shape.values():
+				raw = numpy.stack([galaxy.raw for galaxy in members])
+				if gate:
+					good, reasons = quality.gate(quality.stack_stats(raw), needed)
+					for galaxy, ok, reason in zip(members, good, reasons):
+						if not ok:
+							skipped[galaxy.f_id] = '; '.join(reason)
+					members = [galaxy for galaxy, ok in zip(members, good) if ok]
+					raw = raw[good]
+				if members and register:
+					raw = numpy.stack([align_and_match(stack, needed, reference=needed.index(rgb_filters[0]))[0] for stack in raw])
+				if members and (psf_target is not None):
+					raw = psfmatch.match_stack(raw, needed, psf_target, pad=psfmatch.common_margin(psf_target))
+				if members:
+					yield (members, raw)
+	
+	def shared_results(filt, needed, args):
+		# The members of the batches in flight, in the order imap_shared() gives their panels back
+		in_flight = collections.deque()
+		def stacks():
+			for members, raw in batches(filt, needed):
+				in_flight.append(members)
+				yield raw
+		out_spec = lambda shape, dtype: ((len(mode_list) + 1, shape[0]) + tuple(shape[2:]) + (3,), numpy.uint8)
+		for pixels in shared_arena.imap_shared(restframe_pixels, stacks(), out_spec=out_spec, args=args, processes=processes, arena=arena, pool=pool):
+			yield (in_flight.popleft(), pixels)
+	
+	# With processes, the batches are sent to the workers through shared memory (see shared_arena.py), and so are their panels
+	pool = None
+	if processes and processes > 1:
+		import collections
+		import multiprocessing
+		import shared_arena
+		pool = multiprocessing.Pool(processes)
+		arena = shared_arena.SharedArena()
+	try:
+		for filt in sorted(groups):
+			# The rest frame filter first, then the RGB channels which aren't it
+			needed = [filt] + [rgb_filt for rgb_filt in rgb_filters if rgb_filt != filt]
+			channels = [needed.index(rgb_filt) for rgb_filt in rgb_filters]
+			print('Rest frame ' + filt + ': ' + str(len(groups[filt])) + ' samples, reading ' + ', '.join(needed))
+			args = (mode_list, sig_fract, percent_fract, channels, color, norm, filt, back_box)
+			if pool is None:
+				results = ((members, restframe_pixels(raw, *args)) for members, raw in batches(filt, needed))
+			else:
+				results = shared_results(filt, needed, args)
+			for members, pixels in results:
+				for m, mode in enumerate(mode_list):
+					for galaxy, panel in zip(members, pixels[m]):
+						save(panel, (galaxy.f_id, mode, filt), mode)
+				for galaxy, panel in zip(members, pixels[-1]):
+					save(panel, (galaxy.f_id, 'rgb', 'rgb'), 'rgb')
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+			arena.close()
+	files_read = sum([len(groups[filt]) * (1 + len([rgb_filt for rgb_filt in rgb_filters if rgb_filt != filt])) for filt in groups])
+	total = sum([len(ids) for ids in groups.values()])
+	print('Read ' + str(files_read) + ' files for ' + str(total) + ' samples, instead of ' + str(total * len(filter_list)))
+	if skipped:
+		print(str(len(skipped)) + ' samples skipped: ' + ', '.join(sorted(skipped)))
+	return skipped
 
 def main():
 	sig_fract = 5.0
 	percent_fract = 0.01
 	i_scale = 6.8
 	dpi = 300
-	color = pylab.cm.Greys
+	dtype = numpy.float64 # numpy.float32 halves the memory, see precision_report.py
+	color = 'Greys'
 	restframes = get_restframe_dict('sample_2/id_list.csv')
 
 	data_folder = 'sample_2'
@@ -493,7 +1117,7 @@ def main():
 			'f410m',
 			'f444w',]
 
-	save_collage_bulk(data_folder, scale_modes[2:3], filter_list, sig_fract, percent_fract, restframes, color=color, size_inches=i_scale, dpi=dpi)
+	save_collage_bulk(data_folder, scale_modes[2:3], filter_list, sig_fract, percent_fract, restframes, color=color, size_inches=i_scale, dpi=dpi, dtype=dtype)
 	
 if __name__ == "__main__":
 	main()
@@ -9,6 +9,7 @@
 
 import numpy
 import math
+import accel
 
 def sky_median_sig_clip(input_arr, sig_fract, percent_fract, max_iter=100, low_cut=True, high_cut=True):
 	"""Estimating a sky value for a given number of iterations
@@ -29,6 +30,8 @@ def sky_median_sig_clip(input_arr, sig_fract, percent_fract, max_iter=100, low_c
 	@return: (sky value, number of iterations)
 
 	"""
+	if accel.enabled:
+		return accel.sky_median_sig_clip(input_arr, sig_fract, percent_fract, max_iter, low_cut, high_cut)
 	work_arr = numpy.ravel(input_arr)
 	old_sky = numpy.median(work_arr)
 	sig = work_arr.std()
@@ -82,6 +85,8 @@ def sky_mean_sig_clip(input_arr, sig_fract, percent_fract, max_iter=100, low_cut
 	@return: (sky value, number of iterations)
 
 	"""
+	if accel.enabled:
+		return accel.sky_mean_sig_clip(input_arr, sig_fract, percent_fract, max_iter, low_cut, high_cut)
 	work_arr = numpy.ravel(input_arr)
 	old_sky = numpy.mean(work_arr)
 	sig = work_arr.std()
@@ -144,10 +149,9 @@ def range_from_zscale(input_arr, contrast = 1.0, sig_fract = 3.0, percent_fract
 	I_midpoint = work_arr[midpoint_ind]
 	#print(".. midpoint index ", midpoint_ind, " I_midpoint ", I_midpoint)
 	# initial estimation of the slope
-	x = numpy.array(range(0, len(work_arr))) - midpoint_ind
-	y = numpy.array(work_arr)
-	temp = numpy.vstack([x, numpy.ones(len(x))]).T
-	slope, intercept = numpy.linalg.lstsq(temp, y)[0]
+	x = numpy.arange(len(work_arr)) - midpoint_ind
+	y = work_arr
+	slope, intercept = _fit_line(x, y)
 	old_slope = slope
 	#print("... slope & intercept ", old_slope, " ", intercept)
 	# initial clipping
@@ -162,10 +166,9 @@ def range_from_zscale(input_arr, contrast = 1.0, sig_fract = 3.0, percent_fract
 		else:
 			indices = numpy.where((work_arr < upper_limit))
 	# new estimation of the slope
-	x = numpy.array(indices[0]) - midpoint_ind
-	y = numpy.array(work_arr[indices])
-	temp = numpy.vstack([x, numpy.ones(len(x))]).T
-	slope, intercept = numpy.linalg.lstsq(temp, y)[0]
+	x = indices[0] - midpoint_ind
+	y = work_arr[indices]
+	slope, intercept = _fit_line(x, y)
 	new_slope = slope
 	#print("... slope & intercept ", new_slope, " ", intercept)
 	iteration = 1
@@ -185,10 +188,9 @@ def range_from_zscale(input_arr, contrast = 1.0, sig_fract = 3.0, percent_fract
 			else:
 				indices = numpy.where((work_arr < upper_limit))
 		# new estimation of the slope
-		x = numpy.array(indices[0]) - midpoint_ind
+		x = indices[0] - midpoint_ind
 		y = work_arr[indices]
-		temp = numpy.vstack([x, numpy.ones(len(x))]).T
-		slope, intercept = numpy.linalg.lstsq(temp, y)[0]
+		slope, intercept = _fit_line(x, y)
 		new_slope = slope
 		#print("... slope & intercept ", new_slope, " ", intercept)
 
@@ -213,10 +215,11 @@ def range_from_percentile(input_arr, low_cut=0.25, high_cut=0.25):
 
 	"""
 	work_arr = numpy.ravel(input_arr)
-	work_arr = numpy.sort(work_arr) # sorting is done.
 	size_arr = len(work_arr)
 	low_size = int(size_arr * low_cut)
 	high_size = int(size_arr * high_cut)
+	# only the two order statistics are needed, so select them instead of sorting
+	work_arr = numpy.partition(work_arr, (low_size, size_arr - 1 - high_size))
 	
 	z1 = work_arr[low_size]
 	z2 = work_arr[size_arr - 1 - high_size]
@@ -225,15 +228,271 @@ def range_from_percentile(input_arr, low_cut=0.25, high_cut=0.25):
 
 
 
+def range_from_percentile_stack(input_arr, low_cut=0.25, high_cut=0.25):
+	"""Estimating ranges with given percentiles for each image of a stack
+
+	@type input_arr: numpy array
+	@param input_arr: image data array of shape (..., ny, nx)
+	@type low_cut: float
+	@param low_cut: cut of low-value pixels
+	@type high_cut: float
+	@param high_cut: cut of high-value pixels
+	@rtype: tuple
+	@return: (min. values, max. values), arrays with the leading shape of input_arr
+
+	"""
+	input_arr = numpy.asarray(input_arr)
+	work_arr = input_arr.reshape(input_arr.shape[:-2] + (-1,))
+	size_arr = work_arr.shape[-1]
+	low_size = int(size_arr * low_cut)
+	high_size = int(size_arr * high_cut)
+	work_arr = numpy.partition(work_arr, (low_size, size_arr - 1 - high_size), axis=-1)
+
+	z1 = work_arr[..., low_size]
+	z2 = work_arr[..., size_arr - 1 - high_size]
+
+	return (z1[()], z2[()])
+
+
+
+def range_from_zscale_sampled(input_arr, contrast=0.25, num_samples=1000, max_reject=0.5, min_npixels=5, krej=2.5, max_iter=5):
+	"""Estimating ranges with the IRAF zscale algorithm on a regular subsample of the pixels
+
+	@type input_arr: numpy array
+	@param input_arr: image data array
+	@type contrast: float
+	@param contrast: zscale contrast which should be larger than 0.
+	@type num_samples: integer
+	@param num_samples: number of pixels to sample
+	@type max_reject: float
+	@param max_reject: max. fraction of rejected samples
+	@type min_npixels: integer
+	@param min_npixels: min. number of samples left after rejection
+	@type krej: float
+	@param krej: rejection threshold in units of the residual sigma
+	@type max_iter: integer
+	@param max_iter: max. of iterations
+	@rtype: tuple
+	@return: (min. value, max. value)
+
+	"""
+	return range_from_zscale_stack(input_arr, contrast, num_samples, max_reject, min_npixels, krej, max_iter)
+
+
+
+def range_from_zscale_stack(input_arr, contrast=0.25, num_samples=1000, max_reject=0.5, min_npixels=5, krej=2.5, max_iter=5):
+	"""Estimating ranges with the IRAF zscale algorithm for each image of a stack
+
+	All images are sampled with the same stride and fitted together.  The line
+	through the sorted samples is fitted in closed form, so no pixel is sorted
+	apart from the samples.
+
+	@type input_arr: numpy array
+	@param input_arr: image data array of shape (..., ny, nx)
+	@type contrast: float
+	@param contrast: zscale contrast which should be larger than 0.
+	@type num_samples: integer
+	@param num_samples: number of pixels to sample from each image
+	@type max_reject: float
+	@param max_reject: max. fraction of rejected samples
+	@type min_npixels: integer
+	@param min_npixels: min. number of samples left after rejection
+	@type krej: float
+	@param krej: rejection threshold in units of the residual sigma
+	@type max_iter: integer
+	@param max_iter: max. of iterations
+	@rtype: tuple
+	@return: (min. values, max. values), arrays with the leading shape of input_arr
+
+	"""
+	input_arr = numpy.asarray(input_arr)
+	lead = input_arr.shape[:-2]
+	work_arr = input_arr.reshape((-1, input_arr.shape[-2] * input_arr.shape[-1]))
+	stride = max(1, int(work_arr.shape[1] / num_samples))
+	samples = numpy.sort(work_arr[:, ::stride][:, :num_samples].astype(float), axis=1) # NaN are sorted last
+
+	good = numpy.isfinite(samples)
+	npix = good.sum(axis=1)
+	rows = numpy.arange(samples.shape[0])
+	x = numpy.arange(samples.shape[1], dtype=float)
+	samples = numpy.where(good, samples, 0.0)
+
+	zmin = samples[:, 0]
+	zmax = samples[rows, numpy.maximum(npix - 1, 0)]
+	minpix = numpy.maximum(min_npixels, (npix * max_reject).astype(int))
+	ngrow = numpy.maximum(1, (npix * 0.01).astype(int))
+
+	ngoodpix = npix.copy()
+	last_ngoodpix = npix + 1
+	slope = numpy.zeros(samples.shape[0])
+	active = numpy.ones(samples.shape[0], dtype=bool)
+	fitted_once = numpy.zeros(samples.shape[0], dtype=bool)
+	for iteration in range(max_iter):
+		active = active & (ngoodpix < last_ngoodpix) & (ngoodpix >= minpix)
+		if not active.any():
+			break
+		w = good.astype(float)
+		sw = w.sum(axis=1)
+		sx = (w * x).sum(axis=1)
+		sy = (w * samples).sum(axis=1)
+		sxx = (w * x * x).sum(axis=1)
+		sxy = (w * x * samples).sum(axis=1)
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			b = (sw * sxy - sx * sy) / (sw * sxx - sx * sx)
+			a = (sy - b * sx) / sw
+			flat = samples - (a[:, None] + b[:, None] * x)
+			mean_flat = (w * flat).sum(axis=1) / sw
+			threshold = krej * numpy.sqrt(numpy.maximum((w * flat * flat).sum(axis=1) / sw - mean_flat ** 2, 0.0))
+		slope = numpy.where(active, b, slope)
+		fitted_once = fitted_once | active
+
+		bad = (~good) | (flat < -threshold[:, None]) | (flat > threshold[:, None])
+		# grow the rejected samples by ngrow, like numpy.convolve(bad, ones(ngrow), mode='same')
+		counts = numpy.concatenate((numpy.zeros((bad.shape[0], 1)), numpy.cumsum(bad, axis=1)), axis=1)
+		upper = numpy.minimum(x[None, :].astype(int) + (ngrow[:, None] - 1) // 2 + 1, bad.shape[1])
+		lower = numpy.maximum(x[None, :].astype(int) - ngrow[:, None] // 2, 0)
+		bad = (numpy.take_along_axis(counts, upper, axis=1) - numpy.take_along_axis(counts, lower, axis=1)) > 0
+		bad = bad | (x[None, :] >= npix[:, None])
+
+		good = numpy.where(active[:, None], ~bad, good)
+		last_ngoodpix = numpy.where(active, ngoodpix, last_ngoodpix)
+		ngoodpix = numpy.where(active, good.sum(axis=1), ngoodpix)
+
+	center = (npix - 1) // 2
+	finite = numpy.where(x[None, :] < npix[:, None], samples, numpy.nan)
+	median = numpy.nanmedian(finite, axis=1) if finite.shape[1] else numpy.zeros(samples.shape[0])
+	use_fit = fitted_once & (ngoodpix >= minpix)
+	if contrast > 0:
+		slope = slope / contrast
+	z1 = numpy.where(use_fit, numpy.maximum(zmin, median - (center - 1) * slope), zmin)
+	z2 = numpy.where(use_fit, numpy.minimum(zmax, median + (npix - center) * slope), zmax)
+
+	return (z1.reshape(lead)[()], z2.reshape(lead)[()])
+
+
+
+def percentile_range(low_cut=0.25, high_cut=0.25):
+	"""Make a range provider from range_from_percentile_stack(), for scale_min and scale_max of the scalings below
+
+	@type low_cut: float
+	@param low_cut: cut of low-value pixels
+	@type high_cut: float
+	@param high_cut: cut of high-value pixels
+	@rtype: function
+	@return: function which takes image data and returns (min. value, max. value)
+
+	"""
+	def provider(imageData):
+		return range_from_percentile_stack(imageData, low_cut, high_cut)
+	return provider
+
+
+
+def zscale_range(contrast=0.25, num_samples=1000):
+	"""Make a range provider from range_from_zscale_stack(), for scale_min and scale_max of the scalings below
+
+	@type contrast: float
+	@param contrast: zscale contrast which should be larger than 0.
+	@type num_samples: integer
+	@param num_samples: number of pixels to sample from each image
+	@rtype: function
+	@return: function which takes image data and returns (min. value, max. value)
+
+	"""
+	def provider(imageData):
+		return range_from_zscale_stack(imageData, contrast, num_samples)
+	return provider
+
+
+
+def _fit_line(x, y):
+	"""Least squares fit of a straight line in closed form
+
+	@type x: numpy array
+	@param x: abscissa
+	@type y: numpy array
+	@param y: ordinate
+	@rtype: tuple
+	@return: (slope, intercept)
+
+	"""
+	x_mean = x.mean()
+	y_mean = y.mean()
+	dx = x - x_mean
+	slope = numpy.dot(dx, y - y_mean) / numpy.dot(dx, dx)
+	return (slope, y_mean - slope * x_mean)
+
+
+
+
+def _lead_axes(value):
+	"""Reshape a scalar or array parameter so that it indexes the leading axes of an image stack.
+
+	@type value: float or numpy array
+	@param value: parameter value(s)
+	@rtype: float or numpy array
+	@return: scalar unchanged, or array with two trailing singleton axes for (ny, nx)
+
+	"""
+	if numpy.ndim(value) == 0:
+		return value
+	value = numpy.asarray(value)
+	return value.reshape(value.shape + (1, 1))
+
+
+
+def _scale_range(imageData, scale_min, scale_max, per_image=False):
+	"""Fill in scale_min and scale_max of a scaling from the data or from range providers.
+
+	@type imageData: numpy array
+	@param imageData: image data array
+	@type scale_min: float, function or None
+	@param scale_min: minimum data value, range provider, or None for the data minimum
+	@type scale_max: float, function or None
+	@param scale_max: maximum data value, range provider, or None for the data maximum
+	@type per_image: boolean
+	@param per_image: take the range of each image of a (..., ny, nx) stack separately
+	@rtype: tuple
+	@return: (scale_min, scale_max)
+
+	"""
+	provided = {}
+	for provider in (scale_min, scale_max):
+		if callable(provider) and id(provider) not in provided:
+			provided[id(provider)] = provider(imageData)
+	if callable(scale_min):
+		scale_min = provided[id(scale_min)][0]
+	if callable(scale_max):
+		scale_max = provided[id(scale_max)][1]
+
+	if per_image:
+		if scale_min is None:
+			scale_min = imageData.min(axis=(-2, -1), keepdims=True)
+		else:
+			scale_min = _lead_axes(scale_min)
+		if scale_max is None:
+			scale_max = imageData.max(axis=(-2, -1), keepdims=True)
+		else:
+			scale_max = _lead_axes(scale_max)
+	else:
+		if scale_min is None:
+			scale_min = imageData.min()
+		if scale_max is None:
+			scale_max = imageData.max()
+
+	return (scale_min, scale_max)
+
+
+
 def histeq(inputArray, scale_min=None, scale_max=None, num_bins=512):
 	"""Performs histogram equalisation of the input numpy array.
     
 	@type inputArray: numpy array
 	@param inputArray: image data array
-	@type scale_min: float
-	@param scale_min: minimum data value
-	@type scale_max: float
-	@param scale_max: maximum data value
+	@type scale_min: float or function
+	@param scale_min: minimum data value, or a range provider such as percentile_range()
+	@type scale_max: float or function
+	@param scale_max: maximum data value, or a range provider such as percentile_range()
 	@type num_bins: int
 	@param num_bins: number of bins in which to perform the operation (e.g. 512)
 	@rtype: numpy array
@@ -242,10 +501,7 @@ def histeq(inputArray, scale_min=None, scale_max=None, num_bins=512):
 	"""		
     
 	imageData=numpy.array(inputArray, copy=True)
-	if scale_min == None:
-		scale_min = imageData.min()
-	if scale_max == None:
-		scale_max = imageData.max()
+	scale_min, scale_max = _scale_range(imageData, scale_min, scale_max)
 	imageData.clip(min=scale_min, max=scale_max)
 	imageData = (imageData -scale_min) / (scale_max - scale_min) # now between 0 and 1.
 	indices = numpy.where(imageData < 0)
@@ -258,7 +514,7 @@ def histeq(inputArray, scale_min=None, scale_max=None, num_bins=512):
 
 	# mapping the image values to the histogram bins
 	imageData_temp = numpy.interp(imageData.flatten(), histogram_bins[:-1], histogram_cdf)
-	imageData = imageData_temp.reshape(imageData.shape)
+	imageData = imageData_temp.reshape(imageData.shape).astype(imageData.dtype, copy=False)
        
 	return imageData
 
@@ -269,10 +525,10 @@ def linear(inputArray, scale_min=None, scale_max=None):
 
 	@type inputArray: numpy array
 	@param inputArray: image data array
-	@type scale_min: float
-	@param scale_min: minimum data value
-	@type scale_max: float
-	@param scale_max: maximum data value
+	@type scale_min: float or function
+	@param scale_min: minimum data value, or a range provider such as percentile_range()
+	@type scale_max: float or function
+	@param scale_max: maximum data value, or a range provider such as percentile_range()
 	@rtype: numpy array
 	@return: image data array
 	
@@ -280,10 +536,9 @@ def linear(inputArray, scale_min=None, scale_max=None):
 	#print("img_scale : linear")
 	imageData=numpy.array(inputArray, copy=True)
 	
-	if scale_min == None:
-		scale_min = imageData.min()
-	if scale_max == None:
-		scale_max = imageData.max()
+	scale_min, scale_max = _scale_range(imageData, scale_min, scale_max)
+	if accel.eligible(imageData, scale_min, scale_max):
+		return accel.stretch(imageData, 'linear', scale_min, scale_max)
 
 	imageData.clip(min=scale_min, max=scale_max)
 	imageData = (imageData -scale_min) / (scale_max - scale_min)
@@ -298,10 +553,10 @@ def sqrt(inputArray, scale_min=None, scale_max=None):
 
 	@type inputArray: numpy array
 	@param inputArray: image data array
-	@type scale_min: float
-	@param scale_min: minimum data value
-	@type scale_max: float
-	@param scale_max: maximum data value
+	@type scale_min: float or function
+	@param scale_min: minimum data value, or a range provider such as percentile_range()
+	@type scale_max: float or function
+	@param scale_max: maximum data value, or a range provider such as percentile_range()
 	@rtype: numpy array
 	@return: image data array
 	
@@ -310,10 +565,9 @@ def sqrt(inputArray, scale_min=None, scale_max=None):
 	#print("img_scale : sqrt")
 	imageData=numpy.array(inputArray, copy=True)
 	
-	if scale_min == None:
-		scale_min = imageData.min()
-	if scale_max == None:
-		scale_max = imageData.max()
+	scale_min, scale_max = _scale_range(imageData, scale_min, scale_max)
+	if accel.eligible(imageData, scale_min, scale_max):
+		return accel.stretch(imageData, 'sqrt', scale_min, scale_max)
 
 	imageData.clip(min=scale_min, max=scale_max)
 	imageData = imageData - scale_min
@@ -330,10 +584,10 @@ def log(inputArray, scale_min=None, scale_max=None, exponent = 1000):
 
 	@type inputArray: numpy array
 	@param inputArray: image data array
-	@type scale_min: float
-	@param scale_min: minimum data value
-	@type scale_max: float
-	@param scale_max: maximum data value
+	@type scale_min: float or function
+	@param scale_min: minimum data value, or a range provider such as percentile_range()
+	@type scale_max: float or function
+	@param scale_max: maximum data value, or a range provider such as percentile_range()
 	@rtype: numpy array
 	@return: image data array
 	
@@ -342,10 +596,9 @@ def log(inputArray, scale_min=None, scale_max=None, exponent = 1000):
 	#print("img_scale : log")
 	imageData=numpy.array(inputArray, copy=True)
 	
-	if scale_min == None:
-		scale_min = imageData.min()
-	if scale_max == None:
-		scale_max = imageData.max()
+	scale_min, scale_max = _scale_range(imageData, scale_min, scale_max)
+	if accel.eligible(imageData, scale_min, scale_max):
+		return accel.stretch(imageData, 'log', scale_min, scale_max, exponent=exponent)
 	a = exponent
 	factor = math.log10(a)
 	indices0 = numpy.where(imageData < scale_min)
@@ -368,10 +621,10 @@ def power(inputArray, power_index=3.0, scale_min=None, scale_max=None):
 	@param inputArray: image data array
 	@type power_index: float
 	@param power_index: power index
-	@type scale_min: float
-	@param scale_min: minimum data value
-	@type scale_max: float
-	@param scale_max: maximum data value
+	@type scale_min: float or function
+	@param scale_min: minimum data value, or a range provider such as percentile_range()
+	@type scale_max: float or function
+	@param scale_max: maximum data value, or a range provider such as percentile_range()
 	@rtype: numpy array
 	@return: image data array
 	
@@ -380,10 +633,9 @@ def power(inputArray, power_index=3.0, scale_min=None, scale_max=None):
 	#print("img_scale : power")
 	imageData=numpy.array(inputArray, copy=True)
 	
-	if scale_min == None:
-		scale_min = imageData.min()
-	if scale_max == None:
-		scale_max = imageData.max()
+	scale_min, scale_max = _scale_range(imageData, scale_min, scale_max)
+	if accel.eligible(imageData, scale_min, scale_max):
+		return accel.stretch(imageData, 'power', scale_min, scale_max, power_index=power_index)
 	factor = 1.0 / math.pow((scale_max - scale_min), power_index)
 	indices0 = numpy.where(imageData < scale_min)
 	indices1 = numpy.where((imageData >= scale_min) & (imageData <= scale_max))
@@ -400,10 +652,10 @@ def asinh(inputArray, scale_min=None, scale_max=None, non_linear=2.0):
 
 	@type inputArray: numpy array
 	@param inputArray: image data array
-	@type scale_min: float
-	@param scale_min: minimum data value
-	@type scale_max: float
-	@param scale_max: maximum data value
+	@type scale_min: float or function
+	@param scale_min: minimum data value, or a range provider such as percentile_range()
+	@type scale_max: float or function
+	@param scale_max: maximum data value, or a range provider such as percentile_range()
 	@type non_linear: float
 	@param non_linear: non-linearity factor
 	@rtype: numpy array
@@ -414,10 +666,9 @@ def asinh(inputArray, scale_min=None, scale_max=None, non_linear=2.0):
 	#print("img_scale : asinh")
 	imageData=numpy.array(inputArray, copy=True)
 	
-	if scale_min == None:
-		scale_min = imageData.min()
-	if scale_max == None:
-		scale_max = imageData.max()
+	scale_min, scale_max = _scale_range(imageData, scale_min, scale_max)
+	if accel.eligible(imageData, scale_min, scale_max):
+		return accel.stretch(imageData, 'asinh', scale_min, scale_max, non_linear=non_linear)
 	factor = numpy.arcsinh((scale_max - scale_min)/non_linear)
 	indices0 = numpy.where(imageData < scale_min)
 	indices1 = numpy.where((imageData >= scale_min) & (imageData <= scale_max))
@@ -434,10 +685,10 @@ def logistic(inputArray, scale_min=None, scale_max=None, center=0.5, slope=1.0):
 
 	@type inputArray: numpy array
 	@param inputArray: image data array
-	@type scale_min: float
-	@param scale_min: minimum data value
-	@type scale_max: float
-	@param scale_max: maximum data value
+	@type scale_min: float or function
+	@param scale_min: minimum data value, or a range provider such as percentile_range()
+	@type scale_max: float or function
+	@param scale_max: maximum data value, or a range provider such as percentile_range()
 	@type center: float
 	@param center: central value
 	@type slope: float
@@ -450,10 +701,9 @@ def logistic(inputArray, scale_min=None, scale_max=None, center=0.5, slope=1.0):
 	#print("img_scale : logistic")
 	imageData=numpy.array(inputArray, copy=True)
 	
-	if scale_min == None:
-		scale_min = imageData.min()
-	if scale_max == None:
-		scale_max = imageData.max()
+	scale_min, scale_max = _scale_range(imageData, scale_min, scale_max)
+	if accel.eligible(imageData, scale_min, scale_max):
+		return accel.stretch(imageData, 'logistic', scale_min, scale_max, center=center, slope=slope)
 	factor2 = 1.0/(1.0+1.0/math.exp((scale_max - center)/slope))
 	factor2 = factor2 + 1.0/(1.0+1.0/math.exp((scale_min - center)/slope))
 	factor2 = 1.0 / factor2
@@ -466,3 +716,75 @@ def logistic(inputArray, scale_min=None, scale_max=None, center=0.5, slope=1.0):
 	imageData[indices1] = factor1 + factor2 / (1.0 + 1.0/numpy.exp((imageData[indices1] - center)/slope))
 
 	return imageData
+
+
+def stretch_batch(inputArray, mode, scale_min=None, scale_max=None, **params):
+	"""Performs any of the scalings above on a stack of images, with broadcast parameters.
+	
+	The last two axes of inputArray are the image axes.  Parameters (and scale_min / scale_max)
+	may be scalars or arrays; arrays index the leading axes of the result, so a (ny, nx) image
+	with exponent=[100, 1000, 10000] gives a (3, ny, nx) stack, one variant per exponent.
+	When scale_min or scale_max is None it is taken from each image separately.
+
+	@type inputArray: numpy array
+	@param inputArray: image data array of shape (..., ny, nx)
+	@type mode: string
+	@param mode: one of 'linear', 'sqrt', 'log', 'power', 'asinh', 'logistic', 'histeq'
+	@type scale_min: float, numpy array or function
+	@param scale_min: minimum data value(s), or a range provider such as percentile_range()
+	@type scale_max: float, numpy array or function
+	@param scale_max: maximum data value(s), or a range provider such as percentile_range()
+	@type params: keyword arguments
+	@param params: keyword parameters of the single image function (exponent, power_index, non_linear, center, slope, num_bins)
+	@rtype: numpy array
+	@return: image data array of the broadcast shape
+
+	"""
+	imageData = numpy.asarray(inputArray)
+	if not numpy.issubdtype(imageData.dtype, numpy.floating):
+		imageData = imageData.astype(float)
+
+	if mode == 'histeq':
+		num_bins = numpy.asarray(params.get('num_bins', 512))
+		lead = numpy.broadcast_shapes(imageData.shape[:-2], numpy.shape(scale_min), numpy.shape(scale_max), num_bins.shape)
+		imageData = numpy.broadcast_to(imageData, lead + imageData.shape[-2:])
+		s_min = numpy.broadcast_to(numpy.asarray(scale_min, dtype=object), lead)
+		s_max = numpy.broadcast_to(numpy.asarray(scale_max, dtype=object), lead)
+		num_bins = numpy.broadcast_to(num_bins, lead)
+		out = numpy.empty(imageData.shape, dtype=imageData.dtype)
+		for index in numpy.ndindex(*lead):
+			out[index] = histeq(imageData[index], scale_min=s_min[index], scale_max=s_max[index], num_bins=int(num_bins[index]))
+		return out
+
+	scale_min, scale_max = _scale_range(imageData, scale_min, scale_max, per_image=True)
+
+	with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+		if mode == 'linear':
+			new_img = (imageData - scale_min) / (scale_max - scale_min)
+			return numpy.where(new_img < 0, 0.0, new_img).astype(imageData.dtype, copy=False)
+		if mode == 'sqrt':
+			new_img = numpy.sqrt(numpy.maximum(imageData - scale_min, 0.0))
+			return (new_img / numpy.sqrt(scale_max - scale_min)).astype(imageData.dtype, copy=False)
+
+		if mode == 'log':
+			a = _lead_axes(params.get('exponent', 1000))
+			middle = numpy.log10((imageData * a) + 1) / numpy.log10(a)
+		elif mode == 'power':
+			power_index = _lead_axes(params.get('power_index', 3.0))
+			middle = numpy.power((imageData - scale_min), power_index) / numpy.power((scale_max - scale_min), power_index)
+		elif mode == 'asinh':
+			non_linear = _lead_axes(params.get('non_linear', 2.0))
+			middle = numpy.arcsinh((imageData - scale_min) / non_linear) / numpy.arcsinh((scale_max - scale_min) / non_linear)
+		elif mode == 'logistic':
+			center = _lead_axes(params.get('center', 0.5))
+			slope = _lead_axes(params.get('slope', 1.0))
+			low = 1.0 / (1.0 + 1.0 / numpy.exp((scale_min - center) / slope))
+			factor2 = 1.0 / (1.0 / (1.0 + 1.0 / numpy.exp((scale_max - center) / slope)) + low)
+			factor1 = -1.0 * factor2 * low
+			middle = factor1 + factor2 / (1.0 + 1.0 / numpy.exp((imageData - center) / slope))
+		else:
+			raise ValueError('Unknown scaling mode: ' + str(mode))
+
+		new_img = numpy.where(imageData < scale_min, 0.0, numpy.where(imageData > scale_max, 1.0, middle))
+
+	return new_img.astype(imageData.dtype, copy=False)
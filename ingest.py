@@ -0,0 +1,361 @@
+#
+# Ingest mode: watches a sample folder while the extraction jobs add cutouts to it, and renders each galaxy's collages
+# as soon as all of its filter files are there, instead of rerunning everything over the whole sample.
+# The filter folders are polled (os.scandir, no OS specific notification API) into an index of file sizes and mtimes.
+# A galaxy is ready when every filter has a file which is a whole number of FITS blocks, hasn't changed since the last
+# poll and is older than the settle time (debouncing files still being copied).  Ready galaxies are rendered by a pool
+# of worker processes which have imported matplotlib, astropy and the pipeline once, at start.  Every galaxy finished
+# is appended to a cursor file with the signature of its files, so a restart skips it unless its files were rewritten.
+#
+# You can freely use the code
+#
+
+import csv
+import multiprocessing
+import os
+import signal
+import time
+import warnings
+
+fits_block = 2880  # FITS files are a whole number of 2880 byte blocks
+
+def scan(folder_fn, filter_list):
+	"""One poll of the filter folders.
+
+	@type folder_fn: string
+	@param folder_fn: name of folder which contains filter folders with desired data
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@rtype: dictionary
+	@return: dictionary where the key is (sample ID string, filter), and the value is (size, mtime in ns)
+
+	"""
+	index = {}
+	for filt in filter_list:
+		prefix = 'ceers_' + filt + '_'
+		try:
+			entries = os.scandir(os.path.join(folder_fn, filt))
+		except OSError:
+			continue
+		with entries:
+			for entry in entries:
+				name = entry.name
+				if name.startswith(prefix) and name.endswith('.fits') and name[len(prefix):-5].isdigit():
+					try:
+						stat = entry.stat()
+					except OSError:  # removed since it was listed
+						continue
+					index[(name[len(prefix):-5], filt)] = (stat.st_size, stat.st_mtime_ns)
+	return index
+
+def signature(files):
+	"""
+	@type files: list
+	@param files: list of (size, mtime in ns), one per filter
+	@rtype: string
+	@return: signature of a galaxy's files, which changes if any of them is rewritten
+	"""
+	return '%d-%d' % (max([mtime for size, mtime in files]), sum([size for size, mtime in files]))
+
+def read_cursor(filename):
+	"""
+	@type filename: string
+	@param filename: cursor file written by Ingest
+	@rtype: dictionary
+	@return: dictionary where the key is the sample ID string, and the value is the signature of the files it was made from
+	"""
+	done = {}
+	if os.path.exists(filename):
+		with open(filename, newline='') as fin:
+			for row in csv.reader(fin):
+				if len(row) >= 3 and row[0] != 'id':
+					done[row[0]] = row[1]
+	return done
+
+#################################
+# Workers
+
+worker = {}
+
+def warm_up(params):
+	"""Initializer of the worker processes: import everything and make the dataflow graph once."""
+	# Ctrl-C or SIGTERM stops the watcher, which lets the workers finish the galaxies they have; both are ignored here
+	# since they are often sent to the whole process group (a terminal, systemd, timeout)
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_IGN)
+	import matplotlib
+	matplotlib.use('Agg')
+	import pylab  # the slowest import, done before the first galaxy rather than during it
+	import fits_to_png_bulk
+	import dataflow
+	worker['params'] = params
+	worker['graph'] = dataflow.Graph(max_bytes=64 * 2**20)
+	worker['norm'] = None
+	if params['norm']:
+		import survey_norm
+		worker['norm'] = survey_norm.load_norm(params['norm'])
+
+def interrupt(signum, frame):
+	"""SIGTERM handler of the watcher: stop as Ctrl-C does."""
+	raise KeyboardInterrupt
+
+def render(task):
+	"""Quality gate and collages of one galaxy, in a worker process.
+
+	@type task: tuple
+	@param task: (sample ID string, rest frame filter or None)
+	@rtype: tuple
+	@return: (sample ID string, 'done', 'rejected' or 'failed', list of the reasons or warnings, list of the saved .png)
+
+	"""
+	import numpy
+	import fits_to_png_bulk
+	import dataflow
+	import quality
+	f_id, restframe = task
+	params = worker['params']
+	folder_fn = params['folder_fn']
+	filter_list = params['filter_list']
+	try:
+		files = fits_to_png_bulk.galaxy_files(folder_fn, f_id, filter_list)
+		shifts = None
+		if params['gate'] or (params['register'] is not None):
+			# Judged and registered on the data it is rendered from, which the graph then doesn't read again
+			raw = [dataflow.read(fn=fn, dtype=numpy.dtype(params['dtype']).str) if os.path.exists(fn) else None for fn in files]
+			if params['gate']:
+				rejected = quality.check_galaxy(raw, filter_list)
+				if rejected is not None:
+					return (f_id, 'rejected', rejected[0], [])
+			raw, shifts = fits_to_png_bulk.align_and_match(numpy.stack(raw), filter_list, params['register'], params['psf_target'])
+			for fn, img, shift in zip(files, raw, [None] * len(files) if shifts is None else shifts):
+				worker['graph'].put(dataflow.load(fn, params['dtype'], params['psf_target'], shift), img)
+		outputs = []
+		with warnings.catch_warnings(record=True) as caught_warnings:
+			for mode in params['mode_list']:
+				outputs.append(worker['graph'].get(dataflow.collage(files, params['sig_fract'], params['percent_fract'], 0.0, filter_list, mode, folder_fn, color=params['color'], size_inches=params['size_inches'], dpi=params['dpi'], restframe=restframe, dtype=params['dtype'], norm=worker['norm'], back_box=params['back_box'], psf_target=params['psf_target'], shifts=shifts)))
+		return (f_id, 'done', [str(warn.message) for warn in caught_warnings], outputs)
+	except Exception as error:
+		return (f_id, 'failed', [repr(error)], [])
+
+#################################
+# Watcher
+
+class Ingest:
+	"""Polls a sample folder and renders the galaxies whose files are complete, on a warm pool of processes."""
+
+	def __init__(self, folder_fn, mode_list, filter_list, sig_fract=5.0, percent_fract=0.01, color='hot', size_inches=3.4, dpi=300, dtype=float, gate=True, norm=None, back_box=None, register=False, psf_match=False, restframes=None, interval=5.0, settle=10.0, drain=300.0, workers=None, cursor=None, telemetry=None):
+		"""
+		@type folder_fn: string
+		@param folder_fn: name of folder which contains filter folders with desired data
+		@type mode_list: list
+		@param mode_list: list of scaling modes
+		@type filter_list: list
+		@param filter_list: list of filter name strings; a galaxy is ready when it has all of them
+		@type sig_fract: float
+		@param sig_fract: fraction of sigma clipping
+		@type percent_fract: float
+		@param percent_fract: convergence fraction
+		@type color: matplotlib colormap name
+		@param color: colormap to use for saved image
+		@type size_inches: float
+		@param size_inches: size of output image
+		@type dpi: integer
+		@param dpi: dots per inch of output image
+		@type dtype: numpy dtype
+		@param dtype: floating point precision of the pixel data, float or numpy.float32
+		@type gate: boolean
+		@param gate: skip the galaxies which fail the quality gate (quality.py)
+		@type norm: string
+		@param norm: .npz of a survey normalization (survey_norm.py), or None to scale per image
+		@type back_box: integer
+		@param back_box: subtract a background varying across the image, measured in boxes of this size (see fits_to_png_bulk.subtract_sky()), instead of one sky value
+		@type register: boolean
+		@param register: shift every filter onto the R channel (the 7th filter) by its sub-pixel offset (see registration.py) before scaling
+		@type psf_match: boolean
+		@param psf_match: convolve every filter to the broadest PSF of filter_list (see psfmatch.py) before scaling
+		@type restframes: string
+		@param restframes: csv of id, redshift, rest frame filter, reread when it changes; <folder_fn>/id_list.csv if None
+		@type interval: float
+		@param interval: seconds between polls
+		@type settle: float
+		@param settle: seconds a galaxy's files must have been unchanged for before it is rendered; a galaxy whose files
+		are still not whole FITS blocks by then is recorded as failed
+		@type drain: float
+		@param drain: seconds to wait for the galaxies being rendered when stopping, before the workers are terminated
+		@type workers: integer
+		@param workers: worker processes, os.cpu_count() if None
+		@type cursor: string
+		@param cursor: cursor file, <folder_fn>_collage/ingest_cursor.csv if None
+		@type telemetry: telemetry.Telemetry
+		@param telemetry: publish the progress and queue depths to it (see telemetry.py)
+
+		"""
+		self.folder_fn = folder_fn
+		self.filter_list = list(filter_list)
+		self.params = {'folder_fn': folder_fn, 'mode_list': list(mode_list), 'filter_list': self.filter_list, 'sig_fract': sig_fract, 'percent_fract': percent_fract, 'color': color, 'size_inches': size_inches, 'dpi': dpi, 'dtype': dtype, 'gate': gate, 'norm': norm, 'back_box': back_box, 'register': 6 if register else None, 'psf_target': None}
+		if psf_match:
+			import psfmatch
+			self.params['psf_target'] = psfmatch.broadest(self.filter_list)
+		self.restframes_file = restframes or os.path.join(folder_fn, 'id_list.csv')
+		self.restframes = {}
+		self.restframes_mtime = None
+		self.interval = interval
+		self.settle = settle
+		self.drain = drain
+		self.workers = workers or os.cpu_count() or 1
+		self.cursor = cursor or folder_fn + '_collage/ingest_cursor.csv'
+		self.telemetry = telemetry
+		self.done = read_cursor(self.cursor)
+		self.index = {}
+		self.in_flight = {}  # sample ID: (signature, AsyncResult)
+		self.counts = {'done': 0, 'rejected': 0, 'failed': 0}
+
+	def load_restframes(self):
+		"""Reread the rest frame filters if the csv changed (new galaxies come with new rows)."""
+		try:
+			mtime = os.stat(self.restframes_file).st_mtime_ns
+		except OSError:
+			return
+		if mtime != self.restframes_mtime:
+			import fits_to_png_bulk
+			self.restframes = fits_to_png_bulk.get_restframe_dict(self.restframes_file)
+			self.restframes_mtime = mtime
+
+	def ready(self, index):
+		"""Galaxies to render, from this poll and the last one.
+
+		@type index: dictionary
+		@param index: this poll, from scan()
+		@rtype: tuple
+		@return: (list of (sample ID string, signature), oldest files first; number of galaxies with every file, not
+		rendered yet but still changing or settling; list of (sample ID string, signature, list of the filters) of the
+		galaxies which have settled with files that aren't whole FITS blocks, e.g. truncated copies)
+
+		"""
+		now = time.time_ns()
+		galaxies = {}
+		for (f_id, filt), (size, mtime) in index.items():
+			galaxies.setdefault(f_id, []).append((size, mtime))
+		found = []
+		waiting = 0
+		broken = []
+		for f_id, files in galaxies.items():
+			if (len(files) < len(self.filter_list)) or (f_id in self.in_flight):
+				continue
+			partial = [filt for filt in self.filter_list if not (index[(f_id, filt)][0] >= fits_block and index[(f_id, filt)][0] % fits_block == 0)]
+			unchanged = all([self.index.get((f_id, filt)) == index[(f_id, filt)] for filt in self.filter_list])
+			settled = (now - max([mtime for size, mtime in files])) >= self.settle * 1e9
+			sign = signature(files)
+			if self.done.get(f_id) == sign:
+				continue
+			if unchanged and settled:
+				if partial:
+					broken.append((f_id, sign, partial))
+				else:
+					found.append((max([mtime for size, mtime in files]), f_id, sign))
+			else:
+				waiting += 1
+		return ([(f_id, sign) for mtime, f_id, sign in sorted(found)], waiting, broken)
+
+	def record(self, result, sign):
+		"""Append a finished galaxy to the cursor and report it."""
+		f_id, status, messages, outputs = result
+		new = not os.path.exists(self.cursor)
+		if new:
+			os.makedirs(os.path.dirname(self.cursor) or '.', exist_ok=True)
+		with open(self.cursor, 'a', newline='') as fout:
+			writer = csv.writer(fout)
+			if new:
+				writer.writerow(['id', 'signature', 'status', 'time'])
+			writer.writerow([f_id, sign, status, '%.0f' % time.time()])
+		self.done[f_id] = sign
+		self.counts[status] += 1
+		if status == 'done':
+			print('ceers_' + f_id + ': ' + ', '.join(outputs) + ''.join(['\n  ' + message for message in messages]))
+		else:
+			print('ceers_' + f_id + ' ' + status + ': ' + '; '.join(messages))
+		if self.telemetry is not None:
+			self.telemetry.inc('galaxies_' + status + '_total')
+			self.telemetry.inc('images_total', len(outputs))
+
+	def collect(self):
+		"""Record the galaxies the workers have finished."""
+		for f_id, (sign, pending) in list(self.in_flight.items()):
+			if pending.ready():
+				del self.in_flight[f_id]
+				self.record(pending.get(), sign)
+
+	def poll(self, pool):
+		"""Scan once, and queue the ready galaxies, at most two per worker at a time.
+
+		@rtype: integer
+		@return: number of galaxies waiting for a place in the queue or to settle
+		"""
+		self.load_restframes()
+		index = scan(self.folder_fn, self.filter_list)
+		ready, waiting, broken = self.ready(index)
+		self.index = index
+		# Files which stopped changing short of a whole FITS block won't become readable: fail them until they are rewritten
+		for f_id, sign, partial in broken:
+			self.record((f_id, 'failed', ['incomplete FITS file: ' + ', '.join(partial)], []), sign)
+		room = 2 * self.workers - len(self.in_flight)
+		for f_id, sign in ready[:max(room, 0)]:
+			self.in_flight[f_id] = (sign, pool.apply_async(render, ((f_id, self.restframes.get(f_id)),)))
+		backlog = max(len(ready) - max(room, 0), 0)
+		if self.telemetry is not None:
+			self.telemetry.set('queue_depth', len(self.in_flight), queue='ingest')
+			self.telemetry.set('queue_depth', backlog, queue='ingest_backlog')
+			self.telemetry.set('queue_depth', waiting, queue='ingest_settling')
+		return backlog + waiting
+
+	def finish(self):
+		"""Wait for the galaxies being rendered, at most drain seconds."""
+		deadline = time.time() + self.drain
+		while self.in_flight and (time.time() < deadline):
+			time.sleep(0.1)
+			self.collect()
+
+	def run(self, once=False, max_polls=None):
+		"""Watch the folder until interrupted (Ctrl-C or SIGTERM), rendering galaxies as they become ready.
+
+		@type once: boolean
+		@param once: stop when nothing is ready, settling or being rendered, e.g. to catch up from cron
+		@type max_polls: integer
+		@param max_polls: stop after this many polls
+		@rtype: dictionary
+		@return: number of galaxies done, rejected and failed
+
+		"""
+		polls = 0
+		pool = multiprocessing.Pool(self.workers, initializer=warm_up, initargs=(self.params,))
+		terminate = signal.signal(signal.SIGTERM, interrupt)
+		print('Watching %s every %g s (%d workers, %d galaxies already in %s)' % (self.folder_fn, self.interval, self.workers, len(self.done), self.cursor))
+		try:
+			while True:
+				self.collect()
+				backlog = self.poll(pool)
+				polls += 1
+				if (max_polls is not None) and (polls >= max_polls):
+					break
+				# The first poll only indexes the files: nothing is unchanged since a previous one yet
+				if once and (polls > 1) and not self.in_flight and not backlog:
+					break
+				time.sleep(self.interval)
+			self.finish()
+		except KeyboardInterrupt:
+			print('Stopping: waiting for the %d galaxies being rendered' % len(self.in_flight))
+			self.finish()
+		finally:
+			signal.signal(signal.SIGTERM, terminate)
+			if self.in_flight:
+				# Not recorded in the cursor, so they are rendered again on the next run
+				print('Gave up waiting for %d galaxies: %s' % (len(self.in_flight), ', '.join(sorted(self.in_flight))))
+				# The workers ignore SIGTERM, which is what Pool.terminate() sends
+				for child in multiprocessing.active_children():
+					child.kill()
+				pool.terminate()
+			else:
+				pool.close()
+			pool.join()
+		print('%(done)d galaxies done, %(rejected)d rejected, %(failed)d failed' % self.counts)
+		return dict(self.counts)
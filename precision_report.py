@@ -0,0 +1,160 @@
+#
+# Validation report for running the pipeline in float32 instead of float64
+# Compares the 8-bit output of fits_to_png_bulk.py and Trilogy_rgb.py in both precisions, galaxy by galaxy
+#
+# You can freely use the code
+#
+
+import numpy
+import os
+import sys
+import fits_to_png_bulk
+import Trilogy_rgb
+
+def to_levels(img, levels=256):
+	"""Quantize scaled data in [0, 1] the way a matplotlib colormap with 256 colors does.
+	
+	@type img: numpy array
+	@param img: scaled image data array
+	@type levels: integer
+	@param levels: number of output levels
+	@rtype: numpy array
+	@return: integer array of output levels
+	
+	"""
+	img = numpy.nan_to_num(numpy.asarray(img, dtype=float), nan=0.0)
+	return numpy.clip(numpy.floor(img * levels), 0, levels - 1).astype(int)
+
+def compare(out64, out32):
+	"""Compare two 8-bit outputs.
+	
+	@type out64: numpy array
+	@param out64: output levels of the float64 path
+	@type out32: numpy array
+	@param out32: output levels of the float32 path
+	@rtype: tuple
+	@return: (max. level difference, number of differing pixels, number of pixels)
+	
+	"""
+	diff = numpy.abs(out64.astype(int) - out32.astype(int))
+	return (int(diff.max()), int(numpy.count_nonzero(diff)), diff.size)
+
+def trilogy_levels(channels, dtype, satpercent=0.001, noiselum=0.15):
+	"""Scale R, G, B channels like Trilogy (determinescaling + RGBscale2im) in a given precision.
+	
+	@type channels: list
+	@param channels: list of 3 raw pixel data arrays, R, G, B
+	@type dtype: numpy dtype
+	@param dtype: floating point precision
+	@type satpercent: float
+	@param satpercent: percentage of pixels which will be saturated
+	@type noiselum: float
+	@param noiselum: output luminosity of the noise
+	@rtype: numpy array
+	@return: (ny, nx, 3) uint8 image
+	
+	"""
+	stampRGB = numpy.array(channels, dtype=dtype)
+	unsatpercent = 1 - 0.01 * satpercent
+	levdict = {}
+	noiselums = {}
+	for ichannel, channel in enumerate('RGB'):
+		levdict[channel] = Trilogy_rgb.determinescaling(stampRGB[ichannel], unsatpercent, correctbias=False)
+		noiselums[channel] = noiselum
+	im = Trilogy_rgb.RGBscale2im(stampRGB, levdict, noiselums, 1)
+	return numpy.asarray(im)
+
+def galaxy_ids(folder_fn, filter_list):
+	"""List the IDs of the samples which have a file for every filter.
+	
+	@type folder_fn: string
+	@param folder_fn: name of folder which contains filter folders with desired data
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@rtype: list
+	@return: sorted list of sample ID strings
+	
+	"""
+	ids = None
+	for filt in filter_list:
+		names = os.listdir(folder_fn + '/' + filt)
+		filt_ids = set([name[len('ceers_' + filt + '_'):-5] for name in names if name.endswith('.fits')])
+		ids = filt_ids if ids is None else ids & filt_ids
+	return sorted(ids)
+
+def precision_report(folder_list, mode_list, filter_list, sig_fract, percent_fract, out=sys.stdout):
+	"""Run every galaxy through the float64 and float32 paths and report the output differences.
+	
+	@type folder_list: list
+	@param folder_list: list of sample folder names
+	@type mode_list: list
+	@param mode_list: list of scaling modes
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@type sig_fract: float
+	@param sig_fract: fraction of sigma clipping
+	@type percent_fract: float
+	@param percent_fract: convergence fraction
+	@type out: file
+	@param out: where to write the report
+	@rtype: dictionary
+	@return: dictionary where the key is a mode ('rgb' and 'trilogy' for the composites), and the value is (max. level difference, differing pixels, pixels)
+	
+	"""
+	totals = {}
+	def add(key, result):
+		old = totals.get(key, (0, 0, 0))
+		totals[key] = (max(old[0], result[0]), old[1] + result[1], old[2] + result[2])
+
+	for folder_fn in folder_list:
+		for f_id in galaxy_ids(folder_fn, filter_list):
+			files = fits_to_png_bulk.galaxy_files(folder_fn, f_id, filter_list)
+			data64 = fits_to_png_bulk.load_galaxy(files, sig_fract, percent_fract, dtype=numpy.float64)
+			data32 = fits_to_png_bulk.load_galaxy(files, sig_fract, percent_fract, dtype=numpy.float32)
+			for mode in mode_list:
+				for channel64, channel32 in zip(data64, data32):
+					new64 = fits_to_png_bulk.scale_data(channel64[0], channel64[1], mode, min_val=0.0)
+					new32 = fits_to_png_bulk.scale_data(channel32[0], channel32[1], mode, min_val=0.0)
+					add(mode, compare(to_levels(new64), to_levels(new32)))
+
+			rgb_files = (files[6], files[4], files[1])
+			rgb64 = fits_to_png_bulk.get_rgb(rgb_files, min_val=0.0, dtype=numpy.float64)
+			rgb32 = fits_to_png_bulk.get_rgb(rgb_files, min_val=0.0, dtype=numpy.float32)
+			add('rgb', compare(to_levels(rgb64), to_levels(rgb32)))
+
+			raw = [channel[1] for channel in (data64[6], data64[4], data64[1])]
+			add('trilogy', compare(trilogy_levels(raw, numpy.float64), trilogy_levels(raw, numpy.float32)))
+
+	out.write('%-15s %10s %15s %12s\n' % ('mode', 'max. diff', 'pixels differ', 'fraction'))
+	for key in totals:
+		max_diff, n_diff, n_pix = totals[key]
+		out.write('%-15s %10d %15d %12.2e\n' % (key, max_diff, n_diff, n_diff / float(n_pix)))
+
+	return totals
+
+def main():
+	sig_fract = 5.0
+	percent_fract = 0.01
+
+	scale_modes = ['sqrt',
+			'power',
+			'log',
+			'linear',
+			'asinh_beta_01',
+			'asinh_beta_05',
+			'asinh_beta_20',
+			'histeq',
+			'logistic']
+	
+	filter_list = ['f115w',
+			'f150w',
+			'f200w',
+			'f277w',
+			'f356w',
+			'f410m',
+			'f444w',]
+
+	precision_report(['small_sample', 'sample_2'], scale_modes, filter_list, sig_fract, percent_fract)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,215 @@
+#
+# Prefetching galaxy iterator: reads the next galaxies of a sample on a background thread pool while the current one
+# is being scaled and drawn, so the CPU doesn't idle during .fits reads (slow on NFS) and the disk doesn't idle
+# during the stretches.  At most depth galaxies are read ahead; the queue depth and the time the consumer spent
+# waiting for reads are kept, to check that it never waits in steady state.
+#
+# You can freely use the code
+#
+
+import numpy
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import fits_to_png_bulk
+
+class Galaxy:
+	"""One galaxy, as yielded by iter_galaxies()."""
+
+	def __init__(self, f_id, files, raw, data, headers, rejected=None, error=None, shifts=None):
+		"""
+		@type f_id: string
+		@param f_id: ID of the sample
+		@type files: list
+		@param files: list of file name strings, one per filter
+		@type raw: numpy array
+		@param raw: (filters, width, height) raw pixel data
+		@type data: numpy array
+		@param data: (filters, width, height) raw pixel data minus sky, or None if the sky wasn't subtracted
+		@type headers: list
+		@param headers: list of the astropy FITS headers, one per filter
+		@type rejected: tuple
+		@param rejected: (reasons, statistics) if the galaxy failed the quality gate (then raw and data are None)
+		@type error: Exception
+		@param error: the error reading the galaxy raised, if it did and the prefetcher keeps going (then files, raw, data and headers are None)
+		@type shifts: numpy array
+		@param shifts: (filters, 2) shifts (dy, dx) which registered the filters, if they were (see fits_to_png_bulk.align_and_match())
+
+		"""
+		self.f_id = f_id
+		self.files = files
+		self.raw = raw
+		self.data = data
+		self.headers = headers
+		self.rejected = rejected
+		self.error = error
+		self.shifts = shifts
+
+	def channel_data(self):
+		"""The galaxy as fits_to_png_bulk.load_galaxy() returns it.
+
+		@rtype: list
+		@return: list of (img_data, img_data_raw, width, height) tuples, one per filter
+		"""
+		return [(self.data[i], self.raw[i], self.raw.shape[1], self.raw.shape[2]) for i in range(len(self.files))]
+
+class GalaxyPrefetcher:
+	"""Iterable over the galaxies of a sample, read ahead on a thread pool."""
+
+	def __init__(self, folder_fn, f_ids, filter_list, depth=4, workers=None, sig_fract=5.0, percent_fract=0.01, dtype=float, back_box=None, sky=True, gate=False, register=None, psf_target=None, failures=False, telemetry=None):
+		"""
+		@type folder_fn: string
+		@param folder_fn: name of folder which contains filter folders with desired data
+		@type f_ids: list
+		@param f_ids: list of sample ID strings, in the order to yield them
+		@type filter_list: list
+		@param filter_list: list of filter name strings
+		@type depth: integer
+		@param depth: most galaxies read ahead (being read or waiting)
+		@type workers: integer
+		@param workers: reading threads, depth if None
+		@type sig_fract: float
+		@param sig_fract: fraction of sigma clipping
+		@type percent_fract: float
+		@param percent_fract: convergence fraction
+		@type dtype: numpy dtype
+		@param dtype: floating point precision of the pixel data, float or numpy.float32
+		@type back_box: integer
+		@param back_box: see fits_to_png_bulk.subtract_sky()
+		@type sky: boolean
+		@param sky: subtract the sky in the reading threads too; leave it to the consumer if False
+		@type gate: boolean
+		@param gate: run the quality gate (quality.check_galaxy()) on each galaxy in the reading threads, on the data
+		read for it; galaxies which fail it, have missing files or filters of different sizes are yielded with rejected set
+		@type register: integer
+		@param register: register the filters of each galaxy to the one at this index of filter_list (see registration.py),
+		in the reading thread, after the quality gate and before the sky; None not to
+		@type psf_target: string
+		@param psf_target: convolve the filters of each galaxy to the PSF of this filter (see psfmatch.py), all in one
+		batched pass in the reading thread, after registering them; None to leave them as read
+		@type failures: boolean
+		@param failures: yield the galaxies whose read raises (e.g. a corrupt file) with error set, instead of raising
+		@type telemetry: telemetry.Telemetry
+		@param telemetry: observe the time each galaxy takes to read, as stage_seconds{stage="read"}, and publish the
+		queue depth and the time waited for reads
+
+		"""
+		self.folder_fn = folder_fn
+		self.f_ids = list(f_ids)
+		self.filter_list = filter_list
+		self.depth = max(depth, 1)
+		self.workers = workers or self.depth
+		self.sig_fract = sig_fract
+		self.percent_fract = percent_fract
+		self.dtype = dtype
+		self.back_box = back_box
+		self.sky = sky
+		self.gate = gate
+		self.register = register
+		self.psf_target = psf_target
+		self.failures = failures
+		self.telemetry = telemetry
+		self.pending = deque()
+		self.yielded = 0
+		self.stalls = 0
+		self.stall_time = 0.0
+		self.depth_sum = 0
+
+	def load(self, f_id):
+		"""Read one galaxy (in a reading thread)."""
+		import astropy.io.fits as pyfits
+		start = time.perf_counter()
+		files = fits_to_png_bulk.galaxy_files(self.folder_fn, f_id, self.filter_list)
+		raw = []
+		headers = []
+		for fn in files:
+			if self.gate and not os.path.exists(fn):
+				raw.append(None)
+				headers.append(None)
+				continue
+			with pyfits.open(fn) as hdulist:
+				headers.append(hdulist[0].header.copy())
+				raw.append(numpy.array(hdulist[0].data, dtype=self.dtype))
+		if self.telemetry is not None:
+			self.telemetry.observe('stage_seconds', time.perf_counter() - start, stage='read')
+		if self.gate:
+			import quality
+			rejected = quality.check_galaxy(raw, self.filter_list)
+			if rejected is not None:
+				return Galaxy(f_id, files, None, None, headers, rejected=rejected)
+		raw, shifts = fits_to_png_bulk.align_and_match(numpy.stack(raw), self.filter_list, self.register, self.psf_target)
+		data = None
+		if self.sky:
+			data = numpy.stack([fits_to_png_bulk.subtract_sky(img, self.sig_fract, self.percent_fract, back_box=self.back_box) for img in raw])
+		return Galaxy(f_id, files, raw, data, headers, shifts=shifts)
+
+	def queue_depth(self):
+		"""
+		@rtype: integer
+		@return: galaxies read and waiting to be yielded
+		"""
+		return sum([future.done() for f_id, future in list(self.pending)])
+
+	def __iter__(self):
+		pool = ThreadPoolExecutor(self.workers)
+		if self.telemetry is not None:
+			self.telemetry.gauge('queue_depth', self.queue_depth, queue='prefetch')
+			self.telemetry.gauge('read_wait_seconds', lambda: self.stall_time)
+		ids = iter(self.f_ids)
+		try:
+			for f_id in ids:
+				self.pending.append((f_id, pool.submit(self.load, f_id)))
+				if len(self.pending) >= self.depth:
+					break
+			while self.pending:
+				self.depth_sum += self.queue_depth()
+				f_id, future = self.pending.popleft()
+				if not future.done():
+					start = time.perf_counter()
+					future.exception()
+					self.stall_time += time.perf_counter() - start
+					self.stalls += 1
+				try:
+					galaxy = future.result()
+				except Exception as error:
+					if not self.failures:
+						raise
+					galaxy = Galaxy(f_id, None, None, None, None, error=error)
+				for f_id in ids:
+					self.pending.append((f_id, pool.submit(self.load, f_id)))
+					break
+				self.yielded += 1
+				yield galaxy
+		finally:
+			for f_id, future in self.pending:
+				future.cancel()
+			self.pending.clear()
+			pool.shutdown()
+
+	def stats(self):
+		"""
+		@rtype: dictionary
+		@return: galaxies yielded, times and seconds the consumer waited for a read, mean queue depth when it asked
+		"""
+		return {'galaxies': self.yielded,
+			'stalls': self.stalls,
+			'stall_time': self.stall_time,
+			'mean_depth': self.depth_sum / float(max(self.yielded, 1)),}
+
+def iter_galaxies(folder_fn, f_ids, filter_list, depth=4, **params):
+	"""Iterate over the galaxies of a sample, reading depth galaxies ahead; see GalaxyPrefetcher for the parameters.
+
+	@type folder_fn: string
+	@param folder_fn: name of folder which contains filter folders with desired data
+	@type f_ids: list
+	@param f_ids: list of sample ID strings
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@type depth: integer
+	@param depth: most galaxies read ahead
+	@rtype: GalaxyPrefetcher
+	@return: iterable of Galaxy objects, whose stats() and queue_depth() can be checked while iterating
+
+	"""
+	return GalaxyPrefetcher(folder_fn, f_ids, filter_list, depth=depth, **params)
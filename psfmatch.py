@@ -0,0 +1,175 @@
+#
+# PSF matching: convolve every filter of a sample to the resolution of the broadest one before making an RGB image
+#
+# You can freely use the code
+#
+
+import numpy
+import os
+import re
+import functools
+
+# FWHM (arcsec) of the NIRCam PSFs, from the JWST User Documentation (NIRCam Point Spread Functions)
+psf_fwhm = {'f070w': 0.023,
+		'f090w': 0.030,
+		'f115w': 0.040,
+		'f150w': 0.050,
+		'f200w': 0.066,
+		'f277w': 0.092,
+		'f356w': 0.116,
+		'f410m': 0.137,
+		'f444w': 0.145,}
+
+# arcsec per pixel of the CEERS cutouts
+pixel_scale = 0.03
+
+def filter_of(fn):
+	"""Find the filter name in a file name, like ceers_f150w_30258.fits.
+
+	@type fn: string
+	@param fn: file name
+	@rtype: string
+	@return: lower case filter name, or None if there is none
+
+	"""
+	found = re.search(r'f\d{3}[wmn]', os.path.basename(fn).lower())
+	if found:
+		return found.group(0)
+	return None
+
+def broadest(filter_list):
+	"""Filter with the broadest PSF.
+
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@rtype: string
+	@return: filter name
+
+	"""
+	return max(filter_list, key=lambda filt: psf_fwhm[filt.lower()])
+
+def matching_sigma(filt, target, scale=pixel_scale):
+	"""Width of the Gaussian kernel which turns the PSF of filt into the PSF of target.
+
+	@type filt: string
+	@param filt: filter name
+	@type target: string
+	@param target: filter name of the (broader) target PSF
+	@type scale: float
+	@param scale: arcsec per pixel
+	@rtype: float
+	@return: sigma of the kernel, in pixels (0 if filt is already as broad as target)
+
+	"""
+	fwhm = psf_fwhm[filt.lower()]
+	fwhm_target = psf_fwhm[target.lower()]
+	return numpy.sqrt(max(fwhm_target**2 - fwhm**2, 0.0)) / (2.0 * numpy.sqrt(2.0 * numpy.log(2.0))) / scale
+
+def margin(filter_list, target, scale=pixel_scale):
+	"""Pixels of padding which keep the FFT convolution from wrapping around the image edges.
+
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@type target: string
+	@param target: filter name of the target PSF
+	@type scale: float
+	@param scale: arcsec per pixel
+	@rtype: integer
+	@return: 5 sigma of the widest matching kernel
+
+	"""
+	return int(numpy.ceil(5 * max([matching_sigma(filt, target, scale) for filt in filter_list])))
+
+def common_margin(target, scale=pixel_scale):
+	"""Padding of the widest matching kernel of any filter of psf_fwhm, so that the same filter gives the same matched
+	image whether it is matched alone or in a stack with others (the padding changes the edges slightly).
+
+	@type target: string
+	@param target: filter name of the target PSF
+	@type scale: float
+	@param scale: arcsec per pixel
+	@rtype: integer
+	@return: pixels of padding
+
+	"""
+	return margin(list(psf_fwhm), target, scale)
+
+@functools.lru_cache(maxsize=128)
+def kernel_transform(filt, target, shape, scale=pixel_scale, dtype='float64'):
+	"""Fourier transform of the matching kernel of one filter, as numpy.fft.rfft2() lays it out, cached per (filter, shape).
+
+	@type filt: string
+	@param filt: filter name
+	@type target: string
+	@param target: filter name of the target PSF
+	@type shape: tuple
+	@param shape: (ny, nx) shape of the (padded) images
+	@type scale: float
+	@param scale: arcsec per pixel
+	@type dtype: string
+	@param dtype: floating point precision of the images
+	@rtype: numpy array
+	@return: read-only (ny, nx // 2 + 1) transform
+
+	"""
+	sigma = matching_sigma(filt, target, scale)
+	ky = numpy.fft.fftfreq(shape[0])[:, None]
+	kx = numpy.fft.rfftfreq(shape[1])[None, :]
+	transform = numpy.exp(-2.0 * (numpy.pi * sigma)**2 * (ky**2 + kx**2)).astype(dtype)
+	transform.flags.writeable = False
+	return transform
+
+def match_stack(stack, filter_list, target=None, scale=pixel_scale, pad=None):
+	"""Convolve every filter of a stack to the PSF of the target filter, in one batched FFT pass.
+
+	@type stack: numpy array
+	@param stack: (..., len(filter_list), ny, nx) stack, e.g. (samples, 7, 100, 100)
+	@type filter_list: list
+	@param filter_list: list of filter name strings, one per image along the filter axis
+	@type target: string
+	@param target: filter name of the target PSF, the broadest of filter_list if None
+	@type scale: float
+	@param scale: arcsec per pixel
+	@type pad: integer
+	@param pad: pixels of padding, margin(filter_list, target) if None; see common_margin()
+	@rtype: numpy array
+	@return: matched stack, in the floating point precision of stack
+
+	"""
+	stack = numpy.asarray(stack)
+	dtype = numpy.result_type(stack.dtype, numpy.float32)
+	if target is None:
+		target = broadest(filter_list)
+	if pad is None:
+		pad = margin(filter_list, target, scale)
+	if (pad == 0) or (margin(filter_list, target, scale) == 0):
+		return stack.astype(dtype)
+
+	ny, nx = stack.shape[-2:]
+	widths = [(0, 0)] * (stack.ndim - 2) + [(pad, pad), (pad, pad)]
+	padded = numpy.pad(stack.astype(dtype, copy=False), widths, mode='reflect')
+	shape = padded.shape[-2:]
+	transforms = numpy.stack([kernel_transform(filt.lower(), target.lower(), shape, scale, dtype.name) for filt in filter_list])
+
+	matched = numpy.fft.irfft2(numpy.fft.rfft2(padded) * transforms, s=shape)
+	return matched[..., pad:pad + ny, pad:pad + nx].astype(dtype, copy=False)
+
+def match_galaxy(channel_data, filter_list, target=None, scale=pixel_scale):
+	"""PSF match the filters of one sample, as loaded by fits_to_png_bulk.load_galaxy().
+
+	@type channel_data: list
+	@param channel_data: (img_data, img_data_raw, width, height) tuples from fits_to_png_bulk.load_galaxy()
+	@type filter_list: list
+	@param filter_list: list of filter name strings, in the order of channel_data
+	@type target: string
+	@param target: filter name of the target PSF, the broadest of filter_list if None
+	@type scale: float
+	@param scale: arcsec per pixel
+	@rtype: list
+	@return: list of matched (img_data, img_data_raw, width, height) tuples
+
+	"""
+	img_data = numpy.stack([channel[0] for channel in channel_data])
+	img_data_raw = numpy.stack([channel[1] for channel in channel_data])
+	matched = match_stack(numpy.stack([img_data, img_data_raw]), filter_list, target, scale)
+	return [(matched[0][i], matched[1][i], channel[2], channel[3]) for i, channel in enumerate(channel_data)]
@@ -0,0 +1,219 @@
+#
+# Multi-resolution tile pyramid (Deep Zoom .dzi or XYZ {z}/{x}/{y} layout), written while the image is being made
+# Sections can be added in any order; each band of tiles is written as soon as it is complete, then averaged 2x2 into
+# the next level down, so only about one band of tiles per level is held in memory.
+# Thumbnails of any width are made from the smallest level which is at least that wide.
+#
+# You can freely use the code
+#
+
+import numpy
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+layouts = ['dzi', 'xyz']
+
+def halve(band):
+	"""Average 2x2 blocks of pixels; an odd last row or column is averaged with itself.
+
+	@type band: numpy array
+	@param band: (height, width, channels) uint8 pixels
+	@rtype: numpy array
+	@return: (ceil(height/2), ceil(width/2), channels) uint8 pixels
+
+	"""
+	h, w = band.shape[:2]
+	if (h % 2) or (w % 2):
+		band = numpy.pad(band, ((0, h % 2), (0, w % 2), (0, 0)), mode='edge')
+	band = band.astype(numpy.uint16)
+	return ((band[0::2, 0::2] + band[1::2, 0::2] + band[0::2, 1::2] + band[1::2, 1::2] + 2) // 4).astype(numpy.uint8)
+
+class PyramidLevel:
+	"""One level of a TilePyramid: the bands of tiles which are still being filled."""
+
+	def __init__(self, pyramid, level, width, height, below=None):
+		self.pyramid = pyramid
+		self.level = level
+		self.width = width
+		self.height = height
+		self.below = below  # next (coarser) level
+		self.bands = {}  # tile row: [(height, width, channels) pixels, pixels filled]
+
+	def add(self, data, x0, y0):
+		"""Paste pixels at x0, y0 (from the top left) and write the bands of tiles they complete."""
+		ts = self.pyramid.tilesize
+		h, w = data.shape[:2]
+		for row in range(y0 // ts, (y0 + h - 1) // ts + 1):
+			top = row * ts
+			bottom = min(top + ts, self.height)
+			lo = max(y0, top)
+			hi = min(y0 + h, bottom)
+			if hi <= lo:
+				continue
+			if row not in self.bands:
+				self.bands[row] = [numpy.zeros((bottom - top, self.width, self.pyramid.channels), numpy.uint8), 0]
+			band = self.bands[row]
+			band[0][lo - top:hi - top, x0:x0 + w] = data[lo - y0:hi - y0]
+			band[1] += (hi - lo) * w
+			if band[1] >= (bottom - top) * self.width:
+				self.finish(row)
+
+	def finish(self, row):
+		"""Write a band of tiles and pass it on, averaged, to the next level."""
+		band = self.bands.pop(row)[0]
+		ts = self.pyramid.tilesize
+		for col in range(0, (self.width + ts - 1) // ts):
+			self.pyramid.write(self.level, col, row, band[:, col * ts:(col + 1) * ts])
+		if self.below is not None:
+			self.below.add(halve(band), 0, row * ts // 2)
+
+	def flush(self):
+		"""Write the bands which were never completed (parts of the image which were not made are black)."""
+		for row in sorted(self.bands):
+			self.finish(row)
+
+class TilePyramid:
+	"""Tile pyramid of an image made in sections, e.g. by Trilogy's makecolorimage."""
+
+	def __init__(self, outroot, width, height, mode='RGB', layout='dzi', tilesize=256, fmt='png', workers=4):
+		"""
+		@type outroot: string
+		@param outroot: output name without extension: outroot.dzi and outroot_files/, or outroot/ for xyz
+		@type width: integer
+		@param width: width of the full image, in pixels
+		@type height: integer
+		@param height: height of the full image, in pixels
+		@type mode: string
+		@param mode: PIL mode of the tiles, 'RGB' or 'L'
+		@type layout: string
+		@param layout: 'dzi' (outroot_files/level/col_row.fmt) or 'xyz' (outroot/z/x/y.fmt, z=0 a single tile)
+		@type tilesize: integer
+		@param tilesize: side of the tiles, in pixels
+		@type fmt: string
+		@param fmt: image format of the tiles, png or jpg
+		@type workers: integer
+		@param workers: threads encoding tiles
+
+		"""
+		if layout not in layouts:
+			raise ValueError('Unknown pyramid layout %r, expected one of %s' % (layout, ', '.join(layouts)))
+		self.outroot = outroot
+		self.width = width
+		self.height = height
+		self.mode = mode
+		self.channels = len(mode)
+		self.layout = layout
+		self.tilesize = tilesize
+		self.fmt = fmt
+		self.maxlevel = int(math.ceil(math.log2(max([width, height, 1]))))
+		self.sizes = []  # (width, height) of each level, level 0 is 1x1
+		for level in range(self.maxlevel + 1):
+			scale = 2 ** (self.maxlevel - level)
+			self.sizes.append(((width + scale - 1) // scale, (height + scale - 1) // scale))
+		# xyz starts at the largest level which is a single tile
+		self.minlevel = 0
+		if layout == 'xyz':
+			self.minlevel = max([level for level in range(self.maxlevel + 1) if max(self.sizes[level]) <= tilesize])
+		self.levels = None
+		for level in range(self.minlevel, self.maxlevel + 1):
+			self.levels = PyramidLevel(self, level, self.sizes[level][0], self.sizes[level][1], self.levels)
+		self.pool = ThreadPoolExecutor(workers)
+		self.pending = []
+		self.tiles = 0
+
+	def add(self, im, x0, y0):
+		"""Add a section of the full image.
+
+		@type im: PIL image or numpy array
+		@param im: section
+		@type x0: integer
+		@param x0: column of its left edge in the full image
+		@type y0: integer
+		@param y0: row of its top edge in the full image (the position given to Image.paste)
+		@rtype: None
+
+		"""
+		data = numpy.asarray(im, numpy.uint8)
+		if data.ndim == 2:
+			data = data[:, :, numpy.newaxis]
+		if (x0 < 0) or (y0 < 0):
+			data = data[max([-y0, 0]):, max([-x0, 0]):]
+			x0, y0 = max([x0, 0]), max([y0, 0])
+		data = data[:self.height - y0, :self.width - x0]
+		if data.size:
+			self.levels.add(data, x0, y0)
+
+	def path(self, level, col, row):
+		"""File name of a tile."""
+		if self.layout == 'dzi':
+			return os.path.join(self.outroot + '_files', str(level), '%d_%d.%s' % (col, row, self.fmt))
+		return os.path.join(self.outroot, str(level - self.minlevel), str(col), '%d.%s' % (row, self.fmt))
+
+	def write(self, level, col, row, tile):
+		"""Save a tile in the background, waiting if too many are queued."""
+		outfile = self.path(level, col, row)
+		os.makedirs(os.path.dirname(outfile), exist_ok=True)
+		tile = tile[:, :, 0] if self.channels == 1 else tile
+		self.pending.append(self.pool.submit(Image.fromarray(numpy.ascontiguousarray(tile), self.mode).save, outfile))
+		self.tiles += 1
+		if len(self.pending) > 64:
+			for future in self.pending:
+				future.result()
+			self.pending = []
+
+	def close(self):
+		"""Write what is left, wait for every tile and write the .dzi descriptor.
+
+		@rtype: integer
+		@return: number of tiles written
+
+		"""
+		level = self.levels
+		while level is not None:  # finest first, as each level feeds the next one
+			level.flush()
+			level = level.below
+		for future in self.pending:
+			future.result()
+		self.pending = []
+		self.pool.shutdown()
+		if self.layout == 'dzi':
+			with open(self.outroot + '.dzi', 'w') as fout:
+				fout.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+				fout.write('<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="%s" Overlap="0" TileSize="%d">\n' % (self.fmt, self.tilesize))
+				fout.write('  <Size Width="%d" Height="%d"/>\n' % (self.width, self.height))
+				fout.write('</Image>\n')
+		return self.tiles
+
+	def levelimage(self, level):
+		"""Assemble one (written) level from its tiles.
+
+		@type level: integer
+		@param level: DZI level number, maxlevel is the full image
+		@rtype: PIL image
+		@return: the level
+
+		"""
+		level = max([level, self.minlevel])
+		width, height = self.sizes[level]
+		ts = self.tilesize
+		im = Image.new(self.mode, (width, height))
+		for row in range((height + ts - 1) // ts):
+			for col in range((width + ts - 1) // ts):
+				with Image.open(self.path(level, col, row)) as tile:
+					im.paste(tile, (col * ts, row * ts))
+		return im
+
+	def thumbnail(self, width):
+		"""Downsampled image of a given width, from the smallest level which is at least as wide (after close()).
+
+		@type width: integer
+		@param width: width of the thumbnail, in pixels
+		@rtype: PIL image
+		@return: thumbnail, with the aspect ratio of the full image
+
+		"""
+		level = min([level for level in range(self.maxlevel + 1) if self.sizes[level][0] >= width] + [self.maxlevel])
+		height = max([int(round(width * self.height / float(self.width))), 1])
+		return self.levelimage(level).resize((width, height), Image.LANCZOS)
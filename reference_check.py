@@ -0,0 +1,299 @@
+#
+# Equivalence check of the fast paths (accel.py kernels, img_scale.stretch_batch(), float32) against the original functions
+# Runs each original function and each counterpart on generated cutouts and on the small_sample cutouts, reports how far
+# the outputs differ, how many rendered 8-bit pixels change and the speedup, and fails if a difference is out of tolerance
+#
+# You can freely use the code
+#
+
+import numpy
+import sys
+import time
+import accel
+import img_scale
+import Trilogy_rgb
+import fits_to_png_bulk
+import precision_report
+
+# Tolerances: max. difference relative to the largest reference value, max. rendered level difference,
+# and max. fraction of rendered pixels which may differ at all
+exact = (1e-9, 1, 1e-3)
+single = (1e-3, 1, 1e-3)
+
+# fits_to_png_bulk.scale_data() modes: (img_scale function, parameters, raw data?, scale_min=min_val?)
+stretches = {'sqrt': ('sqrt', {}, False, True),
+		'power': ('power', {'power_index': 3.0}, False, True),
+		'log': ('log', {'exponent': 1000}, True, True),
+		'linear': ('linear', {}, False, True),
+		'asinh_beta_01': ('asinh', {'non_linear': 0.01}, False, True),
+		'asinh_beta_05': ('asinh', {'non_linear': 0.5}, False, True),
+		'asinh_beta_20': ('asinh', {'non_linear': 2.0}, False, True),
+		'histeq': ('histeq', {'num_bins': 256}, True, False),
+		'logistic': ('logistic', {'center': 0.03, 'slope': 0.3}, True, False),}
+
+def generated_cutouts(n=16, size=100, seed=0, sig_fract=5.0, percent_fract=0.01):
+	"""Make cutouts of disk galaxies: an inclined exponential disk and a bulge on a sky with noise, and a few stars.
+
+	@type n: integer
+	@param n: number of cutouts
+	@type size: integer
+	@param size: side of the cutouts, in pixels
+	@type seed: integer
+	@param seed: random seed, so every run checks the same data
+	@type sig_fract: float
+	@param sig_fract: fraction of sigma clipping for the sky subtraction
+	@type percent_fract: float
+	@param percent_fract: convergence fraction for the sky subtraction
+	@rtype: tuple
+	@return: ((n, size, size) data minus sky, (n, size, size) raw data)
+
+	"""
+	rng = numpy.random.default_rng(seed)
+	y, x = numpy.mgrid[:size, :size] - (size - 1) / 2.0
+	raw = numpy.empty((n, size, size))
+	for i in range(n):
+		angle = rng.uniform(0, numpy.pi)
+		axis_ratio = rng.uniform(0.1, 1.0)
+		u = x * numpy.cos(angle) + y * numpy.sin(angle)
+		v = (y * numpy.cos(angle) - x * numpy.sin(angle)) / axis_ratio
+		r = numpy.hypot(u, v)
+		scale = rng.uniform(0.03, 0.15) * size
+		image = rng.uniform(0.05, 2.0) * numpy.exp(-r / scale) + rng.uniform(0.1, 5.0) * numpy.exp(-(r / (0.1 * scale))**0.5 * 7.67)
+		for star in range(rng.integers(0, 4)):
+			sy, sx = rng.uniform(0, size, 2)
+			image += rng.uniform(0.5, 20.0) * numpy.exp(-((y + (size - 1) / 2.0 - sy)**2 + (x + (size - 1) / 2.0 - sx)**2) / 2.0)
+		raw[i] = image + rng.uniform(0.0, 0.05) + rng.normal(0.0, rng.uniform(0.005, 0.02), (size, size))
+	data = numpy.array([fits_to_png_bulk.subtract_sky(image, sig_fract, percent_fract) for image in raw])
+	return (data, raw)
+
+def sample_cutouts(folder_fn, filter_list, sig_fract=5.0, percent_fract=0.01):
+	"""Load every cutout of a sample folder.
+
+	@type folder_fn: string
+	@param folder_fn: name of folder which contains filter folders with desired data
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@type sig_fract: float
+	@param sig_fract: fraction of sigma clipping
+	@type percent_fract: float
+	@param percent_fract: convergence fraction
+	@rtype: tuple
+	@return: ((galaxies, filters, ny, nx) data minus sky, (galaxies, filters, ny, nx) raw data)
+
+	"""
+	galaxies = []
+	for f_id in precision_report.galaxy_ids(folder_fn, filter_list):
+		files = fits_to_png_bulk.galaxy_files(folder_fn, f_id, filter_list)
+		galaxies.append(fits_to_png_bulk.load_galaxy(files, sig_fract, percent_fract))
+	data = numpy.array([[channel[0] for channel in galaxy] for galaxy in galaxies])
+	raw = numpy.array([[channel[1] for channel in galaxy] for galaxy in galaxies])
+	return (data, raw)
+
+def with_accel(flag, func):
+	"""Wrap a function so it runs with the accel.py kernels turned on or off.
+
+	@type flag: boolean
+	@param flag: True for the compiled kernels, False for the numpy code
+	@type func: function
+	@param func: function of no arguments
+	@rtype: function
+	@return: wrapped function
+
+	"""
+	def run():
+		previous = accel.enabled
+		accel.use(flag)
+		try:
+			return func()
+		finally:
+			accel.enabled = previous
+	return run
+
+def timed(func, repeat=3):
+	"""Run a function after one warm-up call (which compiles the kernels) and keep the fastest time.
+
+	@type func: function
+	@param func: function of no arguments
+	@type repeat: integer
+	@param repeat: number of timed calls
+	@rtype: tuple
+	@return: (result, seconds of the fastest call)
+
+	"""
+	result = func()
+	best = numpy.inf
+	for i in range(repeat):
+		start = time.perf_counter()
+		result = func()
+		best = min(best, time.perf_counter() - start)
+	return (result, best)
+
+def compare(reference, candidate, output='scaled'):
+	"""Compare a counterpart's output with the reference output.
+
+	@type reference: numpy array
+	@param reference: output of the original function
+	@type candidate: numpy array
+	@param candidate: output of the counterpart
+	@type output: string
+	@param output: 'scaled' for scaled data in [0, 1] (also compared as 8-bit levels), 'levels' for 8-bit images, 'values' for anything else
+	@rtype: tuple
+	@return: (max. difference relative to the largest reference value, mean relative difference, max. level difference, differing pixels, pixels)
+
+	"""
+	reference = numpy.asarray(reference, dtype=float)
+	candidate = numpy.asarray(candidate, dtype=float)
+	if reference.shape != candidate.shape:
+		return (numpy.inf, numpy.inf, 255, reference.size, reference.size)
+	nan_ref = numpy.isnan(reference)
+	nan_mismatch = nan_ref != numpy.isnan(candidate)
+	diff = numpy.abs(numpy.where(nan_ref | nan_mismatch, 0.0, reference - candidate))
+	diff[nan_mismatch] = numpy.inf
+	scale = max(numpy.nanmax(numpy.abs(reference)) if not nan_ref.all() else 0.0, numpy.finfo(float).tiny)
+	if output == 'scaled':
+		levels = precision_report.compare(precision_report.to_levels(reference), precision_report.to_levels(candidate))
+	elif output == 'levels':
+		levels = precision_report.compare(reference, candidate)
+	else:
+		levels = (0, 0, diff.size)
+	return (diff.max() / scale, diff.mean() / scale, levels[0], levels[1], levels[2])
+
+def stretch_checks(name, data, raw, min_val=0.0):
+	"""Checks of the img_scale.py scalings, as fits_to_png_bulk.scale_data() calls them, on a stack of cutouts.
+
+	@type name: string
+	@param name: name of the data set
+	@type data: numpy array
+	@param data: (..., ny, nx) data minus sky
+	@type raw: numpy array
+	@param raw: (..., ny, nx) raw data
+	@type min_val: float
+	@param min_val: minimum data value
+	@rtype: list
+	@return: list of (check name, reference function, {counterpart name: (function, tolerance)}, output) tuples
+
+	"""
+	checks = []
+	images = data.reshape((-1,) + data.shape[-2:])
+	raw_images = raw.reshape((-1,) + raw.shape[-2:])
+
+	def per_image(func_name, params, stack, scale_min):
+		func = getattr(img_scale, func_name)
+		if scale_min:
+			return lambda: numpy.array([func(image, scale_min=min_val, **params) for image in stack])
+		return lambda: numpy.array([func(image, **params) for image in stack])
+
+	def batch(func_name, params, stack, scale_min):
+		return lambda: img_scale.stretch_batch(stack, func_name, scale_min=min_val if scale_min else None, **params)
+
+	for mode in stretches:
+		func_name, params, use_raw, scale_min = stretches[mode]
+		stack = raw_images if use_raw else images
+		counterparts = {'batch': (with_accel(False, batch(func_name, params, stack, scale_min)), exact),
+				'float32': (with_accel(False, per_image(func_name, params, stack.astype(numpy.float32), scale_min)), single),}
+		if func_name in accel.modes:
+			counterparts['accel'] = (with_accel(True, per_image(func_name, params, stack, scale_min)), exact)
+		checks.append((name + ' ' + mode, with_accel(False, per_image(func_name, params, stack, scale_min)), counterparts, 'scaled'))
+
+	def sky(func_name, stack):
+		func = getattr(img_scale, func_name)
+		return lambda: numpy.array([func(image, 5.0, 0.01, max_iter=10)[0] for image in stack])
+
+	for func_name in ('sky_mean_sig_clip', 'sky_median_sig_clip'):
+		counterparts = {'float32': (with_accel(False, sky(func_name, raw_images.astype(numpy.float32))), single),}
+		if accel.available:
+			counterparts['accel'] = (with_accel(True, sky(func_name, raw_images)), exact)
+		checks.append((name + ' ' + func_name, with_accel(False, sky(func_name, raw_images)), counterparts, 'values'))
+	return checks
+
+def trilogy_checks(name, raw, satpercent=0.001, noiselum=0.15):
+	"""Checks of Trilogy's determinescaling(), imscale2() and RGBscale2im() on the R, G, B channels of a stack of cutouts.
+
+	@type name: string
+	@param name: name of the data set
+	@type raw: numpy array
+	@param raw: (galaxies, 3, ny, nx) raw R, G, B data
+	@type satpercent: float
+	@param satpercent: percentage of pixels which will be saturated
+	@type noiselum: float
+	@param noiselum: output luminosity of the noise
+	@rtype: list
+	@return: list of (check name, reference function, {counterpart name: (function, tolerance)}, output) tuples
+
+	"""
+	unsatpercent = 1 - 0.01 * satpercent
+	noiselums = dict([(channel, noiselum) for channel in 'RGB'])
+
+	def levels(stack):
+		return lambda: numpy.array([[Trilogy_rgb.determinescaling(channel, unsatpercent, correctbias=False) for channel in galaxy] for galaxy in stack])
+
+	def scaled(stack):
+		levdicts = [dict(zip('RGB', galaxy)) for galaxy in levels(raw)()]
+		return lambda: numpy.array([[Trilogy_rgb.imscale2(channel, levdict[key], noiselum) for channel, key in zip(galaxy, 'RGB')] for galaxy, levdict in zip(stack, levdicts)])
+
+	def rendered(stack):
+		return lambda: numpy.array([numpy.asarray(Trilogy_rgb.RGBscale2im(galaxy, dict(zip('RGB', galaxy_levels)), noiselums, 1)) for galaxy, galaxy_levels in zip(stack, levels(stack)())])
+
+	raw32 = raw.astype(numpy.float32)
+	checks = [(name + ' determinescaling', with_accel(False, levels(raw)), {'float32': (with_accel(False, levels(raw32)), single)}, 'values')]
+	for check, func in (('imscale2', scaled), ('RGBscale2im', rendered)):
+		counterparts = {'float32': (with_accel(False, func(raw32)), single)}
+		if accel.available:
+			counterparts['accel'] = (with_accel(True, func(raw)), exact)
+		checks.append((name + ' ' + check, with_accel(False, func(raw)), counterparts, 'levels'))
+	return checks
+
+def reference_check(checks, repeat=3, out=sys.stdout):
+	"""Run each check's reference and counterparts, and report the differences and speedups.
+
+	@type checks: list
+	@param checks: (check name, reference function, {counterpart name: (function, tolerance)}, output) tuples (see compare() for output), from stretch_checks() and trilogy_checks()
+	@type repeat: integer
+	@param repeat: number of timed calls of each function
+	@type out: file
+	@param out: where to write the report
+	@rtype: list
+	@return: list of (check name, counterpart name) whose differences are out of tolerance
+
+	"""
+	failures = []
+	out.write('%-36s %-8s %10s %10s %6s %10s %8s  %s\n' % ('check', 'path', 'max. diff', 'mean diff', 'levels', 'px differ', 'speedup', 'status'))
+	for name, reference, counterparts, output in checks:
+		expected, reference_time = timed(reference, repeat)
+		for path in counterparts:
+			func, (tolerance, max_levels, max_fraction) = counterparts[path]
+			result, path_time = timed(func, repeat)
+			max_diff, mean_diff, level_diff, n_diff, n_pix = compare(expected, result, output)
+			# 8-bit images are judged by their levels alone
+			ok = ((output == 'levels') or (max_diff <= tolerance)) and (level_diff <= max_levels) and (n_diff <= max_fraction * n_pix)
+			if not ok:
+				failures.append((name, path))
+			out.write('%-36s %-8s %10.2e %10.2e %6d %10d %7.2fx  %s\n' % (name, path, max_diff, mean_diff, level_diff, n_diff, reference_time / max(path_time, 1e-9), 'ok' if ok else 'FAIL'))
+	return failures
+
+def main():
+	filter_list = ['f115w',
+			'f150w',
+			'f200w',
+			'f277w',
+			'f356w',
+			'f410m',
+			'f444w',]
+
+	generated, generated_raw = generated_cutouts()
+	large, large_raw = generated_cutouts(n=2, size=2000, seed=1)
+	sample, sample_raw = sample_cutouts('small_sample', filter_list)
+
+	checks = stretch_checks('generated', generated, generated_raw)
+	checks += stretch_checks('generated 2000', large, large_raw)
+	checks += stretch_checks('small_sample', sample, sample_raw)
+	checks += trilogy_checks('generated', generated_raw[:15].reshape(5, 3, 100, 100))
+	checks += trilogy_checks('small_sample', sample_raw[:, [6, 4, 1]])
+
+	failures = reference_check(checks)
+	if failures:
+		print('%d counterparts out of tolerance' % len(failures))
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,249 @@
+#
+# Sub-pixel registration of the filters of a sample (or of a Trilogy_rgb.py mosaic) by phase correlation
+#
+# You can freely use the code
+#
+
+import numpy
+
+def hann_window(shape, dtype=float):
+	"""2D Hann window, which tapers the image edges to zero before the FFT.
+
+	@type shape: tuple
+	@param shape: (ny, nx) shape of the images
+	@type dtype: numpy dtype
+	@param dtype: floating point precision of the window
+	@rtype: numpy array
+	@return: (ny, nx) window
+
+	"""
+	wy = numpy.hanning(shape[0]).astype(dtype)
+	wx = numpy.hanning(shape[1]).astype(dtype)
+	return wy[:, None] * wx[None, :]
+
+def _upsampled_dft(spectrum, region_size, upsample_factor, offsets):
+	"""Cross correlation of each image in a small region around its peak, upsampled by a matrix DFT.
+
+	@type spectrum: numpy array
+	@param spectrum: (n, ny, nx) complex conjugate of the cross-power spectra
+	@type region_size: integer
+	@param region_size: side of the upsampled region, in upsampled pixels
+	@type upsample_factor: integer
+	@param upsample_factor: upsampling factor
+	@type offsets: numpy array
+	@param offsets: (n, 2) position of the region's first pixel, in upsampled pixels
+	@rtype: numpy array
+	@return: (n, region_size, region_size) complex cross correlation
+
+	"""
+	n, ny, nx = spectrum.shape
+	region = numpy.arange(region_size)
+	kernel_x = numpy.exp(-2j * numpy.pi * (region[None, :, None] - offsets[:, 1, None, None]) * numpy.fft.fftfreq(nx, upsample_factor)[None, None, :])
+	kernel_y = numpy.exp(-2j * numpy.pi * (region[None, :, None] - offsets[:, 0, None, None]) * numpy.fft.fftfreq(ny, upsample_factor)[None, None, :])
+	cross = numpy.einsum('nux,nyx->nyu', kernel_x, spectrum)
+	return numpy.einsum('nvy,nyu->nvu', kernel_y, cross)
+
+class Registration:
+	"""Phase correlation (whiten=1) or cross correlation (whiten=0) against one reference image, whose FFT is computed once and reused for every image registered to it."""
+
+	def __init__(self, reference, upsample_factor=20, max_shift=None, whiten=0.0):
+		"""
+		@type reference: numpy array
+		@param reference: (ny, nx) reference image, e.g. the reddest filter
+		@type upsample_factor: integer
+		@param upsample_factor: shifts are found to 1 / upsample_factor of a pixel
+		@type max_shift: float
+		@param max_shift: largest shift (pixels) searched for along each axis, anywhere in the image if None
+		@type whiten: float
+		@param whiten: the cross-power spectrum is divided by its amplitude to this power; 1 is pure phase correlation, 0 plain cross correlation. Our cutouts are noise-dominated at high frequencies, which pure phase correlation weights as much as the galaxy: between the filters of sample_2 it scatters by about 1 pixel, against about 0.2 pixel for 0
+
+		"""
+		reference = numpy.asarray(reference)
+		self.shape = reference.shape
+		self.dtype = numpy.result_type(reference.dtype, numpy.float32)
+		self.upsample_factor = upsample_factor
+		self.max_shift = max_shift
+		self.whiten = whiten
+		self.window = hann_window(self.shape, self.dtype)
+		self.reference_fft = numpy.fft.fft2(self.taper(reference))
+
+	def taper(self, stack):
+		"""Apply the Hann window.
+
+		@type stack: numpy array
+		@param stack: (..., ny, nx) images
+		@rtype: numpy array
+		@return: tapered copy of the images
+
+		"""
+		stack = numpy.asarray(stack, dtype=self.dtype)
+		return stack * self.window
+
+	def estimate(self, stack):
+		"""Measure the shift of each image of a stack relative to the reference.
+
+		@type stack: numpy array
+		@param stack: (ny, nx) image or (n, ny, nx) stack, the same shape as the reference
+		@rtype: numpy array
+		@return: (2,) or (n, 2) shifts (dy, dx), in pixels, by which each image is displaced from the reference
+
+		"""
+		stack = numpy.asarray(stack)
+		single = stack.ndim == 2
+		stack = stack.reshape((-1,) + self.shape)
+		n = stack.shape[0]
+		ny, nx = self.shape
+
+		spectrum = numpy.fft.fft2(self.taper(stack)) * self.reference_fft.conj()
+		if self.whiten:
+			spectrum /= numpy.maximum(numpy.abs(spectrum), numpy.finfo(self.dtype).tiny)**self.whiten
+		correlation = numpy.abs(numpy.fft.ifft2(spectrum))
+
+		if self.max_shift is not None:
+			dy = numpy.abs(numpy.fft.fftfreq(ny, 1.0 / ny))
+			dx = numpy.abs(numpy.fft.fftfreq(nx, 1.0 / nx))
+			correlation[:, (dy[:, None] > self.max_shift) | (dx[None, :] > self.max_shift)] = 0
+
+		peaks = numpy.argmax(correlation.reshape(n, -1), axis=1)
+		shifts = numpy.stack(numpy.unravel_index(peaks, self.shape), axis=1).astype(float)
+		size = numpy.array(self.shape)
+		shifts = numpy.where(shifts > size // 2, shifts - size, shifts)
+
+		if self.upsample_factor > 1:
+			u = self.upsample_factor
+			region_size = int(numpy.ceil(u * 1.5))
+			center = region_size // 2
+			shifts = numpy.round(shifts * u) / u
+			upsampled = numpy.abs(_upsampled_dft(spectrum.conj(), region_size, u, center - shifts * u))
+			peaks = numpy.argmax(upsampled.reshape(n, -1), axis=1)
+			fine = numpy.stack(numpy.unravel_index(peaks, upsampled.shape[1:]), axis=1)
+			shifts = shifts + (fine - center) / float(u)
+
+		if single:
+			return shifts[0]
+		return shifts
+
+def _shifted(data, offset, axis):
+	"""Copy of data moved by a whole number of pixels along one axis, with zeros shifted in.
+
+	@type data: numpy array
+	@param data: image or stack
+	@type offset: integer
+	@param offset: pixels to move by; result[i] = data[i - offset]
+	@type axis: integer
+	@param axis: axis to move along
+	@rtype: numpy array
+	@return: moved copy of data
+
+	"""
+	data = numpy.moveaxis(data, axis, -1)
+	moved = numpy.zeros_like(data)
+	n = data.shape[-1]
+	if abs(offset) < n:
+		if offset >= 0:
+			moved[..., offset:] = data[..., :n - offset]
+		else:
+			moved[..., :offset] = data[..., -offset:]
+	return numpy.moveaxis(moved, -1, axis)
+
+def lanczos_shift(image, shift, a=3):
+	"""Shift one image by a (sub-pixel) amount with a separable Lanczos kernel, with zeros shifted in at the edges.
+	Unlike the Fourier shift, each output pixel only depends on the input pixels within a + 1 pixels of the shift, so
+	sections of a large image can be shifted separately (with that margin) and agree exactly with shifting it whole.
+
+	@type image: numpy array
+	@param image: (ny, nx) image
+	@type shift: tuple
+	@param shift: (dy, dx) shift, in pixels
+	@type a: integer
+	@param a: half-width of the Lanczos kernel
+	@rtype: numpy array
+	@return: shifted image, in the floating point precision of image
+
+	"""
+	image = numpy.asarray(image)
+	dtype = numpy.result_type(image.dtype, numpy.float32)
+	shifted = image.astype(dtype)
+	taps = numpy.arange(-a + 1, a + 1)
+	for axis, s in zip((0, 1), shift):
+		whole = int(numpy.floor(s))
+		x = 1 - (s - whole) - taps
+		weights = numpy.sinc(x) * numpy.sinc(x / a)
+		weights /= weights.sum()
+		total = numpy.zeros_like(shifted)
+		for t, w in zip(taps, weights.astype(dtype)):
+			if w != 0:
+				total += w * _shifted(shifted, whole + 1 - t, axis)
+		shifted = total
+	return shifted
+
+def shift_stack(stack, shifts, method='fourier'):
+	"""Shift each image of a stack by a (sub-pixel) amount.
+
+	@type stack: numpy array
+	@param stack: (ny, nx) image or (n, ny, nx) stack
+	@type shifts: numpy array
+	@param shifts: (2,) or (n, 2) shifts (dy, dx), in pixels
+	@type method: string
+	@param method: 'fourier' (exact for band-limited images, but wraps around at the edges, so pad them by more than the shift first if the edges matter) or 'lanczos' (see lanczos_shift())
+	@rtype: numpy array
+	@return: shifted images, in the floating point precision of stack
+
+	"""
+	stack = numpy.asarray(stack)
+	dtype = numpy.result_type(stack.dtype, numpy.float32)
+	ny, nx = stack.shape[-2:]
+	shifts = numpy.asarray(shifts, dtype=float).reshape(-1, 2)
+	images = stack.reshape(-1, ny, nx)
+	if method == 'lanczos':
+		shifted = numpy.stack([lanczos_shift(image, shift) for image, shift in zip(images, shifts)])
+	else:
+		ky = numpy.fft.fftfreq(ny)[None, :, None]
+		kx = numpy.fft.rfftfreq(nx)[None, None, :]
+		phase = numpy.exp(-2j * numpy.pi * (ky * shifts[:, 0, None, None] + kx * shifts[:, 1, None, None]))
+		shifted = numpy.fft.irfft2(numpy.fft.rfft2(images) * phase, s=(ny, nx))
+	return shifted.reshape(stack.shape).astype(dtype, copy=False)
+
+def align_stack(stack, reference=0, upsample_factor=20, max_shift=None, whiten=0.0):
+	"""Register every image of a stack (e.g. the 7 filters of a sample) to one of them.
+
+	@type stack: numpy array
+	@param stack: (n, ny, nx) stack
+	@type reference: integer
+	@param reference: index of the reference image in the stack
+	@type upsample_factor: integer
+	@param upsample_factor: shifts are found to 1 / upsample_factor of a pixel
+	@type max_shift: float
+	@param max_shift: largest shift (pixels) searched for along each axis
+	@type whiten: float
+	@param whiten: power of the amplitude normalization, see Registration
+	@rtype: tuple
+	@return: (aligned stack, (n, 2) shifts (dy, dx) of each image from the reference)
+
+	"""
+	stack = numpy.asarray(stack)
+	shifts = Registration(stack[reference], upsample_factor, max_shift, whiten).estimate(stack)
+	shifts[reference] = 0
+	return (shift_stack(stack, -shifts), shifts)
+
+def align_galaxy(channel_data, reference=0, upsample_factor=20, max_shift=None, whiten=0.0):
+	"""Register the filters of one sample, as loaded by fits_to_png_bulk.load_galaxy(), to one of them.
+
+	@type channel_data: list
+	@param channel_data: (img_data, img_data_raw, width, height) tuples from fits_to_png_bulk.load_galaxy()
+	@type reference: integer
+	@param reference: index of the reference filter in channel_data
+	@type upsample_factor: integer
+	@param upsample_factor: shifts are found to 1 / upsample_factor of a pixel
+	@type max_shift: float
+	@param max_shift: largest shift (pixels) searched for along each axis
+	@type whiten: float
+	@param whiten: power of the amplitude normalization, see Registration
+	@rtype: tuple
+	@return: (list of aligned (img_data, img_data_raw, width, height) tuples, (n, 2) shifts (dy, dx))
+
+	"""
+	img_data, shifts = align_stack(numpy.stack([channel[0] for channel in channel_data]), reference, upsample_factor, max_shift, whiten)
+	img_data_raw = shift_stack(numpy.stack([channel[1] for channel in channel_data]), -shifts)
+	aligned = [(img_data[i], img_data_raw[i], channel[2], channel[3]) for i, channel in enumerate(channel_data)]
+	return (aligned, shifts)
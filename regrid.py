@@ -0,0 +1,146 @@
+#
+# Reprojection between WCS pixel grids one tile at a time, so Trilogy_rgb.py can combine mosaics with different pixel scales
+#
+# You can freely use the code
+#
+
+import numpy
+import threading
+from collections import OrderedDict
+from astropy.wcs import WCS
+from scipy.ndimage import map_coordinates
+
+# Pixel mappings of the most recent tiles, shared by every image on the same source grid:
+# (source grid, target grid, tile limits): (source y, source x)
+mappings = OrderedDict()
+mappings_lock = threading.Lock()
+mappings_size = 32
+
+# Round-off of the pixel mappings, in pixels
+tolerance = 1e-6
+
+def grid_key(header):
+	"""Key identifying the pixel grid of a FITS header, so images on the same grid share their pixel mappings.
+	Only the pixel to sky parameters count: exposure dates, observatory position etc. differ between images on one grid.
+
+	@type header: astropy.io.fits.Header
+	@param header: FITS header with a celestial WCS
+	@rtype: tuple
+	@return: (NAXIS2, NAXIS1, projection, reference pixel and value, pixel scale matrix, PV, SIP and lookup table distortions)
+
+	"""
+	wcs = WCS(header).celestial
+	sip = None
+	if wcs.sip is not None:
+		sip = tuple([tuple(numpy.ravel(terms)) if terms is not None else None for terms in (wcs.sip.a, wcs.sip.b, wcs.sip.ap, wcs.sip.bp)])
+	lookup = tuple([table is not None for table in (wcs.cpdis1, wcs.cpdis2, wcs.det2im1, wcs.det2im2)])
+	return (header.get('NAXIS2'), header.get('NAXIS1'), tuple(wcs.wcs.ctype), wcs.wcs.radesys, tuple(wcs.wcs.crval), tuple(wcs.wcs.crpix),
+		tuple(wcs.pixel_scale_matrix.ravel()), wcs.wcs.lonpole, wcs.wcs.latpole, tuple(wcs.wcs.get_pv()), sip, lookup)
+
+def coarse(lo, hi, step):
+	"""Positions every step pixels from lo to the last pixel before hi, always including the last.
+
+	@type lo: integer
+	@param lo: first pixel
+	@type hi: integer
+	@param hi: last pixel + 1
+	@type step: integer
+	@param step: spacing
+	@rtype: numpy array
+	@return: pixel positions
+
+	"""
+	return numpy.unique(numpy.append(numpy.arange(lo, hi, step), hi - 1))
+
+class Reprojection:
+	"""Resamples an image from its (source) pixel grid onto a target pixel grid, one tile of the target at a time."""
+
+	def __init__(self, source_header, target_header, order=1, step=16):
+		"""
+		@type source_header: astropy.io.fits.Header
+		@param source_header: FITS header of the image to resample
+		@type target_header: astropy.io.fits.Header
+		@param target_header: FITS header of the image whose grid is the output grid
+		@type order: integer
+		@param order: spline order of the interpolation (1: bilinear, 3: cubic)
+		@type step: integer
+		@param step: the WCS transformation is evaluated every step pixels and interpolated in between
+
+		"""
+		self.source = WCS(source_header).celestial
+		self.target = WCS(target_header).celestial
+		self.source_shape = (source_header['NAXIS2'], source_header['NAXIS1'])
+		self.key = (grid_key(source_header), grid_key(target_header), step)
+		self.order = order
+		self.step = step
+
+	def mapping(self, limits):
+		"""Position in the source image of each pixel of a target tile, cached for the most recent tiles.
+
+		@type limits: tuple
+		@param limits: (ylo, yhi, xlo, xhi) of the tile in the target grid
+		@rtype: tuple
+		@return: ((ny, nx) source y, (ny, nx) source x) pixel positions
+
+		"""
+		key = (self.key, tuple(limits))
+		with mappings_lock:
+			if key in mappings:
+				mappings.move_to_end(key)
+				return mappings[key]
+
+		ylo, yhi, xlo, xhi = limits
+		ys = coarse(ylo, yhi, self.step)
+		xs = coarse(xlo, xhi, self.step)
+		gy, gx = numpy.meshgrid(ys, xs, indexing='ij')
+		ra, dec = self.target.all_pix2world(gx, gy, 0)
+		sx, sy = self.source.all_world2pix(ra, dec, 0)
+
+		# WCS transformations are smooth: interpolate between the coarse positions
+		fy = numpy.interp(numpy.arange(ylo, yhi), ys, numpy.arange(len(ys)))
+		fx = numpy.interp(numpy.arange(xlo, xhi), xs, numpy.arange(len(xs)))
+		iy, ix = numpy.meshgrid(fy, fx, indexing='ij')
+		source_y = map_coordinates(sy, [iy, ix], order=1)
+		source_x = map_coordinates(sx, [iy, ix], order=1)
+
+		with mappings_lock:
+			mappings[key] = (source_y, source_x)
+			while len(mappings) > mappings_size:
+				mappings.popitem(last=False)
+		return (source_y, source_x)
+
+	def resample(self, data, limits, dtype=float):
+		"""Resample one tile of the target grid from the source image, reading only the part of data the tile covers.
+
+		@type data: numpy array
+		@param data: source image (may be a memory map of the whole mosaic)
+		@type limits: tuple
+		@param limits: (ylo, yhi, xlo, xhi) of the tile in the target grid; may extend past the target image
+		@type dtype: numpy dtype
+		@param dtype: floating point precision of the output
+		@rtype: numpy array
+		@return: (yhi - ylo, xhi - xlo) tile, 0 outside the source image and where it is NaN
+
+		"""
+		source_y, source_x = self.mapping(limits)
+		ny, nx = self.source_shape
+		# a target pixel belongs to the source image if it lands on one of its pixels; positions within half a pixel
+		# of the outermost pixel centres take the edge value. Both limits allow for the round-off of the mapping, which
+		# depends on where the tile is, so that tiled and whole image output agree
+		edge = 0.5 + tolerance
+		inside = (source_y >= -edge) & (source_y <= ny - 1 + edge) & (source_x >= -edge) & (source_x <= nx - 1 + edge)
+		if not inside.any():
+			return numpy.zeros(source_y.shape, dtype)
+		source_y = numpy.clip(source_y, 0, ny - 1)
+		source_x = numpy.clip(source_x, 0, nx - 1)
+		pad = self.order + 1
+		y0 = max(int(numpy.floor(source_y.min())) - pad, 0)
+		y1 = min(int(numpy.ceil(source_y.max())) + pad + 1, ny)
+		x0 = max(int(numpy.floor(source_x.min())) - pad, 0)
+		x1 = min(int(numpy.ceil(source_x.max())) + pad + 1, nx)
+
+		window = numpy.array(data[y0:y1, x0:x1], dtype=dtype)
+		window[numpy.isnan(window)] = 0
+		tile = map_coordinates(window, [source_y - y0, source_x - x0], order=self.order, mode='nearest', output=numpy.dtype(dtype))
+		tile[~inside] = 0
+		return tile
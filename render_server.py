@@ -0,0 +1,375 @@
+#
+# Render server: renders single galaxies on request over localhost HTTP, for the inspection tool
+# It stays running with astropy, matplotlib and scipy loaded and the recently used galaxies in memory, so a request
+# doesn't pay for starting Python and importing them.  Requests which arrive together are rendered as one batch.
+#
+# You can freely use the code
+#
+
+import numpy
+import io
+import json
+import queue
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import matplotlib
+matplotlib.use('Agg')
+from PIL import Image
+import fits_to_png_bulk
+import atlas
+
+# fits_to_png_bulk.scale_data() modes, plus 'rgb' for get_rgb()
+scale_modes = ['sqrt',
+		'power',
+		'log',
+		'linear',
+		'asinh_beta_01',
+		'asinh_beta_05',
+		'asinh_beta_20',
+		'histeq',
+		'logistic',
+		'rgb']
+
+filter_list = ['f115w',
+		'f150w',
+		'f200w',
+		'f277w',
+		'f356w',
+		'f410m',
+		'f444w',]
+
+def parse_request(fields):
+	"""Turn the fields of a render request into a hashable request, with the defaults filled in.
+
+	@type fields: dictionary
+	@param fields: dictionary of strings: sample, id, mode, and optionally filter (single filter modes), cmap, min_val, balance ('r,g,b', rgb), non_linear (rgb)
+	@rtype: tuple
+	@return: (sample, id, mode, filter, cmap, min_val, balance, non_linear)
+
+	"""
+	for name in ('sample', 'id', 'mode'):
+		if not fields.get(name):
+			raise ValueError('Missing request field: ' + name)
+	mode = fields['mode']
+	if mode not in scale_modes:
+		raise ValueError('Unknown mode: ' + mode)
+	filt = fields.get('filter', 'f150w')
+	if filt not in filter_list:
+		raise ValueError('Unknown filter: ' + filt)
+	if ('/' in fields['sample']) or ('..' in fields['sample']) or not fields['id'].isdigit():
+		raise ValueError('Bad sample or id')
+	min_val = fields.get('min_val', '0.0')
+	min_val = None if min_val == 'none' else float(min_val)
+	balance = tuple([float(value) for value in fields.get('balance', '1,1,1').split(',')])
+	if len(balance) != 3:
+		raise ValueError('balance needs 3 values')
+	if mode == 'rgb':
+		filt = None
+	return (fields['sample'], fields['id'], mode, filt, fields.get('cmap', 'hot'), min_val, balance, float(fields.get('non_linear', 0.005)))
+
+def to_png(img, cmap=None):
+	"""Encode an image as PNG bytes, the same way up as imshow(..., origin='lower') shows it.
+
+	@type img: numpy array
+	@param img: (width, height) scaled data in [0, 1], or (width, height, 3) RGB data
+	@type cmap: string
+	@param cmap: name of the matplotlib colormap for single channel data
+	@rtype: bytes
+	@return: PNG file contents
+
+	"""
+	out = io.BytesIO()
+	Image.fromarray(atlas.to_pixels(img, cmap)).save(out, format='PNG')
+	return out.getvalue()
+
+class GalaxyCache:
+	"""The most recently used galaxies, loaded with fits_to_png_bulk.load_galaxy()."""
+
+	def __init__(self, size=64, sig_fract=5.0, percent_fract=0.01, dtype=float):
+		"""
+		@type size: integer
+		@param size: number of galaxies to keep (7 100x100 filters take about 0.5 MB in float64)
+		@type sig_fract: float
+		@param sig_fract: fraction of sigma clipping
+		@type percent_fract: float
+		@param percent_fract: convergence fraction
+		@type dtype: numpy dtype
+		@param dtype: floating point precision of the pixel data, float or numpy.float32
+
+		"""
+		self.size = size
+		self.sig_fract = sig_fract
+		self.percent_fract = percent_fract
+		self.dtype = dtype
+		self.galaxies = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, sample, f_id):
+		"""Loaded data of one galaxy, read from disk only if it isn't cached.
+
+		@type sample: string
+		@param sample: sample folder name
+		@type f_id: string
+		@param f_id: ID of the sample
+		@rtype: list
+		@return: (img_data, img_data_raw, width, height) tuples, in the order of filter_list
+
+		"""
+		key = (sample, f_id)
+		with self.lock:
+			if key in self.galaxies:
+				self.galaxies.move_to_end(key)
+				self.hits += 1
+				return self.galaxies[key]
+			self.misses += 1
+
+		files = fits_to_png_bulk.galaxy_files(sample, f_id, filter_list)
+		channel_data = fits_to_png_bulk.load_galaxy(files, self.sig_fract, self.percent_fract, dtype=self.dtype)
+
+		with self.lock:
+			self.galaxies[key] = channel_data
+			while len(self.galaxies) > self.size:
+				self.galaxies.popitem(last=False)
+		return channel_data
+
+class RenderBatcher:
+	"""Collects the requests which arrive within a short window and renders them as one batch: identical requests are
+	rendered once, each galaxy is loaded once, and the RGB requests of a galaxy go through one get_rgb_batch() call."""
+
+	def __init__(self, cache, workers=None, window=0.01, max_batch=64):
+		"""
+		@type cache: GalaxyCache
+		@param cache: loaded galaxies
+		@type workers: integer
+		@param workers: threads rendering the galaxies of a batch, all cores if None
+		@type window: float
+		@param window: seconds to wait for more requests after the first one of a batch
+		@type max_batch: integer
+		@param max_batch: most requests in a batch
+
+		"""
+		self.cache = cache
+		self.window = window
+		self.max_batch = max_batch
+		self.pool = ThreadPoolExecutor(workers)
+		self.pending = queue.Queue()
+		self.inflight = {}
+		self.lock = threading.Lock()
+		self.batches = 0
+		self.requests = 0
+		self.coalesced = 0
+		threading.Thread(target=self.dispatch, daemon=True).start()
+
+	def submit(self, request):
+		"""Queue a request, or join an identical one which is already queued or being rendered.
+
+		@type request: tuple
+		@param request: request from parse_request()
+		@rtype: concurrent.futures.Future
+		@return: future of the PNG bytes
+
+		"""
+		with self.lock:
+			self.requests += 1
+			if request in self.inflight:
+				self.coalesced += 1
+				return self.inflight[request]
+			future = Future()
+			self.inflight[request] = future
+		self.pending.put(request)
+		return future
+
+	def dispatch(self):
+		"""Dispatcher thread: gather a batch, then render each of its galaxies in the worker pool."""
+		while True:
+			batch = [self.pending.get()]
+			deadline = time.monotonic() + self.window
+			while len(batch) < self.max_batch:
+				try:
+					batch.append(self.pending.get(timeout=max(deadline - time.monotonic(), 0)))
+				except queue.Empty:
+					break
+			self.batches += 1
+			galaxies = OrderedDict()
+			for request in batch:
+				galaxies.setdefault(request[:2], []).append(request)
+			for requests in galaxies.values():
+				self.pool.submit(self.render_galaxy, requests)
+
+	def finish(self, request, result=None, error=None):
+		"""Hand a result (or an error) to everyone waiting for a request."""
+		with self.lock:
+			future = self.inflight.pop(request)
+		if error is None:
+			future.set_result(result)
+		else:
+			future.set_exception(error)
+
+	def render_galaxy(self, requests):
+		"""Render every request of one galaxy.
+
+		@type requests: list
+		@param requests: requests from parse_request() with the same sample and id
+		@rtype: None
+
+		"""
+		try:
+			channel_data = self.cache.get(*requests[0][:2])
+		except Exception as error:
+			for request in requests:
+				self.finish(request, error=error)
+			return
+
+		# Same channels as fits_to_png_bulk.img_scale_collage(); one get_rgb_batch() variant per request
+		channels = (channel_data[6], channel_data[4], channel_data[1])
+		by_min_val = OrderedDict()
+		for request in requests:
+			if request[2] == 'rgb':
+				by_min_val.setdefault(request[5], []).append(request)
+		for min_val, group in by_min_val.items():
+			try:
+				non_linear = numpy.array([request[7] for request in group])[:, None]
+				variants = fits_to_png_bulk.get_rgb_batch(channels, [request[6] for request in group], min_val=min_val, non_linear=non_linear)
+				pngs = [to_png(variant) for variant in variants]
+			except Exception as error:
+				for request in group:
+					self.finish(request, error=error)
+				continue
+			for request, png in zip(group, pngs):
+				self.finish(request, png)
+
+		for request in requests:
+			if request[2] == 'rgb':
+				continue
+			sample, f_id, mode, filt, cmap, min_val, balance, non_linear = request
+			try:
+				img_data, img_data_raw, width, height = channel_data[filter_list.index(filt)]
+				self.finish(request, to_png(fits_to_png_bulk.scale_data(img_data, img_data_raw, mode, min_val=min_val), cmap))
+			except Exception as error:
+				self.finish(request, error=error)
+
+class RenderHandler(BaseHTTPRequestHandler):
+	"""GET /render?sample=small_sample&id=12608&mode=asinh_beta_05&filter=f150w returns a PNG; GET /status returns counters as JSON."""
+
+	def do_GET(self):
+		url = urllib.parse.urlparse(self.path)
+		if url.path == '/status':
+			self.reply(200, 'application/json', json.dumps(self.server.status()).encode())
+			return
+		if url.path != '/render':
+			self.reply(404, 'text/plain', b'Use /render or /status')
+			return
+		fields = dict([(name, values[-1]) for name, values in urllib.parse.parse_qs(url.query).items()])
+		try:
+			future = self.server.batcher.submit(parse_request(fields))
+			self.reply(200, 'image/png', future.result(timeout=self.server.timeout_s))
+		except ValueError as error:
+			self.reply(400, 'text/plain', str(error).encode())
+		except FileNotFoundError as error:
+			self.reply(404, 'text/plain', str(error).encode())
+		except Exception as error:
+			self.reply(500, 'text/plain', repr(error).encode())
+
+	def reply(self, code, content_type, body):
+		self.send_response(code)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		if self.server.verbose:
+			BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class RenderServer(ThreadingHTTPServer):
+	"""HTTP server with one GalaxyCache and one RenderBatcher shared by every connection."""
+
+	daemon_threads = True
+
+	def __init__(self, host='127.0.0.1', port=8765, cache_size=64, workers=None, window=0.01, timeout_s=60, verbose=False, dtype=float):
+		"""
+		@type host: string
+		@param host: address to listen on; keep it local, there is no authentication
+		@type port: integer
+		@param port: port to listen on
+		@type cache_size: integer
+		@param cache_size: number of galaxies to keep loaded
+		@type workers: integer
+		@param workers: rendering threads, all cores if None
+		@type window: float
+		@param window: seconds to gather a batch
+		@type timeout_s: float
+		@param timeout_s: seconds before a request gives up
+		@type verbose: boolean
+		@param verbose: log every request
+		@type dtype: numpy dtype
+		@param dtype: floating point precision of the pixel data, float or numpy.float32
+
+		"""
+		ThreadingHTTPServer.__init__(self, (host, port), RenderHandler)
+		self.cache = GalaxyCache(cache_size, dtype=dtype)
+		self.batcher = RenderBatcher(self.cache, workers, window)
+		self.timeout_s = timeout_s
+		self.verbose = verbose
+		self.warm_up()
+
+	def warm_up(self):
+		"""Run every mode once on made up data, so the first real request doesn't pay for compiling the accel.py kernels."""
+		img = numpy.random.default_rng(0).normal(0.0, 1.0, (16, 16)).astype(self.cache.dtype)
+		for mode in scale_modes[:-1]:
+			to_png(fits_to_png_bulk.scale_data(img, img, mode, min_val=0.0), 'hot')
+		channel = (img, img, 16, 16)
+		to_png(fits_to_png_bulk.get_rgb_batch((channel, channel, channel), [(1, 1, 1)], min_val=0.0)[0])
+
+	def status(self):
+		"""Counters of the cache and the batcher.
+
+		@rtype: dictionary
+		@return: dictionary of counters
+
+		"""
+		return {'cached': len(self.cache.galaxies),
+			'hits': self.cache.hits,
+			'misses': self.cache.misses,
+			'requests': self.batcher.requests,
+			'coalesced': self.batcher.coalesced,
+			'batches': self.batcher.batches,}
+
+def render(sample, f_id, mode, host='127.0.0.1', port=8765, **params):
+	"""Ask a running server for one render.
+
+	@type sample: string
+	@param sample: sample folder name
+	@type f_id: string
+	@param f_id: ID of the sample
+	@type mode: string
+	@param mode: scaling mode of fits_to_png_bulk.scale_data(), or 'rgb'
+	@type host: string
+	@param host: address of the server
+	@type port: integer
+	@param port: port of the server
+	@type params: keyword arguments
+	@param params: filter, cmap, min_val, balance ('r,g,b'), non_linear
+	@rtype: bytes
+	@return: PNG file contents
+
+	"""
+	fields = dict(params, sample=sample, id=f_id, mode=mode)
+	url = 'http://%s:%d/render?%s' % (host, port, urllib.parse.urlencode(fields))
+	with urllib.request.urlopen(url) as response:
+		return response.read()
+
+def main():
+	server = RenderServer()
+	print('Serving renders on http://%s:%d/render' % server.server_address)
+	server.serve_forever()
+
+if __name__ == "__main__":
+	main()
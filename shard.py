@@ -0,0 +1,252 @@
+#
+# Sharding: splits a sample into N independent runs (e.g. one per node) with --shard k/N, then merges what they wrote.
+# Every run computes the same plan from the catalog alone, so the runs don't talk to each other: the galaxies are
+# ordered by estimated cost (the size of their files) and a hash of their ID, and each goes to the shard with the least
+# cost so far.  Each shard writes its images, its own quality gate report and a manifest of what it did and how long it
+# took; merge() checks that every shard ran, each galaxy exactly once, and writes one manifest and report for the sample.
+#
+# You can freely use the code
+#
+
+import numpy
+import csv
+import glob
+import hashlib
+import heapq
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+
+def parse_shard(text):
+	"""
+	@type text: string
+	@param text: 'k/N', shard k (1 to N) of N
+	@rtype: tuple
+	@return: (k, N); ValueError if text isn't a shard
+	"""
+	match = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', text)
+	if (match is None) or not (1 <= int(match.group(1)) <= int(match.group(2))):
+		raise ValueError('Not a shard: %r, expected k/N with 1 <= k <= N' % (text,))
+	return (int(match.group(1)), int(match.group(2)))
+
+def id_hash(f_id):
+	"""Hash of an ID which is the same in every process and on every node (unlike hash()).
+
+	@type f_id: string
+	@param f_id: ID of the sample
+	@rtype: integer
+	@return: 64 bit hash
+
+	"""
+	return int.from_bytes(hashlib.blake2b(str(f_id).encode(), digest_size=8).digest(), 'big')
+
+def estimate_costs(cat):
+	"""Cost of each galaxy of a catalog: the total size of its files, which the reads, sky clipping and scaling go by.
+
+	@type cat: catalog.Catalog
+	@param cat: catalog of the sample
+	@rtype: numpy array
+	@return: cost of each row, in bytes (at least 1)
+
+	"""
+	sizes = numpy.zeros(cat.rows['files'].shape, numpy.int64)
+	for j, filt in enumerate(cat.filter_list):
+		path = os.path.join(cat.folder_fn, filt)
+		names = cat.names[j]
+		if not len(names):
+			continue
+		file_sizes = numpy.array([os.stat(os.path.join(path, str(name))).st_size for name in names.tolist()], numpy.int64)
+		has = cat.rows['files'][:, j] >= 0
+		sizes[has, j] = file_sizes[cat.rows['files'][has, j]]
+	return numpy.maximum(sizes.sum(axis=1), 1)
+
+def assign(f_ids, costs, nshards):
+	"""Deterministic, balanced assignment of galaxies to shards.
+
+	The galaxies are taken by decreasing cost, equal costs in the order of their ID hash, and each goes to the shard
+	with the least total cost so far (the lowest numbered of equals), so the shards end up within one galaxy's cost.
+
+	@type f_ids: list
+	@param f_ids: list of sample ID strings
+	@type costs: numpy array
+	@param costs: estimated cost of each galaxy
+	@type nshards: integer
+	@param nshards: number of shards
+	@rtype: numpy array
+	@return: shard (0 to nshards - 1) of each galaxy
+
+	"""
+	hashes = numpy.array([id_hash(f_id) for f_id in f_ids], numpy.uint64)
+	order = numpy.lexsort((hashes, -numpy.asarray(costs, numpy.float64)))
+	shards = numpy.zeros(len(f_ids), numpy.int64)
+	loads = [(0.0, k) for k in range(nshards)]
+	for i in order.tolist():
+		load, k = heapq.heappop(loads)
+		shards[i] = k
+		heapq.heappush(loads, (load + float(costs[i]), k))
+	return shards
+
+def shard_ids(folder_fn, filter_list, shard):
+	"""The galaxies of one shard of a sample.
+
+	@type folder_fn: string
+	@param folder_fn: name of folder which contains filter folders with desired data
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@type shard: tuple
+	@param shard: (k, N) from parse_shard()
+	@rtype: tuple
+	@return: (list of the sample ID strings of shard k, in catalog order; their estimated cost)
+
+	"""
+	import catalog
+	k, nshards = shard
+	cat = catalog.load_catalog(folder_fn, filter_list).with_files()
+	f_ids = cat.ids()
+	costs = estimate_costs(cat)
+	mine = assign(f_ids, costs, nshards) == k - 1
+	return ([f_id for f_id, ok in zip(f_ids, mine.tolist()) if ok], int(costs[mine].sum()))
+
+def manifest_name(out_folder, shard):
+	"""
+	@rtype: string
+	@return: out_folder/manifest_<k>_of_<N>.json
+	"""
+	return os.path.join(out_folder, 'manifest_%d_of_%d.json' % shard)
+
+def report_name(shard):
+	"""
+	@rtype: string
+	@return: name of the quality gate report of a shard, rejected_<k>_of_<N>.csv
+	"""
+	return 'rejected_%d_of_%d.csv' % shard
+
+def run_shard(render, folder_fn, out_folder, filter_list, shard, **params):
+	"""Render one shard of a sample and write its manifest.
+
+	@type render: function
+	@param render: fits_to_png_bulk.save_collage_bulk or save_comparison_bulk
+	@type folder_fn: string
+	@param folder_fn: name of folder which contains filter folders with desired data
+	@type out_folder: string
+	@param out_folder: folder render() saves in, where the manifest goes
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@type shard: tuple
+	@param shard: (k, N) from parse_shard()
+	@param params: the other arguments of render(), by name
+	@rtype: dictionary
+	@return: the manifest
+
+	"""
+	started = time.time()
+	f_ids, cost = shard_ids(folder_fn, filter_list, shard)
+	print('Shard %d/%d: %d samples' % (shard + (len(f_ids),)))
+	# A shard in which some samples failed still writes its manifest, then raises
+	import fits_to_png_bulk
+	failed = None
+	try:
+		summary = render(folder_fn, filter_list=filter_list, f_ids=f_ids, report=report_name(shard), **params)
+	except fits_to_png_bulk.GalaxiesFailed as error:
+		failed = error
+		summary = error.summary
+	manifest = {'shard': list(shard),
+		'sample': folder_fn,
+		'command': render.__name__,
+		'host': socket.gethostname(),
+		'pid': os.getpid(),
+		'started': started,
+		'finished': time.time(),
+		'estimated_cost': cost,
+		'report': report_name(shard) if summary['rejected'] else None}
+	manifest.update(summary)
+	os.makedirs(out_folder, exist_ok=True)
+	with open(manifest_name(out_folder, shard), 'w') as fout:
+		json.dump(manifest, fout, indent=1)
+	if failed is not None:
+		raise failed
+	return manifest
+
+def merge(out_folder):
+	"""Consolidate the manifests and quality gate reports of the shards in a folder.
+
+	Writes out_folder/manifest.json (every shard's samples, outputs, failures, warnings and timing, and the timing of the shards
+	side by side) and out_folder/rejected.csv (the shard reports, one after the other).
+
+	@type out_folder: string
+	@param out_folder: folder the shards saved in
+	@rtype: dictionary
+	@return: the merged manifest; its missing and duplicates lists are empty if the run is complete
+
+	"""
+	names = glob.glob(os.path.join(out_folder, 'manifest_*_of_*.json'))
+	if not names:
+		raise ValueError('No shard manifests in ' + out_folder)
+	manifests = []
+	for name in names:
+		with open(name) as fin:
+			manifests.append(json.load(fin))
+	manifests.sort(key=lambda manifest: manifest['shard'])
+	counts = set([manifest['shard'][1] for manifest in manifests])
+	if len(counts) > 1:
+		raise ValueError('Manifests of different shard counts in %s: %s' % (out_folder, sorted(counts)))
+	nshards = counts.pop()
+	seen = {}
+	duplicates = []
+	for manifest in manifests:
+		for f_id in manifest['samples']:
+			if f_id in seen:
+				duplicates.append(f_id)
+			seen[f_id] = manifest['shard'][0]
+	seconds = numpy.array([manifest['seconds'] for manifest in manifests])
+	merged = {'shards': nshards,
+		'missing': sorted(set(range(1, nshards + 1)) - set([manifest['shard'][0] for manifest in manifests])),
+		'duplicates': sorted(duplicates),
+		'samples': sorted(seen),
+		'rendered': {},
+		'rejected': [],
+		'failed': {},
+		'outputs': [],
+		'warnings': {},
+		'timing': [],}
+	for manifest in manifests:
+		merged['rendered'].update(manifest['rendered'])
+		merged['rejected'].extend(manifest['rejected'])
+		merged['failed'].update(manifest.get('failed', {}))
+		merged['outputs'].extend(manifest['outputs'])
+		merged['warnings'].update(manifest['warnings'])
+		merged['timing'].append({'shard': manifest['shard'][0], 'host': manifest['host'], 'samples': len(manifest['samples']), 'estimated_cost': manifest['estimated_cost'], 'seconds': manifest['seconds'], 'read_wait': manifest['read_wait']})
+	merged['rejected'].sort()
+	# Wall time of the whole run is the slowest shard; imbalance is how much longer it took than the mean
+	merged['seconds'] = float(seconds.max())
+	merged['imbalance'] = float(seconds.max() / seconds.mean()) if seconds.mean() > 0 else 1.0
+	with open(os.path.join(out_folder, 'manifest.json'), 'w') as fout:
+		json.dump(merged, fout, indent=1)
+	reports = [os.path.join(out_folder, manifest['report']) for manifest in manifests if manifest['report']]
+	if reports:
+		with open(os.path.join(out_folder, 'rejected.csv'), 'w', newline='') as fout:
+			writer = csv.writer(fout)
+			for i, report in enumerate(reports):
+				with open(report, newline='') as fin:
+					rows = list(csv.reader(fin))
+				writer.writerows(rows if i == 0 else rows[1:])
+	return merged
+
+def run_local(argv, nshards):
+	"""Run the shards of a cli.py command as separate local processes, all at once, as they would run on N nodes.
+
+	@type argv: list
+	@param argv: cli.py arguments, e.g. ['collage', 'small_sample', '--modes', 'log']
+	@type nshards: integer
+	@param nshards: number of shards
+	@rtype: list
+	@return: list of the exit codes of the shards
+
+	"""
+	cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+	processes = [subprocess.Popen([sys.executable, cli] + list(argv) + ['--shard', '%d/%d' % (k, nshards)]) for k in range(1, nshards + 1)]
+	return [process.wait() for process in processes]
@@ -0,0 +1,328 @@
+#
+# Shared memory arena for galaxy stacks and Trilogy stamps, so worker processes get them without pickling
+# The parent (the loader) writes each stack into a multiprocessing.shared_memory block and sends the workers only a
+# descriptor, (block name, shape, dtype); the workers map the block and write their output into another block.
+# Blocks are reference counted, and released blocks are reused for the next stacks of the same size, so the memory in
+# use stays bounded by the number of stacks in flight however long the run is.
+#
+# You can freely use the code
+#
+
+import numpy
+import collections
+import multiprocessing
+import os
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+class SharedArena:
+	"""Reference counted shared memory blocks, owned by one (parent) process."""
+
+	def __init__(self, capacity=None):
+		"""
+		@type capacity: integer
+		@param capacity: most bytes of blocks (in use or kept for reuse) at once; no limit if None
+
+		"""
+		self.capacity = capacity
+		self.blocks = {}  # block name: [SharedMemory, reference count]
+		self.free = collections.defaultdict(list)  # block size: released blocks kept for reuse
+		self.nbytes = 0
+
+	def allocate(self, shape, dtype=float):
+		"""Get a block for an array, reusing a released block of the same size if there is one.
+
+		@type shape: tuple
+		@param shape: shape of the array
+		@type dtype: numpy dtype
+		@param dtype: dtype of the array
+		@rtype: tuple
+		@return: descriptor (block name, shape, dtype string), with a reference count of 1
+		"""
+		dtype = numpy.dtype(dtype)
+		size = max(int(numpy.prod(shape)) * dtype.itemsize, 1)
+		if self.free[size]:
+			block = self.free[size].pop()
+		else:
+			if self.capacity and (self.nbytes + size > self.capacity):
+				self.trim(self.capacity - size)
+			if self.capacity and (self.nbytes + size > self.capacity):
+				raise MemoryError('Shared arena is full: %d bytes in use, %d more requested, capacity %d' % (self.nbytes, size, self.capacity))
+			block = shared_memory.SharedMemory(create=True, size=size)
+			self.nbytes += size
+		self.blocks[block.name] = [block, 1]
+		return (block.name, tuple(shape), dtype.str)
+
+	def put(self, array):
+		"""Copy an array into a new block.
+
+		@type array: numpy array
+		@param array: array to share
+		@rtype: tuple
+		@return: descriptor, with a reference count of 1
+
+		"""
+		array = numpy.asarray(array)
+		descriptor = self.allocate(array.shape, array.dtype)
+		self.view(descriptor)[...] = array
+		return descriptor
+
+	def view(self, descriptor):
+		"""The array of a block, in this (the owning) process.
+
+		@type descriptor: tuple
+		@param descriptor: descriptor from allocate() or put()
+		@rtype: numpy array
+		@return: array backed by the block; drop it before the block is released
+
+		"""
+		name, shape, dtype = descriptor
+		return numpy.ndarray(shape, dtype, buffer=self.blocks[name][0].buf)
+
+	def acquire(self, descriptor):
+		"""Take one more reference to a block, e.g. for each task it is sent to.
+
+		@type descriptor: tuple
+		@param descriptor: descriptor of a block in use
+		@rtype: tuple
+		@return: the same descriptor
+
+		"""
+		self.blocks[descriptor[0]][1] += 1
+		return descriptor
+
+	def release(self, descriptor):
+		"""Drop one reference to a block; at none, the block is kept for reuse (or freed, if over capacity).
+
+		@type descriptor: tuple
+		@param descriptor: descriptor of a block in use
+		@rtype: None
+
+		"""
+		entry = self.blocks[descriptor[0]]
+		entry[1] -= 1
+		if entry[1] == 0:
+			del self.blocks[descriptor[0]]
+			self.free[entry[0].size].append(entry[0])
+			if self.capacity:
+				self.trim(self.capacity)
+
+	def trim(self, nbytes=0):
+		"""Free released blocks until no more than nbytes are held.
+
+		@type nbytes: integer
+		@param nbytes: bytes to keep at most
+		@rtype: None
+
+		"""
+		for size in list(self.free):
+			while self.free[size] and (self.nbytes > nbytes):
+				self.destroy(self.free[size].pop())
+				self.nbytes -= size
+
+	def destroy(self, block):
+		"""Unmap and unlink a block; the memory is returned once every worker has unmapped it too."""
+		try:
+			block.close()
+		except BufferError:  # a view of it is still alive here; the mapping goes when the view does
+			pass
+		block.unlink()
+
+	def in_use(self):
+		"""
+		@rtype: tuple
+		@return: (blocks in use, bytes held including released blocks kept for reuse)
+		"""
+		return (len(self.blocks), self.nbytes)
+
+	def close(self):
+		"""Free every block, in use or not."""
+		for block, count in list(self.blocks.values()):
+			self.destroy(block)
+		self.blocks = {}
+		self.trim(0)
+		self.nbytes = 0
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+# Blocks mapped by this (worker) process, most recently used last
+attached = collections.OrderedDict()
+attached_size = 32
+
+def attach(descriptor):
+	"""The array of a block, in a worker process.  Blocks stay mapped for the next tasks, as the arena reuses them.
+
+	@type descriptor: tuple
+	@param descriptor: descriptor from SharedArena.allocate() or put()
+	@rtype: numpy array
+	@return: array backed by the block
+
+	"""
+	name, shape, dtype = descriptor
+	if name in attached:
+		attached.move_to_end(name)
+	else:
+		if sys.version_info >= (3, 13):
+			attached[name] = shared_memory.SharedMemory(name=name, track=False)
+		else:
+			# Before 3.13 attaching registers the block with this process's resource tracker too, which would unlink it
+			# (and warn of a leak) when the worker exits, though the arena owns it
+			attached[name] = shared_memory.SharedMemory(name=name)
+			resource_tracker.unregister(attached[name]._name, 'shared_memory')
+		while len(attached) > attached_size:
+			try:
+				attached.popitem(last=False)[1].close()
+			except BufferError:
+				pass
+	return numpy.ndarray(shape, dtype, buffer=attached[name].buf)
+
+def run_shared(func, in_descriptor, out_descriptor, args=()):
+	"""Worker task: out = func(stack, *args), reading and writing shared blocks.
+
+	@type func: function
+	@param func: module level function (so it can be sent to the workers)
+	@type in_descriptor: tuple
+	@param in_descriptor: descriptor of the input stack
+	@type out_descriptor: tuple
+	@param out_descriptor: descriptor of the output
+	@type args: tuple
+	@param args: other arguments of func
+	@rtype: None
+
+	"""
+	attach(out_descriptor)[...] = func(attach(in_descriptor), *args)
+
+def imap_shared(func, stacks, out_spec=None, args=(), processes=None, max_inflight=None, arena=None, pool=None):
+	"""Run func over stacks in worker processes which receive only descriptors, yielding the outputs in order.
+
+	@type func: function
+	@param func: module level function, func(stack, *args) -> output
+	@type stacks: iterable
+	@param stacks: numpy arrays, or descriptors of blocks already filled in arena (which imap_shared() then releases)
+	@type out_spec: function
+	@param out_spec: out_spec(shape, dtype) -> (shape, dtype) of the output of func; the same as the input if None
+	@type args: tuple
+	@param args: other arguments of func
+	@type processes: integer
+	@param processes: number of worker processes (of pool, if given), all cores if None
+	@type max_inflight: integer
+	@param max_inflight: most stacks in shared memory at once, twice the number of processes if None
+	@type arena: SharedArena
+	@param arena: arena to use, a new one (closed at the end) if None
+	@type pool: multiprocessing.Pool
+	@param pool: worker processes to use, e.g. across several calls; a new pool of processes (ended at the end) if None
+	@rtype: generator
+	@return: outputs, as arrays backed by shared memory which are reused once the generator moves on: copy them to keep them
+
+	"""
+	own = arena is None
+	if own:
+		arena = SharedArena()
+	own_pool = pool is None
+	processes = processes or os.cpu_count() or 1
+	max_inflight = max_inflight or 2 * processes
+	pending = collections.deque()
+	if own_pool:
+		pool = multiprocessing.Pool(processes)
+	try:
+		for stack in stacks:
+			in_descriptor = stack if isinstance(stack, tuple) else arena.put(stack)
+			shape, dtype = in_descriptor[1], numpy.dtype(in_descriptor[2])
+			if out_spec is not None:
+				shape, dtype = out_spec(shape, dtype)
+			out_descriptor = arena.allocate(shape, dtype)
+			pending.append((in_descriptor, out_descriptor, pool.apply_async(run_shared, (func, in_descriptor, out_descriptor, args))))
+			while len(pending) >= max_inflight:
+				yield from _finish(arena, pending.popleft())
+		while pending:
+			yield from _finish(arena, pending.popleft())
+	finally:
+		if own_pool:
+			pool.terminate()
+			pool.join()
+		else:
+			# Tasks of a shared pool which are still running may write to their blocks: wait for them before releasing
+			for in_descriptor, out_descriptor, result in pending:
+				result.wait()
+		for in_descriptor, out_descriptor, result in pending:
+			arena.release(in_descriptor)
+			arena.release(out_descriptor)
+		if own:
+			arena.close()
+
+def _finish(arena, entry):
+	"""Wait for one task of imap_shared(), yield its output and release its blocks once the caller moves on."""
+	in_descriptor, out_descriptor, result = entry
+	try:
+		result.get()
+	finally:
+		arena.release(in_descriptor)
+	try:
+		yield arena.view(out_descriptor)
+	finally:
+		arena.release(out_descriptor)
+
+def load_galaxy_shared(arena, fn_list, sig_fract, percent_fract, dtype=float):
+	"""Load one sample into a block, like fits_to_png_bulk.load_galaxy().
+
+	@type arena: SharedArena
+	@param arena: arena to load into
+	@type fn_list: list
+	@param fn_list: list of file name strings, one per filter (all the same size)
+	@type sig_fract: float
+	@param sig_fract: fraction of sigma clipping
+	@type percent_fract: float
+	@param percent_fract: convergence fraction
+	@type dtype: numpy dtype
+	@param dtype: floating point precision of the pixel data, float or numpy.float32
+	@rtype: tuple
+	@return: descriptor of a (2, len(fn_list), width, height) block: [0] is the data minus sky, [1] the raw data
+
+	"""
+	import fits_to_png_bulk
+	descriptor = None
+	for i, fn in enumerate(fn_list):
+		img_data, img_data_raw, width, height = fits_to_png_bulk.get_fits_data(fn, sig_fract, percent_fract, dtype=dtype)
+		if descriptor is None:
+			descriptor = arena.allocate((2, len(fn_list), width, height), dtype)
+			stack = arena.view(descriptor)
+		stack[0, i] = img_data
+		stack[1, i] = img_data_raw
+	return descriptor
+
+def scale_stack(stack, mode, min_val=0.0):
+	"""Worker function: fits_to_png_bulk.scale_data() of every filter of a stack from load_galaxy_shared().
+
+	@type stack: numpy array
+	@param stack: (2, filters, width, height) stack
+	@type mode: string
+	@param mode: method of scaling
+	@type min_val: float
+	@param min_val: minimum data value
+	@rtype: numpy array
+	@return: (filters, width, height) scaled data
+
+	"""
+	import fits_to_png_bulk
+	return numpy.array([fits_to_png_bulk.scale_data(stack[0, i], stack[1, i], mode, min_val=min_val) for i in range(stack.shape[1])])
+
+def scaled_spec(shape, dtype):
+	"""out_spec of scale_stack()."""
+	return (shape[1:], dtype)
+
+def trilogy_stamp(stampRGB, levdict, noiselums, colorsatfac=1, mode='RGB', invlum=0):
+	"""Worker function: Trilogy_rgb.RGBscale2im() of one (3, ny, nx) stamp, or (1, ny, nx) in mode 'L'.
+
+	@rtype: numpy array
+	@return: (ny, nx, 3) uint8 image, or (ny, nx) in mode 'L', in the orientation of the PIL image
+	"""
+	import Trilogy_rgb
+	return numpy.asarray(Trilogy_rgb.RGBscale2im(stampRGB, levdict, noiselums, colorsatfac, mode, invlum))
+
+def trilogy_spec(shape, dtype):
+	"""out_spec of trilogy_stamp()."""
+	return (tuple(shape[1:]) + ((3,) if shape[0] == 3 else ()), numpy.uint8)
@@ -0,0 +1,301 @@
+#
+# Survey-wide normalization: one frozen scale_min / scale_max per filter for the whole sample, and a histeq whose CDF is
+# that of every pixel of the filter in the sample, instead of the range and histogram of each image, so panels of
+# different galaxies can be compared by eye.
+# reduce_sample() makes one pass over the sample on a pool of processes.  Each worker histograms its galaxies on the
+# same fixed edges (uniform in asinh(x / softening): fine around the sky, coarse for bright cores, never rebinned), so
+# the partial results merge by adding counts.  The merged histograms are saved to a .npz, and SurveyNorm.scale() then
+# scales any image or stack of a filter, in any mode, with no statistics of its own.
+#
+# You can freely use the code
+#
+
+import numpy
+import json
+import multiprocessing
+import os
+
+# Histogram edges: bins uniform in asinh(x / softening) between -limit and limit; values beyond go in the end bins
+softening = 1.0e-3
+limit = 1.0e4
+num_bins = 8192
+
+# Default range of the frozen normalization: percent of the sample's pixels cut at each end
+low_cut = 0.1
+high_cut = 0.1
+
+def asinh_edges(softening=softening, limit=limit, num_bins=num_bins):
+	"""
+	@rtype: numpy array
+	@return: num_bins + 1 histogram edges, uniform in asinh(x / softening) between -limit and limit
+	"""
+	u_max = numpy.arcsinh(limit / softening)
+	return softening * numpy.sinh(numpy.linspace(-u_max, u_max, num_bins + 1))
+
+class FilterHistogram:
+	"""Mergeable statistics of the pixels of one filter: histogram on the asinh edges, count, NaN count, min. and max."""
+
+	def __init__(self, softening=softening, limit=limit, num_bins=num_bins):
+		self.softening = softening
+		self.limit = limit
+		self.num_bins = num_bins
+		self.counts = numpy.zeros(num_bins, numpy.int64)
+		self.nan = 0
+		self.min = numpy.inf
+		self.max = -numpy.inf
+
+	def add(self, data):
+		"""Add the pixels of an image or stack.
+
+		@type data: numpy array
+		@param data: pixel data
+		@rtype: None
+
+		"""
+		data = numpy.asarray(data, dtype=float).ravel()
+		finite = numpy.isfinite(data)
+		self.nan += int(data.size - finite.sum())
+		data = data[finite]
+		if not data.size:
+			return
+		u_max = numpy.arcsinh(self.limit / self.softening)
+		u = numpy.arcsinh(data / self.softening)
+		bins = numpy.clip(((u + u_max) * (self.num_bins / (2 * u_max))).astype(numpy.int64), 0, self.num_bins - 1)
+		self.counts += numpy.bincount(bins, minlength=self.num_bins)
+		self.min = min(self.min, float(data.min()))
+		self.max = max(self.max, float(data.max()))
+
+	def merge(self, other):
+		"""Add the statistics of another worker (on the same edges) to these.
+
+		@type other: FilterHistogram
+		@param other: partial result to merge
+		@rtype: FilterHistogram
+		@return: self
+
+		"""
+		if (other.softening, other.limit, other.num_bins) != (self.softening, self.limit, self.num_bins):
+			raise ValueError('Histograms on different edges can not be merged')
+		self.counts += other.counts
+		self.nan += other.nan
+		self.min = min(self.min, other.min)
+		self.max = max(self.max, other.max)
+		return self
+
+	def edges(self):
+		return asinh_edges(self.softening, self.limit, self.num_bins)
+
+	def cumulative(self):
+		"""
+		@rtype: tuple
+		@return: (edges, fraction of the pixels below each edge); the end edges are moved to the min. and max.
+		"""
+		edges = self.edges()
+		edges[0] = min(edges[0], self.min)
+		edges[-1] = max(edges[-1], self.max)
+		cdf = numpy.concatenate([[0], numpy.cumsum(self.counts)]) / float(max(self.counts.sum(), 1))
+		return (edges, cdf)
+
+	def percentile(self, percent):
+		"""Value below which percent of the pixels are, interpolated within a bin.
+
+		@type percent: float
+		@param percent: 0 to 100
+		@rtype: float
+		@return: data value (the exact min. and max. at 0 and 100)
+
+		"""
+		if percent <= 0:
+			return self.min
+		if percent >= 100:
+			return self.max
+		edges, cdf = self.cumulative()
+		# The first edge where the fraction reaches the target, interpolated from the edge before
+		i = max(int(numpy.searchsorted(cdf, percent / 100.0, side='left')), 1)
+		fraction = (percent / 100.0 - cdf[i - 1]) / max(cdf[i] - cdf[i - 1], 1e-300)
+		return float(min(max(edges[i - 1] + fraction * (edges[i] - edges[i - 1]), self.min), self.max))
+
+def reduce_galaxies(task):
+	"""Worker of reduce_sample(): statistics of the raw and sky subtracted data of some galaxies.
+
+	@type task: tuple
+	@param task: (folder_fn, list of sample ID strings, filter_list, sig_fract, percent_fract, (softening, limit, num_bins))
+	@rtype: dictionary
+	@return: dictionary where the key is (filter, 'raw' or 'sky'), and the value is a FilterHistogram
+
+	"""
+	import astropy.io.fits as pyfits
+	import fits_to_png_bulk
+	folder_fn, f_ids, filter_list, sig_fract, percent_fract, edges = task
+	partial = dict([((filt, data), FilterHistogram(*edges)) for filt in filter_list for data in ('raw', 'sky')])
+	for f_id in f_ids:
+		for filt, fn in zip(filter_list, fits_to_png_bulk.galaxy_files(folder_fn, f_id, filter_list)):
+			if not os.path.exists(fn):
+				continue
+			raw = numpy.array(pyfits.getdata(fn), dtype=float)
+			partial[(filt, 'raw')].add(raw)
+			partial[(filt, 'sky')].add(fits_to_png_bulk.subtract_sky(raw, sig_fract, percent_fract))
+	return partial
+
+def reduce_sample(folder_fn, filter_list, f_ids=None, sig_fract=5.0, percent_fract=0.01, processes=None, chunk=64, softening=softening, limit=limit, num_bins=num_bins):
+	"""Histogram every filter of a sample in parallel and merge the workers' results.
+
+	@type folder_fn: string
+	@param folder_fn: name of folder which contains filter folders with desired data
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@type f_ids: list
+	@param f_ids: list of sample ID strings; every sample of the folder (see catalog.py) if None
+	@type sig_fract: float
+	@param sig_fract: fraction of sigma clipping of the sky, as in the bulk functions
+	@type percent_fract: float
+	@param percent_fract: convergence fraction of the sky
+	@type processes: integer
+	@param processes: worker processes, os.cpu_count() if None; 1 works in this process
+	@type chunk: integer
+	@param chunk: galaxies per task
+	@rtype: SurveyNorm
+	@return: the merged normalization
+
+	"""
+	if f_ids is None:
+		import catalog
+		f_ids = catalog.load_catalog(folder_fn, filter_list).with_files().ids()
+	edges = (softening, limit, num_bins)
+	tasks = [(folder_fn, f_ids[start:start + chunk], filter_list, sig_fract, percent_fract, edges) for start in range(0, len(f_ids), chunk)]
+	merged = dict([((filt, data), FilterHistogram(*edges)) for filt in filter_list for data in ('raw', 'sky')])
+	pool = multiprocessing.Pool(processes) if (processes or os.cpu_count() or 1) > 1 else None
+	try:
+		for partial in (pool.imap_unordered(reduce_galaxies, tasks) if pool else map(reduce_galaxies, tasks)):
+			for key, histogram in partial.items():
+				merged[key].merge(histogram)
+	finally:
+		if pool:
+			pool.close()
+			pool.join()
+	return SurveyNorm(merged, {'sample': folder_fn, 'galaxies': len(f_ids), 'sig_fract': sig_fract, 'percent_fract': percent_fract})
+
+class SurveyNorm:
+	"""Frozen normalization of a sample: scales images of any of its filters with the survey's range and CDF."""
+
+	def __init__(self, histograms, info=None, low_cut=low_cut, high_cut=high_cut):
+		"""
+		@type histograms: dictionary
+		@param histograms: dictionary where the key is (filter, 'raw' or 'sky'), and the value is a FilterHistogram
+		@type info: dictionary
+		@param info: where the histograms came from
+		@type low_cut: float
+		@param low_cut: percent of the pixels below scale_min
+		@type high_cut: float
+		@param high_cut: percent of the pixels above scale_max
+
+		"""
+		self.histograms = histograms
+		self.info = info or {}
+		self.low_cut = low_cut
+		self.high_cut = high_cut
+		self.cdfs = {}
+
+	def filters(self):
+		return sorted(set([filt for filt, data in self.histograms]))
+
+	def range(self, filt, data='sky'):
+		"""
+		@type filt: string
+		@param filt: filter name
+		@type data: string
+		@param data: 'raw' or 'sky' (subtracted) pixel data
+		@rtype: tuple
+		@return: frozen (scale_min, scale_max) of the filter
+		"""
+		histogram = self.histograms[(filt, data)]
+		return (histogram.percentile(self.low_cut), histogram.percentile(100.0 - self.high_cut))
+
+	def histeq(self, img_data_raw, filt):
+		"""Histogram equalisation with the CDF of the whole sample's pixels of the filter, within the frozen range.
+
+		@type img_data_raw: numpy array
+		@param img_data_raw: raw pixel data, one image or a stack
+		@type filt: string
+		@param filt: filter name
+		@rtype: numpy array
+		@return: image data array in [0, 1]
+
+		"""
+		if filt not in self.cdfs:
+			edges, cdf = self.histograms[(filt, 'raw')].cumulative()
+			scale_min, scale_max = self.range(filt, 'raw')
+			low, high = numpy.interp([scale_min, scale_max], edges, cdf)
+			self.cdfs[filt] = (edges, (cdf - low) / max(high - low, 1e-300))
+		edges, cdf = self.cdfs[filt]
+		img_data_raw = numpy.asarray(img_data_raw)
+		new_img = numpy.clip(numpy.interp(img_data_raw, edges, cdf), 0.0, 1.0)
+		return new_img.astype(img_data_raw.dtype if numpy.issubdtype(img_data_raw.dtype, numpy.floating) else float, copy=False)
+
+	def scale(self, img_data, img_data_raw, filt, mode, min_val=None):
+		"""Scale one image or a stack of a filter, as fits_to_png_bulk.scale_data() does but with the frozen range.
+
+		@type img_data: numpy array
+		@param img_data: raw pixel data minus sky
+		@type img_data_raw: numpy array
+		@param img_data_raw: raw pixel data
+		@type filt: string
+		@param filt: filter name
+		@type mode: string
+		@param mode: method of scaling
+		@type min_val: float
+		@param min_val: minimum data value, for the modes which use it (as in scale_data()); the frozen one if None
+		@rtype: numpy array
+		@return: image data array
+
+		"""
+		import img_scale
+		import fits_to_png_bulk
+		func_name, params, raw, uses_min_val = fits_to_png_bulk.batch_modes.get(mode, fits_to_png_bulk.batch_modes['linear'])
+		if func_name == 'histeq':
+			return self.histeq(img_data_raw, filt)
+		scale_min, scale_max = self.range(filt, 'raw' if raw else 'sky')
+		if uses_min_val and (min_val is not None):
+			scale_min = min_val
+		return img_scale.stretch_batch(img_data_raw if raw else img_data, func_name, scale_min=scale_min, scale_max=scale_max, **params)
+
+	def save(self, filename):
+		"""Save the histograms, e.g. sample_2_norm.npz; load_norm() reads them back.
+
+		@type filename: string
+		@param filename: output file name
+		@rtype: None
+
+		"""
+		arrays = {}
+		stats = {}
+		for (filt, data), histogram in self.histograms.items():
+			arrays[filt + '_' + data] = histogram.counts
+			stats[filt + '_' + data] = [histogram.nan, histogram.min, histogram.max]
+		first = list(self.histograms.values())[0]
+		meta = {'info': self.info, 'edges': [first.softening, first.limit, first.num_bins], 'stats': stats, 'low_cut': self.low_cut, 'high_cut': self.high_cut}
+		numpy.savez_compressed(filename, meta=numpy.array(json.dumps(meta)), **arrays)
+
+def load_norm(filename, low_cut=None, high_cut=None):
+	"""Read a normalization saved by SurveyNorm.save().
+
+	@type filename: string
+	@param filename: .npz file name
+	@type low_cut: float
+	@param low_cut: percent of the pixels below scale_min; the saved one if None
+	@type high_cut: float
+	@param high_cut: percent of the pixels above scale_max; the saved one if None
+	@rtype: SurveyNorm
+	@return: the normalization
+
+	"""
+	with numpy.load(filename) as saved:
+		meta = json.loads(str(saved['meta']))
+		histograms = {}
+		for key, (nan, lo, hi) in meta['stats'].items():
+			filt, data = key.rsplit('_', 1)
+			histogram = FilterHistogram(*meta['edges'])
+			histogram.counts = saved[key].astype(numpy.int64)
+			histogram.nan, histogram.min, histogram.max = nan, lo, hi
+			histograms[(filt, data)] = histogram
+	return SurveyNorm(histograms, meta['info'], meta['low_cut'] if low_cut is None else low_cut, meta['high_cut'] if high_cut is None else high_cut)
@@ -0,0 +1,216 @@
+#
+# Parameter sweeps of the img_scale stretches and of get_rgb(), for tuning the images made by fits_to_png_bulk.py
+#
+# You can freely use the code
+#
+
+import numpy
+import itertools
+import os
+import multiprocessing
+import pylab
+from alive_progress import alive_bar
+import img_scale
+import fits_to_png_bulk
+
+# Modes which are applied to the raw pixel data instead of the sky subtracted data (see fits_to_png_bulk.scale_data)
+raw_modes = ['log', 'histeq', 'logistic']
+
+# Modes which ignore min_val (see fits_to_png_bulk.scale_data)
+free_modes = ['histeq', 'logistic']
+
+def expand_grid(grid):
+	"""Expand a parameter grid into one array per parameter, one entry per variant.
+
+	@type grid: dictionary
+	@param grid: dictionary where the key is a keyword parameter of the scaling, and the value is a list of values to try
+	@rtype: tuple
+	@return: (list of label strings, dictionary of numpy arrays whose first axis runs over the variants)
+
+	"""
+	names = list(grid.keys())
+	combos = list(itertools.product(*[grid[name] for name in names]))
+
+	labels = []
+	for combo in combos:
+		labels.append(', '.join([name + '=' + str(value) for name, value in zip(names, combo)]))
+
+	params = {}
+	for i, name in enumerate(names):
+		params[name] = numpy.array([combo[i] for combo in combos], dtype=float)
+
+	return (labels, params)
+
+def sweep_galaxy(channel_data, mode, grid, min_val=0.0):
+	"""Evaluate every variant of a parameter grid on one sample in a single broadcast pass.
+
+	@type channel_data: list
+	@param channel_data: (img_data, img_data_raw, width, height) tuples from fits_to_png_bulk.load_galaxy()
+	@type mode: string
+	@param mode: scaling mode of img_scale.stretch_batch(), or 'rgb' to sweep get_rgb() settings (color_balance, non_linear) over R, G, B channel_data
+	@type grid: dictionary
+	@param grid: dictionary where the key is a keyword parameter of the scaling, and the value is a list of values to try
+	@type min_val: float
+	@param min_val: minimum data value
+	@rtype: tuple
+	@return: (list of label strings, (variants, filters, width, height) array, or (variants, width, height, 3) array for 'rgb')
+
+	"""
+	labels, params = expand_grid(grid)
+
+	if mode == 'rgb':
+		color_balances = params.get('color_balance', numpy.ones((len(labels), 3)))
+		non_linear = params.get('non_linear', numpy.full(len(labels), 0.005))
+		return (labels, fits_to_png_bulk.get_rgb_batch(channel_data, color_balances, min_val=min_val, non_linear=non_linear[:, None]))
+
+	if mode in raw_modes:
+		data = numpy.stack([channel[1] for channel in channel_data])
+	else:
+		data = numpy.stack([channel[0] for channel in channel_data])
+
+	if mode in free_modes:
+		min_val = None
+
+	# (variants, 1) parameters broadcast against the (filters, width, height) stack
+	for name in params:
+		params[name] = params[name][:, None]
+
+	return (labels, img_scale.stretch_batch(data, mode, scale_min=min_val, **params))
+
+def save_sweep_sheet(variants, labels, row_titles, title, out_file, color=pylab.cm.hot, size_inches=3.4, dpi=300):
+	"""Save one comparison sheet with every variant of a sample side by side.
+
+	@type variants: numpy array
+	@param variants: array returned by sweep_galaxy()
+	@type labels: list
+	@param labels: list of label strings, one per variant
+	@type row_titles: list
+	@param row_titles: list of filter name strings, one per row, or None for an RGB sweep
+	@type title: string
+	@param title: title of the sheet
+	@type out_file: string
+	@param out_file: file name of the .png image
+	@type color: matplotlib colormap
+	@param color: colormap to use for saved image
+	@type size_inches: float
+	@param size_inches: size of each panel
+	@type dpi: integer
+	@param dpi: dots per inch of output image
+	@rtype: None
+	@return: saves a pyplot figure as .png
+
+	"""
+	n_rows = 1 if row_titles is None else len(row_titles)
+	n_cols = len(labels)
+
+	fig, axes = pylab.subplots(n_rows, n_cols, squeeze=False)
+	fig.set_size_inches(size_inches * n_cols, size_inches * n_rows)
+
+	fs = 7
+
+	for j, label in enumerate(labels):
+		for i in range(n_rows):
+			axes[i][j].axis('off')
+			if row_titles is None:
+				axes[i][j].imshow(variants[j], interpolation='nearest', origin='lower')
+				axes[i][j].set_title(label, fontsize=fs)
+			else:
+				axes[i][j].imshow(variants[j][i], interpolation='nearest', origin='lower', cmap=color)
+				axes[i][j].set_title(row_titles[i] + ') ' + label, fontsize=fs)
+
+	out_path = os.path.dirname(out_file)
+	if out_path and not os.path.exists(out_path):
+		os.makedirs(out_path, exist_ok=True)
+
+	pylab.suptitle(title)
+	pylab.savefig(out_file, dpi=(dpi))
+	pylab.close('all')
+
+def sweep_one(job):
+	"""Load one sample, sweep it and save its comparison sheet.  Runs inside a worker process.
+
+	@type job: tuple
+	@param job: (folder_fn, f_id, filter_list, mode, grid, sig_fract, percent_fract, min_val, color, size_inches, dpi, dtype)
+	@rtype: string
+	@return: ID of the sample
+
+	"""
+	(folder_fn, f_id, filter_list, mode, grid, sig_fract, percent_fract, min_val, color, size_inches, dpi, dtype) = job
+
+	if mode == 'rgb':
+		# Same channels as fits_to_png_bulk.img_scale_collage()
+		filter_list = [filter_list[6], filter_list[4], filter_list[1]]
+
+	files = fits_to_png_bulk.galaxy_files(folder_fn, f_id, filter_list)
+	channel_data = fits_to_png_bulk.load_galaxy(files, sig_fract, percent_fract, dtype=dtype)
+	labels, variants = sweep_galaxy(channel_data, mode, grid, min_val=min_val)
+
+	row_titles = None if mode == 'rgb' else filter_list
+	out_file = folder_fn + '_sweep/' + mode + '/ceers_' + f_id + '_' + mode + '.png'
+	save_sweep_sheet(variants, labels, row_titles, 'ceers_' + f_id, out_file, color=color, size_inches=size_inches, dpi=dpi)
+
+	return f_id
+
+def sweep_bulk(folder_fn, id_list, filter_list, mode, grid, sig_fract, percent_fract, min_val=0.0, color=pylab.cm.hot, size_inches=3.4, dpi=300, processes=None, dtype=float):
+	"""Save a comparison sheet for every sample, with the samples spread over worker processes.
+
+	@type folder_fn: string
+	@param folder_fn: name of folder which contains filter folders with desired data
+	@type id_list: list
+	@param id_list: list of sample ID strings
+	@type filter_list: list
+	@param filter_list: list of filter name strings
+	@type mode: string
+	@param mode: scaling mode of img_scale.stretch_batch(), or 'rgb'
+	@type grid: dictionary
+	@param grid: dictionary where the key is a keyword parameter of the scaling, and the value is a list of values to try
+	@type sig_fract: float
+	@param sig_fract: fraction of sigma clipping
+	@type percent_fract: float
+	@param percent_fract: convergence fraction
+	@type min_val: float
+	@param min_val: minimum data value
+	@type color: matplotlib colormap
+	@param color: colormap to use for saved image
+	@type size_inches: float
+	@param size_inches: size of each panel
+	@type dpi: integer
+	@param dpi: dots per inch of output image
+	@type processes: integer
+	@param processes: number of worker processes, all cores if None
+	@type dtype: numpy dtype
+	@param dtype: floating point precision of the pixel data, float or numpy.float32
+	@rtype: None
+	@return: saves one pyplot figure as .png per sample
+
+	"""
+	jobs = [(folder_fn, f_id, filter_list, mode, grid, sig_fract, percent_fract, min_val, color, size_inches, dpi, dtype) for f_id in id_list]
+
+	with multiprocessing.Pool(processes) as pool:
+		with alive_bar(len(jobs), title='Sweep: ' + mode) as bar:
+			for f_id in pool.imap_unordered(sweep_one, jobs):
+				bar()
+
+def main():
+	sig_fract = 5.0
+	percent_fract = 0.01
+	i_scale = 2.0
+	dpi = 150
+	color = pylab.cm.Greys
+	restframes = fits_to_png_bulk.get_restframe_dict('sample_2/id_list.csv')
+
+	data_folder = 'sample_2'
+
+	filter_list = ['f115w',
+			'f150w',
+			'f200w',
+			'f277w',
+			'f356w',
+			'f410m',
+			'f444w',]
+
+	sweep_bulk(data_folder, list(restframes.keys()), filter_list, 'log', {'exponent': [100, 1000, 10000]}, sig_fract, percent_fract, color=color, size_inches=i_scale, dpi=dpi)
+	sweep_bulk(data_folder, list(restframes.keys()), filter_list, 'rgb', {'color_balance': [(1,1,1), (1,1.5,3), (1,3,5)]}, 3.0, 5.0-4, size_inches=i_scale, dpi=dpi)
+
+if __name__ == "__main__":
+	main()
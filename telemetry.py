@@ -0,0 +1,284 @@
+#
+# Live telemetry for long bulk runs: counters, gauges and latency histograms, rewritten every few seconds to a metrics
+# text file (Prometheus textfile format, e.g. for the node_exporter textfile collector) and a JSON status file, so a run
+# can be watched, and a stall caught, without the terminal its progress bar is in.
+# Both files are written to a temporary name and renamed, so a reader never sees half a file.
+#
+# You can freely use the code
+#
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+prefix = 'disk_galaxies_'
+
+# Upper bounds of the latency histogram buckets, in seconds
+buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+# name: (type, help) of the metrics the bulk functions publish
+metrics = OrderedDict([('galaxies_total', ('gauge', 'Galaxies in the run')),
+	('galaxies_done_total', ('counter', 'Galaxies rendered')),
+	('galaxies_rejected_total', ('counter', 'Galaxies the quality gate rejected')),
+	('galaxies_failed_total', ('counter', 'Galaxies whose rendering raised an error')),
+	('images_total', ('counter', 'Images saved')),
+	('galaxies_per_second', ('gauge', 'Galaxies rendered per second since the last write')),
+	('galaxies_per_second_mean', ('gauge', 'Galaxies rendered per second since the start')),
+	('stage_seconds', ('histogram', 'Time spent in each stage of the pipeline')),
+	('galaxy_seconds', ('histogram', 'Time spent on each galaxy, all modes')),
+	('queue_depth', ('gauge', 'Items waiting in each queue')),
+	('read_wait_seconds', ('gauge', 'Time spent waiting for galaxies to be read')),
+	('memo_bytes', ('gauge', 'Memory held by the dataflow graph')),
+	('resident_memory_bytes', ('gauge', 'Resident set size of the process')),
+	('open_fds', ('gauge', 'Open file descriptors of the process')),
+	('seconds_since_progress', ('gauge', 'Time since the last galaxy was done')),
+	('start_time_seconds', ('gauge', 'Start of the run, seconds since the epoch')),])
+
+def resident_memory():
+	"""
+	@rtype: integer
+	@return: resident set size of this process, in bytes (the peak where /proc isn't available), or None
+	"""
+	try:
+		with open('/proc/self/statm') as fin:
+			return int(fin.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, ValueError, IndexError):
+		pass
+	try:
+		import resource
+		import sys
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		return peak if sys.platform == 'darwin' else peak * 1024
+	except ImportError:
+		return None
+
+def open_fds():
+	"""
+	@rtype: integer
+	@return: number of open file descriptors of this process, or None where it can't be counted
+	"""
+	for path in ('/proc/self/fd', '/dev/fd'):
+		try:
+			return len(os.listdir(path))
+		except OSError:
+			pass
+	return None
+
+def label_text(labels):
+	"""Prometheus label set, e.g. {stage="read"}, from a tuple of (name, value) pairs."""
+	if not labels:
+		return ''
+	return '{' + ','.join(['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels]) + '}'
+
+def atomic_write(filename, text):
+	"""Write a file under a temporary name, then rename it over filename."""
+	temporary = filename + '.tmp'
+	with open(temporary, 'w') as fout:
+		fout.write(text)
+	os.replace(temporary, filename)
+
+class Histogram:
+	"""Cumulative bucket counts, sum and count of observations, as Prometheus histograms are."""
+
+	def __init__(self):
+		self.counts = [0] * len(buckets)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, value):
+		for i, bound in enumerate(buckets):
+			if value <= bound:
+				self.counts[i] += 1
+		self.count += 1
+		self.sum += value
+
+	def quantile(self, q):
+		"""Upper bound of the bucket the q quantile is in (None if beyond the last bucket or no observations)."""
+		for bound, count in zip(buckets, self.counts):
+			if count >= q * self.count > 0:
+				return bound
+		return None
+
+class Telemetry:
+	"""Counters, gauges and histograms of a run, written to outroot.prom and outroot.json every interval seconds."""
+
+	def __init__(self, outroot, interval=10.0, job='bulk'):
+		"""
+		@type outroot: string
+		@param outroot: output name without extension: outroot.prom (metrics) and outroot.json (status)
+		@type interval: float
+		@param interval: seconds between writes
+		@type job: string
+		@param job: name of the run, the job label of every metric
+
+		"""
+		self.outroot = outroot
+		self.interval = interval
+		self.job = job
+		self.lock = threading.Lock()
+		self.counters = OrderedDict()  # (name, labels): value
+		self.gauges = OrderedDict()
+		self.histograms = OrderedDict()
+		self.callbacks = OrderedDict()  # (name, labels): function returning the gauge's value
+		self.state = 'starting'
+		self.error = None
+		self.started = time.time()
+		self.last_progress = self.started
+		self.last_write = (self.started, 0)  # time, galaxies done
+		self.stopped = threading.Event()
+		self.thread = None
+		dirname = os.path.dirname(outroot)
+		if dirname:
+			os.makedirs(dirname, exist_ok=True)
+
+	def inc(self, name, value=1, **labels):
+		"""Add to a counter."""
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+			if name == 'galaxies_done_total':
+				self.last_progress = time.time()
+
+	def set(self, name, value, **labels):
+		"""Set a gauge."""
+		with self.lock:
+			self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+	def gauge(self, name, func, **labels):
+		"""Set a gauge to func() each time the files are written, e.g. the depth of a queue.
+
+		@type name: string
+		@param name: name of the gauge
+		@type func: function
+		@param func: function of no arguments returning a number, or None to leave the gauge out
+		@rtype: None
+
+		"""
+		with self.lock:
+			self.callbacks[(name, tuple(sorted(labels.items())))] = func
+
+	def observe(self, name, seconds, **labels):
+		"""Add an observation to a histogram."""
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			if key not in self.histograms:
+				self.histograms[key] = Histogram()
+			self.histograms[key].observe(seconds)
+
+	def timer(self, name, **labels):
+		"""Context manager observing the time spent in its block, e.g. with telemetry.timer('stage_seconds', stage='sky'):"""
+		return Timer(self, name, labels)
+
+	def sample(self):
+		"""Evaluate the gauge functions and the process and rate gauges."""
+		now = time.time()
+		for (name, labels), func in list(self.callbacks.items()):
+			value = func()
+			if value is not None:
+				self.set(name, value, **dict(labels))
+		for name, value in (('resident_memory_bytes', resident_memory()), ('open_fds', open_fds())):
+			if value is not None:
+				self.set(name, value)
+		with self.lock:
+			done = sum([value for (name, labels), value in self.counters.items() if name == 'galaxies_done_total'])
+			last_time, last_done = self.last_write
+			self.last_write = (now, done)
+			last_progress = self.last_progress
+		self.set('galaxies_per_second', (done - last_done) / max(now - last_time, 1e-9))
+		self.set('galaxies_per_second_mean', done / max(now - self.started, 1e-9))
+		self.set('seconds_since_progress', now - last_progress)
+		self.set('start_time_seconds', self.started)
+
+	def metrics_text(self):
+		"""
+		@rtype: string
+		@return: the metrics in the Prometheus text format
+		"""
+		job = (('job', self.job),)
+		lines = []
+		with self.lock:
+			series = [(name, labels, value) for (name, labels), value in list(self.counters.items()) + list(self.gauges.items()) + list(self.histograms.items())]
+			kinds = dict([(name, 'counter') for name, labels in self.counters] + [(name, 'gauge') for name, labels in self.gauges] + [(name, 'histogram') for name, labels in self.histograms])
+		names = sorted(kinds, key=lambda name: (list(metrics).index(name) if name in metrics else len(metrics), name))
+		for name in names:
+			kind, help_text = metrics.get(name, (kinds[name], ''))
+			if help_text:
+				lines.append('# HELP %s%s %s' % (prefix, name, help_text))
+			lines.append('# TYPE %s%s %s' % (prefix, name, kind))
+			for series_name, labels, value in series:
+				if series_name != name:
+					continue
+				if isinstance(value, Histogram):
+					for bound, count in zip(buckets, value.counts):
+						lines.append('%s%s_bucket%s %d' % (prefix, name, label_text(job + labels + (('le', repr(bound)),)), count))
+					lines.append('%s%s_bucket%s %d' % (prefix, name, label_text(job + labels + (('le', '+Inf'),)), value.count))
+					lines.append('%s%s_sum%s %r' % (prefix, name, label_text(job + labels), value.sum))
+					lines.append('%s%s_count%s %d' % (prefix, name, label_text(job + labels), value.count))
+				else:
+					lines.append('%s%s%s %r' % (prefix, name, label_text(job + labels), float(value)))
+		return '\n'.join(lines) + '\n'
+
+	def status(self):
+		"""
+		@rtype: dictionary
+		@return: the state of the run (starting, running, finished or failed), the counters and gauges, and the count,
+		mean and bucket bound of the median and 95th percentile of each histogram
+		"""
+		with self.lock:
+			values = OrderedDict()
+			for (name, labels), value in list(self.counters.items()) + list(self.gauges.items()):
+				values[name + label_text(labels)] = value
+			latency = OrderedDict()
+			for (name, labels), histogram in self.histograms.items():
+				latency[name + label_text(labels)] = {'count': histogram.count, 'mean': histogram.sum / max(histogram.count, 1), 'p50': histogram.quantile(0.5), 'p95': histogram.quantile(0.95)}
+		return {'job': self.job, 'state': self.state, 'error': self.error, 'pid': os.getpid(), 'started': self.started, 'updated': time.time(), 'metrics': values, 'latency': latency}
+
+	def write(self):
+		"""Sample the gauges and rewrite both files."""
+		self.sample()
+		atomic_write(self.outroot + '.prom', self.metrics_text())
+		atomic_write(self.outroot + '.json', json.dumps(self.status(), indent=1))
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			self.write()
+
+	def start(self):
+		"""Write the files now, then every interval seconds on a background thread."""
+		self.state = 'running'
+		self.write()
+		self.thread = threading.Thread(target=self.run, name='telemetry', daemon=True)
+		self.thread.start()
+		return self
+
+	def close(self, error=None):
+		"""Stop the background thread and write the files a last time, with the state finished, or failed if error."""
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+		self.state = 'failed' if error else 'finished'
+		self.error = None if error is None else repr(error)
+		self.write()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, kind, value, traceback):
+		self.close(value)
+
+class Timer:
+	"""See Telemetry.timer()."""
+
+	def __init__(self, telemetry, name, labels):
+		self.telemetry = telemetry
+		self.name = name
+		self.labels = labels
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, kind, value, traceback):
+		self.telemetry.observe(self.name, time.perf_counter() - self.start, **self.labels)
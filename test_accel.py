@@ -0,0 +1,129 @@
+#
+# Tests of the accel.py kernels against the numpy code they stand in for
+# Each case runs the same img_scale.py or Trilogy_rgb.py call with the kernels on and off; skipped without numba
+#
+# You can freely use the code
+#
+
+import unittest
+import numpy
+import accel
+import img_scale
+import Trilogy_rgb
+
+
+def reference(func, *args, **kwargs):
+	"""Run func with the compiled kernels turned off, restoring the previous setting after.
+
+	@type func: function
+	@param func: img_scale.py or Trilogy_rgb.py function
+	@rtype: object
+	@return: what func returns on the numpy path
+
+	"""
+	previous = accel.enabled
+	accel.use(False)
+	try:
+		return func(*args, **kwargs)
+	finally:
+		accel.enabled = previous
+
+def galaxy(size=200, dtype=numpy.float64, seed=0):
+	"""A noisy exponential disk on a sky of 10 counts, like the sample cutouts.
+
+	@type size: int
+	@param size: width and height in pixels
+	@type dtype: numpy dtype
+	@param dtype: pixel type
+	@type seed: int
+	@param seed: seed of the noise
+	@rtype: numpy array
+	@return: size x size image
+
+	"""
+	y, x = numpy.mgrid[:size, :size] - size / 2.0
+	disk = 500.0 * numpy.exp(-numpy.hypot(x, 1.6 * y) / (size / 12.0))
+	noise = numpy.random.RandomState(seed).normal(0.0, 3.0, (size, size))
+	return (10.0 + disk + noise).astype(dtype)
+
+
+@unittest.skipUnless(accel.available, 'numba is not installed')
+class KernelTest(unittest.TestCase):
+
+	# relative and absolute tolerances: the kernels multiply by precomputed factors and sum in another order
+	dtypes = {numpy.float64: (1e-9, 1e-12), numpy.float32: (1e-5, 1e-6)}
+
+	def setUp(self):
+		self.enabled = accel.use(True)
+
+	def tearDown(self):
+		accel.enabled = self.enabled
+
+	def check_stretch(self, func, **params):
+		for dtype, (rtol, atol) in self.dtypes.items():
+			data = galaxy(dtype=dtype)
+			# numpy.float64 limits make float32 data float64 in linear and sqrt
+			for lo, hi in [(10.0, 400.0), numpy.percentile(data, [1.0, 99.5])]:
+				fast = func(data, scale_min=lo, scale_max=hi, **params)
+				slow = reference(func, data, scale_min=lo, scale_max=hi, **params)
+				self.assertEqual(fast.dtype, slow.dtype)
+				numpy.testing.assert_allclose(fast, slow, rtol=rtol, atol=atol)
+
+	def test_linear(self):
+		self.check_stretch(img_scale.linear)
+
+	def test_sqrt(self):
+		self.check_stretch(img_scale.sqrt)
+
+	def test_log(self):
+		self.check_stretch(img_scale.log, exponent=1000)
+
+	def test_power(self):
+		self.check_stretch(img_scale.power, power_index=3.0)
+
+	def test_asinh(self):
+		self.check_stretch(img_scale.asinh, non_linear=2.0)
+
+	def test_logistic(self):
+		self.check_stretch(img_scale.logistic, center=0.5, slope=1.0)
+
+	def test_chunked_stretch(self):
+		# split the image over the thread pool, as happens for large images
+		data = galaxy(size=300)
+		chunk = accel.chunk
+		accel.chunk = 4096
+		try:
+			fast = img_scale.asinh(data, scale_min=10.0, scale_max=400.0)
+		finally:
+			accel.chunk = chunk
+		numpy.testing.assert_allclose(fast, reference(img_scale.asinh, data, scale_min=10.0, scale_max=400.0), rtol=1e-9, atol=1e-12)
+
+	def check_sky(self, func):
+		for dtype, (rtol, atol) in self.dtypes.items():
+			data = galaxy(dtype=dtype)
+			for cuts in [(True, True), (True, False), (False, True)]:
+				fast, fast_iter = func(data, 3.0, 0.01, 10, *cuts)
+				slow, slow_iter = reference(func, data, 3.0, 0.01, 10, *cuts)
+				self.assertEqual(fast_iter, slow_iter)
+				self.assertAlmostEqual(fast, slow, delta=rtol * abs(slow) + atol)
+
+	def test_sky_mean_sig_clip(self):
+		self.check_sky(img_scale.sky_mean_sig_clip)
+
+	def test_sky_median_sig_clip(self):
+		self.check_sky(img_scale.sky_median_sig_clip)
+
+	def test_imscale2(self):
+		# the levels come from Trilogy's own fit, and must agree to within 1 out of 256
+		for dtype in self.dtypes:
+			data = galaxy(dtype=dtype)
+			levels = Trilogy_rgb.determinescaling(data, 1 - 1e-5, correctbias=False)
+			for y1 in [0.5, 0.1]:  # the closed form, and the fit of k
+				fast = Trilogy_rgb.imscale2(data, levels, y1)
+				slow = reference(Trilogy_rgb.imscale2, data, levels, y1)
+				self.assertEqual(fast.dtype, numpy.uint8)
+				self.assertLessEqual(numpy.abs(fast.astype(int) - slow).max(), 1)
+
+
+if __name__ == '__main__':
+	unittest.main()
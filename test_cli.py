@@ -0,0 +1,71 @@
+#
+# Tests of cli.py's startup: --help and index must start quickly in a fresh interpreter, without importing the heavy
+# modules (astropy, matplotlib, fits_to_png_bulk.py) the rendering subcommands need
+#
+# You can freely use the code
+#
+
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+cli = os.path.join(here, 'cli.py')
+
+# seconds each command may take to start, the fastest of repeat runs counting
+budget = 0.5
+repeat = 3
+
+# modules which --help and index must not import
+heavy = ['astropy', 'matplotlib', 'scipy', 'fits_to_png_bulk']
+
+commands = [['--help'], ['index', os.path.join(here, 'small_sample'), '--out', os.devnull]]
+
+
+def startup_time(command):
+	"""Fastest of repeat runs of cli.py with a command, each in a fresh interpreter.
+
+	@type command: list
+	@param command: cli.py arguments
+	@rtype: float
+	@return: seconds
+
+	"""
+	best = float('inf')
+	for i in range(repeat):
+		start = time.perf_counter()
+		subprocess.run([sys.executable, cli] + command, check=True, stdout=subprocess.DEVNULL, cwd=here)
+		best = min(best, time.perf_counter() - start)
+	return best
+
+def imported(command):
+	"""Top level modules imported by running cli.py with a command in a fresh interpreter.
+
+	@type command: list
+	@param command: cli.py arguments
+	@rtype: set
+	@return: set of module names
+
+	"""
+	script = 'import sys, cli\ntry:\n\tcli.main(sys.argv[1:])\nexcept SystemExit:\n\tpass\nprint(" ".join(sys.modules), file=sys.stderr)'
+	result = subprocess.run([sys.executable, '-c', script] + command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, cwd=here)
+	return set([name.split('.')[0] for name in result.stderr.split()])
+
+
+class StartupTest(unittest.TestCase):
+
+	def test_budget(self):
+		for command in commands:
+			with self.subTest(command=command[0]):
+				self.assertLessEqual(startup_time(command), budget)
+
+	def test_light_imports(self):
+		for command in commands:
+			with self.subTest(command=command[0]):
+				self.assertFalse(imported(command) & set(heavy))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,66 @@
+#
+# Tests of dataflow.py's Graph: memoization and least recently used eviction, by get() and by put()
+#
+# You can freely use the code
+#
+
+import unittest
+import numpy
+import dataflow
+
+calls = []
+
+def block(index):
+	"""A 1 kB value, recording the call."""
+	calls.append(index)
+	return numpy.full(128, index, float)
+
+def node(index):
+	return dataflow.Node(block, index=index)
+
+
+class GraphTest(unittest.TestCase):
+
+	def setUp(self):
+		del calls[:]
+		# room for 3 values of 1 kB
+		self.graph = dataflow.Graph(max_bytes=3 * 1024)
+
+	def test_memoized(self):
+		self.graph.get(node(0))
+		self.graph.get(node(0))
+		self.assertEqual(calls, [0])
+		self.assertEqual(self.graph.hits, 1)
+
+	def test_get_evicts(self):
+		for index in range(4):
+			self.graph.get(node(index))
+		self.assertEqual(self.graph.nbytes, 3 * 1024)
+		self.assertNotIn(node(0).key, self.graph.memo)
+		self.graph.get(node(0))
+		self.assertEqual(calls, [0, 1, 2, 3, 0])
+
+	def test_put_evicts(self):
+		for index in range(5):
+			self.graph.put(node(index), numpy.full(128, index, float))
+		self.assertEqual(self.graph.nbytes, 3 * 1024)
+		self.assertEqual(self.graph.evictions, 2)
+		self.assertEqual(list(self.graph.memo), [node(index).key for index in (2, 3, 4)])
+
+	def test_put_least_recently_used(self):
+		for index in range(3):
+			self.graph.put(node(index), numpy.full(128, index, float))
+		self.graph.get(node(0))
+		self.graph.put(node(3), numpy.full(128, 3, float))
+		self.assertEqual(list(self.graph.memo), [node(index).key for index in (2, 0, 3)])
+
+	def test_put_keeps_inserted(self):
+		self.graph.put(node(0), numpy.zeros(128))
+		self.graph.put(node(1), numpy.zeros(1024))
+		self.assertEqual(list(self.graph.memo), [node(1).key])
+		self.assertIs(self.graph.get(node(1)), self.graph.memo[node(1).key])
+		self.assertEqual(calls, [])
+
+
+if __name__ == '__main__':
+	unittest.main()
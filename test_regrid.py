@@ -0,0 +1,91 @@
+#
+# Tests of regrid.py: tiled reprojection against whole image reprojection, and the grid key
+#
+# You can freely use the code
+#
+
+import unittest
+import numpy
+from astropy.io import fits
+from astropy.wcs import WCS
+import regrid
+
+
+def header(size, scale, **cards):
+	"""Header of a TAN grid whose first pixel centre is at (150, 2), size x size pixels of scale arcsec.
+
+	@type size: int
+	@param size: width and height in pixels
+	@type scale: float
+	@param scale: pixel scale in arcsec
+	@type cards: dict
+	@param cards: more header cards, e.g. exposure dates
+	@rtype: astropy.io.fits.Header
+	@return: FITS header
+
+	"""
+	wcs = WCS(naxis=2)
+	wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+	wcs.wcs.crval = [150.0, 2.0]
+	wcs.wcs.crpix = [1.0, 1.0]
+	wcs.wcs.cdelt = [-scale / 3600.0, scale / 3600.0]
+	result = wcs.to_header()
+	result['NAXIS'] = 2
+	result['NAXIS1'] = size
+	result['NAXIS2'] = size
+	result.update(cards)
+	return result
+
+
+class ReprojectionTest(unittest.TestCase):
+
+	def setUp(self):
+		regrid.mappings.clear()
+		# a source grid 2x coarser than the target: the target's first row and column land on the source's edge
+		self.source = header(50, 0.06)
+		self.target = header(100, 0.03)
+		self.data = numpy.random.RandomState(0).uniform(1.0, 2.0, (50, 50))
+
+	def resample(self, tile):
+		reprojection = regrid.Reprojection(self.source, self.target)
+		out = numpy.zeros((100, 100))
+		for ylo in range(0, 100, tile):
+			for xlo in range(0, 100, tile):
+				limits = (ylo, min(ylo + tile, 100), xlo, min(xlo + tile, 100))
+				out[limits[0]:limits[1], limits[2]:limits[3]] = reprojection.resample(self.data, limits)
+		return out
+
+	def test_tiles(self):
+		whole = self.resample(100)
+		for tile in (30, 16, 7):
+			numpy.testing.assert_allclose(self.resample(tile), whole, rtol=1e-6)
+
+	def test_edges(self):
+		# every target pixel lands on the source image (the last ones half a source pixel past its last centre)
+		whole = self.resample(100)
+		self.assertTrue((whole > 0).all())
+		self.assertAlmostEqual(whole[0, 0], self.data[0, 0], places=6)
+
+	def test_outside(self):
+		# tiles off the source image are 0
+		tile = regrid.Reprojection(header(20, 0.06), self.target).resample(self.data[:20, :20], (60, 100, 60, 100))
+		self.assertFalse(tile.any())
+
+
+class GridKeyTest(unittest.TestCase):
+
+	def test_same_grid(self):
+		first = header(100, 0.03, **{'DATE-BEG': '2022-06-21T12:00:00', 'MJD-BEG': 59751.5, 'XPOSURE': 2834.0})
+		second = header(100, 0.03, **{'DATE-BEG': '2022-12-24T03:00:00', 'MJD-BEG': 59937.1, 'XPOSURE': 3092.0})
+		self.assertEqual(regrid.grid_key(first), regrid.grid_key(second))
+
+	def test_other_grid(self):
+		self.assertNotEqual(regrid.grid_key(header(100, 0.03)), regrid.grid_key(header(100, 0.06)))
+		self.assertNotEqual(regrid.grid_key(header(100, 0.03)), regrid.grid_key(header(101, 0.03)))
+		shifted = header(100, 0.03)
+		shifted['CRPIX1'] = 2.0
+		self.assertNotEqual(regrid.grid_key(header(100, 0.03)), regrid.grid_key(shifted))
+
+
+if __name__ == '__main__':
+	unittest.main()